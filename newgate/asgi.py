@@ -12,5 +12,9 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'newgate.settings')
+# Under ASGI every request's sync code runs in its own thread, and a persistent
+# connection per thread is never reused: close them after each request unless
+# configured otherwise (DB_POOL=1 is the better option here).
+os.environ.setdefault('DB_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
+import sys
+from datetime import timedelta
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -51,6 +53,8 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
+    'rest_framework',
     'shop.apps.YourAppConfig'
     
 ]
@@ -66,7 +70,9 @@ INSTALLED_APPS = [
 # }
 
 MIDDLEWARE = [
+    'shop.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'shop.db_routers.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -81,7 +87,8 @@ ROOT_URLCONF = 'newgate.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, timing each render for the request metrics
+        'BACKEND': 'shop.metrics.TimedDjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR,  'shop ', 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -115,17 +122,187 @@ WSGI_APPLICATION = 'newgate.wsgi.application'
 #     }
 # }
 
+def env_bool(name, default=False):
+    return os.environ.get(name, str(default)).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def database_settings(prefix, **defaults):
+    """
+    Postgres settings read from <prefix>_NAME/_USER/_PASSWORD/_HOST/_PORT.
+
+    DB_CONN_MAX_AGE keeps connections open between requests (seconds, 0 to
+    close after each request) and DB_CONN_HEALTH_CHECKS pings a reused
+    connection before handing it out. DB_POOL=1 switches to psycopg 3's
+    connection pool instead (needs the psycopg[pool] package; persistent
+    connections are disabled then, since the pool already keeps them open).
+    DB_STATEMENT_TIMEOUT_MS aborts runaway queries server-side.
+    """
+    config = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get(f'{prefix}_NAME', defaults.get('NAME', 'ecomm')),
+        'USER': os.environ.get(f'{prefix}_USER', defaults.get('USER', 'root')),
+        'PASSWORD': os.environ.get(f'{prefix}_PASSWORD', defaults.get('PASSWORD', 'mypassword')),
+        'HOST': os.environ.get(f'{prefix}_HOST', defaults.get('HOST', 'localhost')),
+        'PORT': os.environ.get(f'{prefix}_PORT', defaults.get('PORT', '5432')),
+        'CONN_MAX_AGE': env_int('DB_CONN_MAX_AGE', 60),
+        'CONN_HEALTH_CHECKS': env_bool('DB_CONN_HEALTH_CHECKS', True),
+        'OPTIONS': {},
+    }
+    if env_bool('DB_POOL'):
+        config['CONN_MAX_AGE'] = 0
+        config['OPTIONS']['pool'] = {
+            'min_size': env_int('DB_POOL_MIN_SIZE', 2),
+            'max_size': env_int('DB_POOL_MAX_SIZE', 10),
+            'timeout': env_int('DB_POOL_TIMEOUT', 10),
+        }
+    statement_timeout = env_int('DB_STATEMENT_TIMEOUT_MS', 0)
+    if statement_timeout:
+        config['OPTIONS']['options'] = f'-c statement_timeout={statement_timeout}'
+    return config
+
+
 DATABASES = {
+    'default': database_settings('DB'),
+}
+
+# Optional read replica for catalog and reporting reads (see shop.db_routers)
+if os.environ.get('DB_REPLICA_HOST'):
+    DATABASES['replica'] = database_settings('DB_REPLICA', **{
+        key: DATABASES['default'][key] for key in ('NAME', 'USER', 'PASSWORD', 'PORT')
+    })
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+    DATABASE_ROUTERS = ['shop.db_routers.ReplicaRouter']
+
+REPLICA_DATABASE = 'replica'
+# Reads stay on the primary this long after a client writes
+REPLICA_PIN_SECONDS = env_int('DB_REPLICA_PIN_SECONDS', 10)
+# Fall back to the primary when the replica is further behind than this
+REPLICA_MAX_LAG_SECONDS = env_int('DB_REPLICA_MAX_LAG_SECONDS', 5)
+REPLICA_CHECK_SECONDS = env_int('DB_REPLICA_CHECK_SECONDS', 5)
+
+# Cache
+# CACHE_BACKEND selects locmem (per process, the default), file or redis
+# (needs the redis package); CACHE_LOCATION overrides the backend's default.
+# Bump CACHE_VERSION to invalidate everything after a deploy.
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'newgate'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', os.path.join(BASE_DIR, 'cache')),
+    'redis': ('django.core.cache.backends.redis.RedisCache', 'redis://localhost:6379/1'),
+}
+CACHE_BACKEND, CACHE_LOCATION = CACHE_BACKENDS[os.environ.get('CACHE_BACKEND', 'locmem')]
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'ecomm',
-        'USER': 'root',
-        'PASSWORD': 'mypassword',
-        'HOST': 'localhost',
-        'PORT': '5432',
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.environ.get('CACHE_LOCATION', CACHE_LOCATION),
+        'KEY_PREFIX': 'newgate',
+        'VERSION': env_int('CACHE_VERSION', 1),
+        'TIMEOUT': env_int('CACHE_TIMEOUT', 300),
     }
 }
 
+# Request instrumentation (see shop.metrics)
+REQUEST_METRICS_SERVER_TIMING = env_bool('REQUEST_METRICS_SERVER_TIMING', DEBUG)
+REQUEST_METRICS_DUPLICATE_THRESHOLD = 3
+# Most queries a request to each URL name, or (URL name, method), may run;
+# savepoints count. Over budget logs a warning, or raises when
+# QUERY_BUDGET_STRICT is on (the default under `manage.py test`).
+QUERY_BUDGETS = {
+    'home': 14,
+    'profile': 10,
+    'order_history': 10,
+    # A first visit creates the session and the cart
+    'cart': 14,
+    ('checkout', 'GET'): 12,
+    # A customer's first order also creates their order summary; each further
+    # line item adds a stock update (two with a variant)
+    ('checkout', 'POST'): 30,
+    'header_counts_api': 6,
+    'autocomplete': 2,
+    'order_list': 12,
+    'export_orders': 3,
+    # Product API: versions + rows + one query per prefetched relation
+    'api_product_list': 5,
+    'api_product_detail': 5,
+    'api_category_list': 2,
+    'api_category_detail': 2,
+    'api_brand_list': 2,
+    'api_brand_detail': 2,
+    # Account API: a batch costs about the same as a single change
+    'api_cart': 10,
+    'api_wishlist': 12,
+    'api_checkout': 24,
+}
+QUERY_BUDGET_STRICT = env_bool('QUERY_BUDGET_STRICT', sys.argv[1:2] == ['test'])
+
+# Live header counts (see shop.live_counts): comment heartbeat interval on idle
+# streams, and how often a stream re-reads counts without a notification
+# (changes made in other processes aren't published to this one).
+LIVE_COUNTS_HEARTBEAT_SECONDS = 20
+LIVE_COUNTS_RECHECK_SECONDS = env_int('LIVE_COUNTS_RECHECK_SECONDS', 120)
+
+# Background tasks (see shop.tasks), run by `manage.py run_task_worker`.
+# A claimed task that hasn't finished after TASK_LEASE_SECONDS is handed to
+# another worker; failures are retried with exponential backoff between
+# TASK_RETRY_BASE_SECONDS and TASK_RETRY_MAX_SECONDS.
+TASK_LEASE_SECONDS = env_int('TASK_LEASE_SECONDS', 300)
+TASK_MAX_ATTEMPTS = env_int('TASK_MAX_ATTEMPTS', 5)
+TASK_RETRY_BASE_SECONDS = env_int('TASK_RETRY_BASE_SECONDS', 10)
+TASK_RETRY_MAX_SECONDS = env_int('TASK_RETRY_MAX_SECONDS', 3600)
+
+# JSON API (see shop.api)
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+    'DEFAULT_PARSER_CLASSES': ['rest_framework.parsers.JSONParser'],
+}
+
+# Short-lived access tokens: the account API trusts their claims without
+# looking the user up, so a deactivated user keeps access until expiry.
+SIMPLE_JWT = {
+    'ACCESS_TOKEN_LIFETIME': timedelta(minutes=env_int('JWT_ACCESS_MINUTES', 10)),
+    'REFRESH_TOKEN_LIFETIME': timedelta(days=env_int('JWT_REFRESH_DAYS', 14)),
+    'UPDATE_LAST_LOGIN': False,
+}
+
+# Outgoing mail (order confirmations); printed to the console unless configured
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'localhost')
+EMAIL_PORT = env_int('EMAIL_PORT', 25)
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'orders@newgate.local')
+
+# Logging (see shop.logs): JSON lines written by a background thread.
+# LOG_LEVELS sets per-module levels, e.g. "shop.views=DEBUG,shop.metrics=INFO";
+# only LOG_DEBUG_SAMPLE_RATE of DEBUG records are kept.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_LEVELS = {
+    'shop.metrics': 'WARNING',  # one INFO record per request
+    **dict(item.split('=', 1) for item in os.environ.get('LOG_LEVELS', '').split(',') if '=' in item),
+}
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '0.1'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'sample_debug': {'()': 'shop.logs.SampleFilter', 'rate': LOG_DEBUG_SAMPLE_RATE},
+    },
+    'handlers': {
+        'background': {
+            '()': 'shop.logs.BackgroundHandler',
+            'filename': os.environ.get('LOG_FILE') or None,
+            'filters': ['sample_debug'],
+        },
+    },
+    'loggers': {
+        'shop': {'handlers': ['background'], 'level': LOG_LEVEL, 'propagate': False},
+        **{name: {'level': level} for name, level in LOG_LEVELS.items()},
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -1,15 +1,93 @@
 from django.contrib import admin
 from .models import Category, Tag, Product
 from django.contrib import admin
-from .models import Order, OrderItem, Address, ProductImage, ProductVariant, Brand, Review
+from .models import Order, OrderItem, Address, ProductImage, ProductVariant, Brand, Review, Task
+from django.utils import timezone
 from django.utils.html import format_html
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Prefetch
+from django.utils.functional import cached_property
+from django.contrib import messages
+from django.shortcuts import redirect, render
+from django.urls import path
+import csv
+import io
+from .forms import ProductImportForm
+from .product_import import FeedError, ProductImporter, detect_format
+from .signals import batched_wishlist_changes
+from .utils import get_address_cities
+
+
+class BatchedWishlistDeleteMixin:
+    """
+    Deleting catalog objects cascades to every wishlist item of their
+    products; batch the counter updates those deletes trigger instead of
+    running one UPDATE per item.
+    """
+    def delete_model(self, request, obj):
+        with batched_wishlist_changes():
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with batched_wishlist_changes():
+            super().delete_queryset(request, queryset)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for large changelists: an unfiltered queryset is counted from
+    the planner's row estimate (pg_class.reltuples) instead of COUNT(*).
+    Small tables and filtered querysets still get an exact count.
+    """
+    exact_count_threshold = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = self.estimated_rows(queryset)
+            if estimate > self.exact_count_threshold:
+                return estimate
+        return super().count
+
+    @staticmethod
+    def estimated_rows(queryset):
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+        return max(row[0], 0) if row else 0
+
+
+class CityFilter(admin.SimpleListFilter):
+    title = 'City'
+    parameter_name = 'city'
+    field_path = 'delivery_address__city'
+
+    def lookups(self, request, model_admin):
+        return [(city, city) for city in get_address_cities()]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{self.field_path: self.value()})
+        return queryset
+
 
+class AddressCityFilter(CityFilter):
+    field_path = 'city'
 
 
 @admin.register(Address)
 class AddressAdmin(admin.ModelAdmin):
     search_fields = ('full_name', 'street', 'city', 'phone', 'user__email')
-    list_filter = ('city', 'country', 'is_default')
+    list_filter = (AddressCityFilter, 'country', 'is_default')
     list_display = ('full_name', 'city', 'country', 'phone', 'user')
     autocomplete_fields = ('user',)
     list_select_related = ('user',)
@@ -24,22 +102,13 @@ class OrderItemInline(admin.TabularInline):
     def subtotal_display(self, obj):
         if obj.price is None or obj.quantity is None:
             return "N/A"
-        return obj.discount_price * obj.quantity
+        return obj.get_cost()
     subtotal_display.short_description = "Subtotal"
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product', 'variant')
 
-class CityFilter(admin.SimpleListFilter):
-    title = 'City'
-    parameter_name = 'city'
 
-    def lookups(self, request, model_admin):
-        cities = Address.objects.order_by('city').values_list('city', flat=True).distinct()
-        return [(city, city) for city in cities if city]
-
-    def queryset(self, request, queryset):
-        if self.value():
-            return queryset.filter(delivery_address__city=self.value())
-        return queryset
 
 
 @admin.register(Order)
@@ -50,7 +119,9 @@ class OrderAdmin(admin.ModelAdmin):
         'delivery_address_info', 'get_products'
     )
     list_editable = ('status',)
-    list_filter = ('status', 'created_at')
+    list_filter = ('status', 'created_at', CityFilter)
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
     search_fields = (
         'delivery_address__full_name',
         'delivery_address__phone',
@@ -95,19 +166,23 @@ class OrderAdmin(admin.ModelAdmin):
 
     def get_products(self, obj):
         items = obj.items.all()
-        if items.exists():
+        if items:
             return ", ".join([f"{item.product.name} (x{item.quantity})" for item in items])
         return "No products"
     get_products.short_description = "Products Ordered"
 
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('delivery_address', 'user')
+        return super().get_queryset(request).select_related('delivery_address', 'user').prefetch_related(
+            Prefetch('items', queryset=OrderItem.objects.select_related('product').only(
+                'id', 'order_id', 'quantity', 'product__name'
+            ))
+        )
 
 
 
 
 
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(BatchedWishlistDeleteMixin, admin.ModelAdmin):
     list_display = ('name', 'slug', 'image')
     prepopulated_fields = {'slug': ('name',)}
     search_fields = ('name', 'description')
@@ -135,8 +210,9 @@ class ProductImageInline(admin.TabularInline):
         # Optional: add custom validation to ensure only one image is marked as main per product.
         return formset
       
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(BatchedWishlistDeleteMixin, admin.ModelAdmin):
     list_display = ('name', 'price', 'category', 'available', 'featured')
+    list_select_related = ('category',)
     list_filter = ('category', 'available', 'featured', 'tags')
     prepopulated_fields = {'slug': ('name',)}
     search_fields = ('name', 'description')
@@ -154,10 +230,53 @@ class ProductAdmin(admin.ModelAdmin):
         # Removed the 'Media' section since 'image' field no longer exists.
     )
     inlines = [ProductImageInline, ProductVariantInline]
+    change_list_template = 'admin/shop/product/change_list.html'
+
+    def get_urls(self):
+        urls = [
+            path('import/', self.admin_site.admin_view(self.import_feed_view), name='shop_product_import'),
+        ]
+        return urls + super().get_urls()
+
+    def import_feed_view(self, request):
+        if not self.has_add_permission(request) or not self.has_change_permission(request):
+            raise PermissionDenied
+
+        form = ProductImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            feed = form.cleaned_data['feed']
+            fmt = form.cleaned_data['format'] or detect_format(feed.name)
+            importer = ProductImporter(download_images=form.cleaned_data['download_images'])
+            # Uploads are read as a stream; large feeds belong in `manage.py import_products`
+            stream = io.TextIOWrapper(feed.file, encoding='utf-8', newline='')
+            try:
+                stats = importer.run(stream, fmt)
+            except (UnicodeDecodeError, csv.Error, FeedError) as e:
+                # The file itself is unreadable past some point; earlier batches are already saved
+                reason = "it is not UTF-8 text" if isinstance(e, UnicodeDecodeError) else e
+                form.add_error('feed', f"The feed could not be read: {reason}.")
+                if importer.stats.products:
+                    messages.warning(request, f"Imported before the error: {importer.stats}")
+            else:
+                messages.success(request, f"Imported {stats}")
+                for error in stats.errors[:10]:
+                    messages.warning(request, error)
+                return redirect('admin:shop_product_changelist')
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import products',
+            'form': form,
+        }
+        return render(request, 'admin/shop/product/import.html', context)
 
 admin.site.register(Product, ProductAdmin)
 
-admin.site.register(Brand)
+class BrandAdmin(BatchedWishlistDeleteMixin, admin.ModelAdmin):
+    pass
+
+admin.site.register(Brand, BrandAdmin)
 
 
 
@@ -166,6 +285,9 @@ class ReviewAdmin(admin.ModelAdmin):
     list_filter = ('rating', 'created_at', 'product')
     search_fields = ('comment', 'user__username', 'product__name')
     list_per_page = 25
+    list_select_related = ('product', 'user')
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
     
     def product_column(self, obj):
         return format_html('<strong>{}</strong><br><small>ID: {}</small>', 
@@ -207,4 +329,20 @@ class ReviewAdmin(admin.ModelAdmin):
     
     readonly_fields = ('created_at',)
 
-admin.site.register(Review, ReviewAdmin)
\ No newline at end of file
+admin.site.register(Review, ReviewAdmin)
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'status', 'attempts', 'max_attempts', 'run_at', 'created_at')
+    list_filter = ('status', 'name')
+    search_fields = ('name', 'last_error')
+    readonly_fields = ('attempts', 'last_error', 'created_at', 'updated_at')
+    actions = ['requeue']
+
+    @admin.action(description="Requeue selected tasks now")
+    def requeue(self, request, queryset):
+        count = queryset.exclude(status=Task.RUNNING).update(
+            status=Task.QUEUED, attempts=0, run_at=timezone.now(), updated_at=timezone.now()
+        )
+        self.message_user(request, f"{count} task(s) requeued.", messages.SUCCESS)
@@ -0,0 +1,428 @@
+"""
+Read-only JSON API for the catalog: products, categories and brands.
+
+- Cursor pagination (?cursor=..., ?page_size= up to 100), stable while
+  products are being added.
+- ?fields=name,price,images: sparse fieldsets. Each field maps to the
+  columns, joins and prefetches it needs (field_plans), so the query
+  loads only those. Unknown fields are a 400.
+- ?ids=3,1,2: up to MAX_BULK_IDS objects in one in_bulk() query,
+  returned in the order asked, with the ids that weren't found.
+- Strong ETags built from updated_at, plus the category's or brand's when
+  that field is included. List and detail requests first read only ids
+  and timestamps, so a revalidation answered with 304 costs one small
+  query. Changes made with update() or to variants, images and tags
+  bump Product.updated_at (see Product.touch and the signals).
+
+Catalog reads go to the replica when one is configured (db_routers).
+
+The cart, wishlist and checkout endpoints are for signed-in app clients.
+They authenticate with a JWT access token (POST /api/v1/token/), taking
+the user id from its claims without reading the session or user tables.
+A single request can apply a whole batch of changes and gets back the
+compact result. Pricing, stock and order placement are shared with the
+HTML checkout (shop.checkout).
+
+The staff endpoints are for scripts and ops tooling. They take the same
+JWT, but load the user on every request so that revoking staff rights
+takes effect at once, and answer 401/403 instead of redirecting to the
+login page.
+"""
+import hashlib
+
+from django.db import transaction
+from django.db.models import F, Prefetch
+from django.utils.cache import parse_etags
+from rest_framework import status, viewsets
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework_simplejwt.authentication import JWTAuthentication, JWTStatelessUserAuthentication
+
+from .checkout import EmptyCart, TokenInUse, delete_items, order_lines, place_order
+from .live_counts import publish_counts_changed
+from .models import (
+    Address, Brand, Cart, CartItem, Category, CheckoutSubmission, Order, Product, ProductImage, ProductVariant, Tag,
+    Wishlist, WishlistItem,
+)
+from .serializers import (
+    BrandSerializer, BulkOrderStatusSerializer, CartOpsSerializer, CategorySerializer, CheckoutSerializer, ProductSerializer,
+    WishlistChangeSerializer,
+)
+
+MAX_BULK_IDS = 100
+
+
+# ========== CATALOG API ==========
+
+class NewestFirstPagination(CursorPagination):
+    page_size = 24
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-id'
+
+
+class OldestFirstPagination(NewestFirstPagination):
+    ordering = 'id'
+
+
+class CatalogViewSet(viewsets.ReadOnlyModelViewSet):
+    # Public data: skip authentication (and the session lookup it would cost)
+    authentication_classes = []
+    permission_classes = [AllowAny]
+    pagination_class = NewestFirstPagination
+    # field -> {'only': columns, 'select': select_related, 'prefetch': prefetch_related};
+    # a field without a plan is a column of its own name
+    field_plans = {}
+    # field -> timestamp that also goes into the ETag when the field is included
+    etag_related = {}
+
+    def requested_fields(self):
+        allowed = self.serializer_class.Meta.fields
+        value = self.request.query_params.get('fields')
+        if not value:
+            return list(allowed)
+        requested = {name.strip() for name in value.split(',') if name.strip()}
+        unknown = requested - set(allowed)
+        if unknown:
+            raise ValidationError({'fields': f"Unknown fields: {', '.join(sorted(unknown))}"})
+        return [name for name in allowed if name in requested or name == 'id']
+
+    def planned_queryset(self, fields):
+        only, select, prefetch = {'id', 'updated_at'}, [], []
+        for name in fields:
+            plan = self.field_plans.get(name, {})
+            only.update(plan.get('only', (name,)))
+            select.extend(plan.get('select', ()))
+            prefetch.extend(plan.get('prefetch', ()))
+        queryset = self.get_queryset().prefetch_related(*prefetch).only(*only)
+        # select_related() without arguments would follow every foreign key
+        return queryset.select_related(*select) if select else queryset
+
+    def version_fields(self, fields):
+        return ['id', 'updated_at', *(self.etag_related[name] for name in fields if name in self.etag_related)]
+
+    def version_of(self, obj, fields):
+        """The version_fields() values of a loaded object, as values() would return them"""
+        version = {}
+        for path in self.version_fields(fields):
+            value = obj
+            for attr in path.split('__'):
+                value = getattr(value, attr) if value is not None else None
+            version[path] = value
+        return version
+
+    def make_etag(self, fields, versions):
+        source = repr((self.request.get_full_path(), fields, [tuple(v.values()) for v in versions]))
+        return f'"{hashlib.md5(source.encode()).hexdigest()}"'
+
+    def not_modified(self, etag):
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match and ('*' in parse_etags(if_none_match) or etag in parse_etags(if_none_match)):
+            return self.with_validators(Response(status=304), etag)
+        return None
+
+    def with_validators(self, response, etag):
+        response['ETag'] = etag
+        # Cacheable, but only after checking back with the ETag
+        response['Cache-Control'] = 'public, no-cache'
+        return response
+
+    def serialize(self, fields, objects):
+        return self.serializer_class(objects, many=True, fields=fields, context=self.get_serializer_context()).data
+
+    def load(self, fields, ids):
+        """The objects for `ids`, in that order, from a single in_bulk() query (plus the plan's prefetches)"""
+        found = self.planned_queryset(fields).in_bulk(ids)
+        return [found[pk] for pk in ids if pk in found]
+
+    def list(self, request, *args, **kwargs):
+        fields = self.requested_fields()
+        if 'ids' in request.query_params:
+            return self.bulk(fields)
+        versions = self.paginate_queryset(self.get_queryset().values(*self.version_fields(fields)))
+        etag = self.make_etag(fields, versions)
+        return self.not_modified(etag) or self.with_validators(self.get_paginated_response(
+            self.serialize(fields, self.load(fields, [version['id'] for version in versions]))
+        ), etag)
+
+    def retrieve(self, request, pk=None, *args, **kwargs):
+        fields = self.requested_fields()
+        version = self.get_queryset().filter(pk=pk).values(*self.version_fields(fields)).first()
+        if version is None:
+            raise NotFound()
+        etag = self.make_etag(fields, [version])
+        return self.not_modified(etag) or self.with_validators(Response(
+            self.serialize(fields, self.load(fields, [version['id']]))[0]
+        ), etag)
+
+    def bulk(self, fields):
+        try:
+            ids = list(dict.fromkeys(int(pk) for pk in self.request.query_params['ids'].split(',') if pk.strip()))
+        except ValueError:
+            raise ValidationError({'ids': "Expected a comma-separated list of ids"})
+        if len(ids) > MAX_BULK_IDS:
+            raise ValidationError({'ids': f"At most {MAX_BULK_IDS} ids per request"})
+        objects = self.load(fields, ids)
+        etag = self.make_etag(fields, [self.version_of(obj, fields) for obj in objects])
+        found = {obj.pk for obj in objects}
+        return self.not_modified(etag) or self.with_validators(Response({
+            'results': self.serialize(fields, objects),
+            'missing': [pk for pk in ids if pk not in found],
+        }), etag)
+
+
+class ProductViewSet(CatalogViewSet):
+    serializer_class = ProductSerializer
+    field_plans = {
+        'category': {
+            'only': ('category__id', 'category__name', 'category__slug', 'category__updated_at'),
+            'select': ('category',),
+        },
+        'brand': {
+            'only': ('brand__id', 'brand__name', 'brand__slug', 'brand__updated_at'),
+            'select': ('brand',),
+        },
+        'tags': {'only': (), 'prefetch': (Prefetch('tags', Tag.objects.only('id', 'name', 'slug')),)},
+        'images': {'only': (), 'prefetch': (Prefetch(
+            'images', ProductImage.objects.only('id', 'product_id', 'image', 'alt_text', 'is_main').order_by('-is_main', 'id')
+        ),)},
+        'variants': {'only': (), 'prefetch': (Prefetch(
+            'variants', ProductVariant.objects.order_by('id')
+        ),)},
+    }
+    etag_related = {'category': 'category__updated_at', 'brand': 'brand__updated_at'}
+
+    def get_queryset(self):
+        return Product.objects.filter(available=True)
+
+
+class CategoryViewSet(CatalogViewSet):
+    serializer_class = CategorySerializer
+    pagination_class = OldestFirstPagination
+
+    def get_queryset(self):
+        return Category.objects.all()
+
+
+class BrandViewSet(CatalogViewSet):
+    serializer_class = BrandSerializer
+    pagination_class = OldestFirstPagination
+
+    def get_queryset(self):
+        return Brand.objects.all()
+
+
+# ========== ACCOUNT API (JWT) ==========
+
+class AccountApiView(APIView):
+    # request.user is a TokenUser built from the token's claims: only .id is known
+    authentication_classes = [JWTStatelessUserAuthentication]
+    permission_classes = [IsAuthenticated]
+
+
+class CartView(AccountApiView):
+    """
+    GET the cart; POST {"ops": [...]} to change it; DELETE to empty it.
+    Each op is {"op": "add" | "set" | "remove", "product": id, "variant": id
+    or null, "quantity": n}. Every response is the resulting cart, priced
+    the way checkout will charge it.
+    """
+
+    def get(self, request):
+        return Response(self.cart_body(request.user.id))
+
+    def post(self, request):
+        serializer = CartOpsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ops = serializer.validated_data['ops']
+        self.check_targets(ops)
+        with transaction.atomic():
+            cart, _ = Cart.objects.get_or_create(user_id=request.user.id)
+            self.apply(cart, ops)
+        return Response(self.cart_body(request.user.id))
+
+    def delete(self, request):
+        with transaction.atomic():
+            cart = Cart.objects.filter(user_id=request.user.id).first()
+            if cart:
+                delete_items(CartItem.objects.select_for_update().filter(cart=cart), cart=cart)
+        return Response(self.cart_body(request.user.id))
+
+    def check_targets(self, ops):
+        """400 for ops adding products or variants that don't exist (removing them is fine)"""
+        adding = [op for op in ops if op['op'] != 'remove']
+        if not adding:
+            return
+        products = set(Product.objects.filter(pk__in={op['product'] for op in adding}).values_list('pk', flat=True))
+        variant_ids = {op['variant'] for op in adding if op['variant']}
+        variants = dict(
+            ProductVariant.objects.filter(pk__in=variant_ids).values_list('pk', 'product_id')
+        ) if variant_ids else {}
+        errors = {}
+        for index, op in enumerate(ops):
+            if op['op'] == 'remove':
+                continue
+            if op['product'] not in products:
+                errors[index] = "Unknown product."
+            elif op['variant'] and variants.get(op['variant']) != op['product']:
+                errors[index] = "Unknown variant for this product."
+        if errors:
+            raise ValidationError({'ops': errors})
+
+    def apply(self, cart, ops):
+        """Work out the new quantities in memory, then write them with one statement per kind of change"""
+        items = {
+            (item.product_id, item.variant_id): item
+            for item in CartItem.objects.select_for_update().filter(cart=cart)
+        }
+        quantities = {key: item.quantity for key, item in items.items()}
+        for op in ops:
+            key = (op['product'], op['variant'])
+            if op['op'] == 'add':
+                quantities[key] = quantities.get(key, 0) + op['quantity']
+            elif op['op'] == 'set':
+                quantities[key] = op['quantity']
+            else:
+                quantities[key] = 0
+        created, changed, removed = [], [], []
+        for key, quantity in quantities.items():
+            item = items.get(key)
+            if item is None:
+                if quantity:
+                    created.append(CartItem(cart=cart, product_id=key[0], variant_id=key[1], quantity=quantity))
+            elif not quantity:
+                removed.append(item)
+            elif quantity != item.quantity:
+                item.quantity = quantity
+                changed.append(item)
+        CartItem.objects.bulk_create(created)
+        CartItem.objects.bulk_update(changed, ['quantity'])
+        delete_items(removed, cart=cart)
+        if created or changed:
+            # Bulk writes don't send the CartItem signals
+            publish_counts_changed(cart.user_id)
+
+    def cart_body(self, user_id):
+        cart_items = CartItem.objects.filter(cart__user_id=user_id).select_related('product', 'variant').order_by('id')
+        total, lines = order_lines(cart_items)
+        return {
+            'count': sum(line['quantity'] for line in lines),
+            'total': str(total),
+            'items': [{
+                'product': line['product'].pk,
+                'variant': line['variant'].pk if line['variant'] else None,
+                'quantity': line['quantity'],
+                'price': str(line['discounted_price']),
+                'subtotal': str(line['total']),
+            } for line in lines],
+        }
+
+
+class WishlistView(AccountApiView):
+    """GET the wishlisted product ids, newest first; POST {"add": [ids], "remove": [ids]} to change them"""
+
+    def get(self, request):
+        return Response(self.wishlist_body(request.user.id))
+
+    def post(self, request):
+        serializer = WishlistChangeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        remove = set(serializer.validated_data['remove'])
+        add = [pk for pk in dict.fromkeys(serializer.validated_data['add']) if pk not in remove]
+        with transaction.atomic():
+            # Locked so that concurrent batches take turns: each sees what the other added
+            wishlist, _ = Wishlist.objects.select_for_update().get_or_create(user_id=request.user.id)
+            present = set(WishlistItem.objects.filter(wishlist=wishlist).values_list('product_id', flat=True))
+            add = [pk for pk in add if pk not in present]
+            if add:
+                found = set(Product.objects.filter(pk__in=add).values_list('pk', flat=True))
+                unknown = [pk for pk in add if pk not in found]
+                if unknown:
+                    raise ValidationError({'add': f"Unknown products: {', '.join(map(str, unknown))}"})
+                WishlistItem.objects.bulk_create([WishlistItem(wishlist=wishlist, product_id=pk) for pk in add])
+                # What the WishlistItem signals would have done for each new row
+                Product.objects.filter(pk__in=add).update(wishlist_count=F('wishlist_count') + 1)
+                publish_counts_changed(request.user.id)
+            if remove & present:
+                delete_items(WishlistItem.objects.filter(wishlist=wishlist, product_id__in=remove), wishlist=wishlist)
+        return Response(self.wishlist_body(request.user.id))
+
+    def wishlist_body(self, user_id):
+        products = list(
+            WishlistItem.objects.filter(wishlist__user_id=user_id)
+            .order_by('-added_at', '-id').values_list('product_id', flat=True)
+        )
+        return {'count': len(products), 'products': products}
+
+
+class CheckoutView(AccountApiView):
+    """
+    POST {"token": uuid, "address": {...} or "address_id": id, "save_address": bool}
+    orders the cart: 201 {"order": id}. The token makes retries safe: sending
+    it again answers 200 with the order it placed. A token another user
+    already used is a 409.
+    """
+
+    def post(self, request):
+        serializer = CheckoutSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        user_id = request.user.id
+
+        cart_items = CartItem.objects.filter(cart__user_id=user_id)
+        if not cart_items.exists():
+            # A retry finds the cart already emptied by the first request
+            submission = CheckoutSubmission.objects.filter(
+                CheckoutSubmission.owned_by(user_id), token=data['token'], order__isnull=False
+            ).first()
+            if submission:
+                return Response({'order': submission.order_id})
+            return Response({'detail': "Your cart is empty."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if 'address_id' in data:
+            address = Address.objects.filter(pk=data['address_id'], user_id=user_id).first()
+            if address is None:
+                raise ValidationError({'address_id': "Address not found."})
+        else:
+            address = Address(**data['address'], user_id=user_id if data['save_address'] else None)
+
+        try:
+            order_id, placed = place_order(cart_items, address, user_id=user_id, token=data['token'])
+        except TokenInUse:
+            return Response({'token': "This token was already used."}, status=status.HTTP_409_CONFLICT)
+        except EmptyCart:
+            return Response({'detail': "Your cart is empty."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'order': order_id}, status=status.HTTP_201_CREATED if placed else status.HTTP_200_OK)
+
+
+# ========== STAFF API (JWT) ==========
+
+class StaffApiView(APIView):
+    # The user row is read on each request: is_staff isn't in the token's claims
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsAdminUser]
+
+
+class OrderStatusBulkView(StaffApiView):
+    """
+    POST {"order_ids": [1, 2], "status": "shipped"} moves the orders in one
+    transition and answers with each order's outcome: updated, unchanged,
+    invalid_transition or not_found.
+    """
+
+    def post(self, request):
+        serializer = BulkOrderStatusSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        new_status = serializer.validated_data['status']
+        order_ids = list(dict.fromkeys(serializer.validated_data['order_ids']))
+
+        found = Order.transition_status(order_ids, new_status, changed_by=request.user)
+        results = Order.transition_results(order_ids, new_status, found)
+        return Response({
+            'status': new_status,
+            'updated': sum(1 for result in results.values() if result == 'updated'),
+            'results': {str(order_id): result for order_id, result in results.items()},
+        })
@@ -0,0 +1,199 @@
+"""
+Deterministic benchmark data.
+
+generate() fills the database with a reproducible catalog, customers,
+orders, reviews and wishlists: the same counts and seed always produce
+the same rows, so benchmark runs on different machines or commits are
+comparable. Everything it creates is recognisable by its "bench" prefix
+and is removed by flush().
+
+Rows are written with bulk_create, which skips model signals, so the
+derived data those signals maintain (carts and wishlists for new users,
+order summaries, wishlist counts, cache namespaces) is rebuilt
+explicitly at the end.
+"""
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .caching import invalidate
+from .models import (
+    Address, Brand, Cart, Category, Order, OrderItem, OrderSummary, Product, ProductImage, ProductVariant,
+    Review, Tag, Wishlist, WishlistItem,
+)
+
+User = get_user_model()
+
+BENCH_PASSWORD = 'bench-pass'
+BENCH_STAFF = 'bench_staff'
+BATCH_SIZE = 1000
+
+DEFAULT_COUNTS = {
+    'categories': 12,
+    'brands': 15,
+    'tags': 40,
+    'products': 500,
+    'variants': 2,    # per product
+    'images': 2,      # per product
+    'users': 200,
+    'orders': 2000,
+    'reviews': 1500,
+    'wishlists': 100,  # users with a wishlist
+}
+
+ADJECTIVES = ['Classic', 'Modern', 'Compact', 'Premium', 'Smart', 'Vintage', 'Slim', 'Bright', 'Solar', 'Pro']
+NOUNS = ['Lamp', 'Bulb', 'Panel', 'Lantern', 'Strip', 'Spotlight', 'Chandelier', 'Sconce', 'Torch', 'Fixture']
+COLORS = ['Warm White', 'Cool White', 'Black', 'Silver', 'Gold', 'RGB']
+CITIES = ['Lahore', 'Karachi', 'Islamabad', 'Faisalabad', 'Multan', 'Peshawar', 'Quetta']
+REVIEW_WORDS = ['bright', 'sturdy', 'cheap', 'excellent', 'dim', 'stylish', 'reliable', 'fast delivery', 'value']
+
+
+def bench_users():
+    return User.objects.filter(username__startswith='bench_')
+
+
+def flush():
+    """Remove all benchmark rows; users go first so their orders cascade before the products"""
+    with transaction.atomic():
+        bench_users().delete()
+        Address.objects.filter(slug__startswith='bench-').delete()
+        Product.objects.filter(slug__startswith='bench-').delete()
+        for model in (Category, Brand, Tag):
+            model.objects.filter(slug__startswith='bench-').delete()
+
+
+def bulk(model, objects):
+    return model.objects.bulk_create(objects, batch_size=BATCH_SIZE)
+
+
+def generate(counts=None, seed=42, log=None):
+    counts = {**DEFAULT_COUNTS, **(counts or {})}
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+
+    with transaction.atomic():
+        categories = bulk(Category, [
+            Category(name=f'Bench Category {n}', slug=f'bench-category-{n}') for n in range(counts['categories'])
+        ])
+        brands = bulk(Brand, [
+            Brand(name=f'Bench Brand {n}', slug=f'bench-brand-{n}') for n in range(counts['brands'])
+        ])
+        tags = bulk(Tag, [Tag(name=f'bench tag {n}', slug=f'bench-tag-{n}') for n in range(counts['tags'])])
+        log(f"{len(categories)} categories, {len(brands)} brands, {len(tags)} tags")
+
+        products = []
+        for n in range(counts['products']):
+            price = Decimal(rng.randrange(500, 50000)) / 10
+            products.append(Product(
+                name=f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {n}',
+                slug=f'bench-product-{n}',
+                description=f'Benchmark product {n}: ' + ' '.join(rng.sample(REVIEW_WORDS, 4)),
+                price=price,
+                discount_price=(price * Decimal('0.85')).quantize(Decimal('0.01')) if rng.random() < 0.3 else None,
+                category=rng.choice(categories),
+                brand=rng.choice(brands) if brands else None,
+                stock=rng.randrange(0, 200),
+                sold=rng.randrange(0, 1000),
+                featured=rng.random() < 0.05,
+            ))
+        products = bulk(Product, products)
+        ProductTag = Product.tags.through
+        bulk(ProductTag, [
+            ProductTag(product_id=product.pk, tag_id=tag.pk)
+            for product in products for tag in rng.sample(tags, min(3, len(tags)))
+        ])
+        variants = bulk(ProductVariant, [
+            ProductVariant(
+                product=product, sku=f'BENCH-{product.pk}-{v}', color=COLORS[v % len(COLORS)],
+                wattage=rng.choice([5, 9, 12, 18, 24]), additional_price=Decimal(v * 50), stock=rng.randrange(0, 50),
+            )
+            for product in products for v in range(counts['variants'])
+        ])
+        bulk(ProductImage, [
+            ProductImage(product=product, image=f'products/bench-{product.pk}-{i}.jpg', is_main=i == 0)
+            for product in products for i in range(counts['images'])
+        ])
+        log(f"{len(products)} products, {len(variants)} variants")
+
+        password = make_password(BENCH_PASSWORD)
+        users = bulk(User, [
+            User(username=f'bench_user_{n}', email=f'bench_user_{n}@example.com', password=password)
+            for n in range(counts['users'])
+        ])
+        users.append(User.objects.create(
+            username=BENCH_STAFF, email='bench_staff@example.com', password=password, is_staff=True,
+        ))
+        customers = users[:-1]
+        # The post_save receiver that normally creates these doesn't run for bulk_create
+        bulk(Cart, [Cart(user=user) for user in customers])
+        wishlists = bulk(Wishlist, [Wishlist(user=user) for user in customers])
+        addresses = [
+            Address(
+                user=user, full_name=f'Bench Customer {n}', email=user.email, street=f'{n} Bench Street',
+                city=rng.choice(CITIES), state='Punjab', postal_code=f'{54000 + n}', country='Pakistan',
+                phone=f'0300{n:07d}', slug=f'bench-address-{n}', is_default=True,
+            )
+            for n, user in enumerate(customers)
+        ]
+        for address in addresses:
+            address.fingerprint = address.compute_fingerprint()  # normally set by save()
+        addresses = bulk(Address, addresses)
+        log(f"{len(customers)} customers")
+
+        orders, lines, ages = [], [], []
+        for n in range(counts['orders'] if customers else 0):
+            index = rng.randrange(len(customers))
+            order_lines = []
+            for product in rng.sample(products, min(rng.randint(1, 4), len(products))):
+                quantity = rng.randint(1, 3)
+                order_lines.append(OrderItem(
+                    product=product, quantity=quantity, price=product.price,
+                    discounted_price=product.discount_price or product.price,
+                ))
+            orders.append(Order(
+                user=customers[index], delivery_address=addresses[index],
+                total=sum(line.discounted_price * line.quantity for line in order_lines),
+                status=rng.choice([choice for choice, _ in Order.STATUS_CHOICES]),
+            ))
+            lines.append(order_lines)
+            ages.append(timedelta(days=rng.randrange(90), seconds=rng.randrange(86400)))
+        orders = bulk(Order, orders)
+        bulk(OrderItem, [
+            OrderItem(order=order, product=line.product, quantity=line.quantity, price=line.price,
+                      discounted_price=line.discounted_price)
+            for order, order_lines in zip(orders, lines) for line in order_lines
+        ])
+        # Spread orders over the last 90 days (auto_now_add stamps them all "now")
+        now = timezone.now()
+        for order, age in zip(orders, ages):
+            order.created_at = now - age
+        Order.objects.bulk_update(orders, ['created_at'], batch_size=BATCH_SIZE)
+        for user in customers:
+            OrderSummary.rebuild(user.pk)
+        log(f"{len(orders)} orders")
+
+        pairs = set()
+        while customers and products and len(pairs) < min(counts['reviews'], len(customers) * len(products)):
+            pairs.add((rng.randrange(len(products)), rng.randrange(len(customers))))
+        bulk(Review, [
+            Review(product=products[p], user=customers[u], rating=rng.randint(1, 5),
+                   comment=' '.join(rng.choices(REVIEW_WORDS, k=rng.randint(3, 30))))
+            for p, u in sorted(pairs)
+        ])
+        bulk(WishlistItem, [
+            WishlistItem(wishlist=wishlist, product=product)
+            for wishlist in wishlists[:counts['wishlists']]
+            for product in rng.sample(products, min(5, len(products)))
+        ])
+        last_id = Product.objects.aggregate(last=Max('id'))['last'] or 0
+        Product.reconcile_wishlist_counts(0, last_id + 1)
+        log(f"{len(pairs)} reviews")
+
+    for model in (Product, Category, Brand, Tag, Review):
+        invalidate(model)
@@ -0,0 +1,338 @@
+"""
+Storefront benchmark scenarios and drivers.
+
+Each scenario turns an iteration number into plain request specs:
+untimed setup requests (e.g. putting an item in the cart before checkout)
+and the one request that is timed. That keeps the scenarios independent
+of how they are sent:
+
+- ClientDriver runs them in-process through Django's test client.
+- HttpDriver runs them against a running server (runserver, gunicorn,
+  ...) from several worker processes at once, using requests.
+
+Both read the query count from the Server-Timing header that
+shop.metrics adds (the "desc" of the db entry). Results are summarised
+per scenario (p50/p95/p99/mean latency, throughput, queries, errors) and
+can be compared with a stored baseline.
+
+run_concurrency() measures something different: how a server holds up
+as the number of simultaneously open connections grows, for comparing
+deployments (e.g. gunicorn/WSGI against uvicorn/ASGI) on one endpoint.
+It uses asyncio keep-alive connections, so one process can hold
+hundreds of them.
+"""
+import asyncio
+import json
+import re
+import statistics
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+from .bench_data import BENCH_PASSWORD, BENCH_STAFF
+
+SHOP_SORTS = ['price_low_to_high', 'price_high_to_low', 'newest_first']
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+CHECKOUT_FORM = {
+    'full_name': 'Bench Customer', 'email': 'bench@example.com', 'street': '1 Bench Street', 'city': 'Lahore',
+    'state': 'Punjab', 'postal_code': '54000', 'country': 'Pakistan', 'phone': '03001234567',
+    'save_address': 'on',  # reused from the user's addresses, so flush() removes it with them
+    'checkout_token': '{checkout_token}',
+}
+
+
+class Scenario:
+    """
+    One benchmarked request. Paths and form values are format strings filled
+    from the context's rotating values ({product_id}, {product_slug},
+    {category_slug}, {brand_slug}, {term}), so every iteration hits a
+    different row, and {checkout_token}, a new token per iteration as the
+    checkout page hands out. Setup
+    requests run before the timed one and aren't measured. Scenarios are
+    plain data so they can be shipped to HTTP worker processes.
+    """
+
+    def __init__(self, name, path, user=None, method='GET', data=None, setup=()):
+        self.name = name
+        self.path = path
+        self.user = user  # None (anonymous), 'customer' or 'staff'
+        self.method = method
+        self.data = data or {}
+        self.setup = setup  # (method, path) pairs
+
+    def requests(self, context, iteration):
+        values = {name: items[iteration % len(items)] for name, items in context['rotate'].items()}
+        values['checkout_token'] = uuid.uuid4()
+        setup = [(method, path.format(**values), {}) for method, path in self.setup]
+        data = {name: value.format(**values) for name, value in self.data.items()}
+        return setup, (self.method, self.path.format(**values), data)
+
+
+ADD_TO_CART = ('POST', '/add-to-cart/{product_id}/')
+
+SCENARIOS = [
+    Scenario('home_anonymous', '/'),
+    Scenario('home_customer', '/', user='customer'),
+    Scenario('shop', '/shop/'),
+    *[Scenario(f'shop_sort_{sort}', f'/shop/?sort_by={sort}') for sort in SHOP_SORTS],
+    Scenario('shop_category', '/shop/?category={category_slug}'),
+    Scenario('shop_brand', '/shop/?brand={brand_slug}'),
+    Scenario('shop_price_range', '/shop/?price_min=100&price_max=2000'),
+    Scenario('shop_all_filters', '/shop/?category={category_slug}&brand={brand_slug}'
+                                 '&price_min=100&price_max=4000&sort_by=price_low_to_high'),
+    Scenario('shop_customer', '/shop/?sort_by=newest_first', user='customer'),
+    Scenario('search', '/search/?q={term}'),
+    Scenario('autocomplete', '/autocomplete/?term={term}'),
+    Scenario('product_detail', '/product/{product_slug}/'),
+    Scenario('product_detail_customer', '/product/{product_slug}/', user='customer'),
+    Scenario('cart', '/cart/', user='customer', setup=[ADD_TO_CART]),
+    Scenario('update_cart', '/update-cart/{product_id}/increase/', user='customer', method='POST',
+             setup=[ADD_TO_CART]),
+    Scenario('checkout_page', '/checkout/', user='customer', setup=[ADD_TO_CART]),
+    Scenario('checkout_submit', '/checkout/', user='customer', method='POST', data=CHECKOUT_FORM,
+             setup=[ADD_TO_CART]),
+    Scenario('admin_dashboard', '/dashboard/', user='staff'),
+]
+
+
+def select_scenarios(patterns=None):
+    """Scenarios whose name contains any of the given substrings (all of them by default)"""
+    if not patterns:
+        return list(SCENARIOS)
+    return [scenario for scenario in SCENARIOS if any(pattern in scenario.name for pattern in patterns)]
+
+
+def benchmark_context(sample_size=50):
+    """Values the scenarios rotate through, read from the bench data"""
+    from .models import Brand, Category, Product
+
+    products = list(
+        Product.objects.filter(slug__startswith='bench-').order_by('id').values_list('id', 'slug', 'name')[:sample_size]
+    )
+    if not products:
+        raise ValueError("No benchmark data; run `manage.py generate_bench_data` first")
+    return {
+        'rotate': {
+            'product_id': [pk for pk, _, _ in products],
+            'product_slug': [slug for _, slug, _ in products],
+            'term': sorted({name.split()[1] for _, _, name in products}),
+            'category_slug': list(Category.objects.filter(slug__startswith='bench-').values_list('slug', flat=True)),
+            'brand_slug': list(Brand.objects.filter(slug__startswith='bench-').values_list('slug', flat=True)),
+        },
+        'users': {'customer': 'bench_user_0', 'staff': BENCH_STAFF},
+        'password': BENCH_PASSWORD,
+    }
+
+
+def queries_from_header(value):
+    match = SERVER_TIMING_QUERIES.search(value or '')
+    return int(match.group(1)) if match else None
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(samples, elapsed):
+    """samples: list of (milliseconds, status, queries)"""
+    latencies = [ms for ms, _, _ in samples]
+    queries = [q for _, _, q in samples if q is not None]
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for _, status, _ in samples if status >= 400),
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else None,
+        'mean_ms': round(statistics.mean(latencies), 2),
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'max_ms': round(max(latencies), 2),
+        'queries_median': statistics.median(queries) if queries else None,
+        'queries_max': max(queries) if queries else None,
+    }
+
+
+class ClientDriver:
+    """In-process requests through Django's test client: no network or server overhead"""
+    name = 'client'
+
+    def __init__(self, iterations, warmup):
+        self.iterations = iterations
+        self.warmup = warmup
+
+    def run(self, scenario, context):
+        from django.contrib.auth import get_user_model
+        from django.test import Client
+        from django.test.utils import override_settings
+
+        client = Client()
+        if scenario.user:
+            client.force_login(get_user_model().objects.get(username=context['users'][scenario.user]))
+
+        def send(method, path, data):
+            return client.post(path, data) if method == 'POST' else client.get(path)
+
+        samples, elapsed = [], 0.0
+        with override_settings(REQUEST_METRICS_SERVER_TIMING=True, ALLOWED_HOSTS=['*']):
+            for iteration in range(self.warmup + self.iterations):
+                setup, timed = scenario.requests(context, iteration)
+                for spec in setup:
+                    send(*spec)
+                started = time.perf_counter()
+                response = send(*timed)
+                duration = time.perf_counter() - started
+                if iteration >= self.warmup:
+                    elapsed += duration
+                    samples.append((duration * 1000, response.status_code,
+                                    queries_from_header(response.headers.get('Server-Timing'))))
+        return summarize(samples, elapsed)
+
+
+def http_session(base_url, context, user=None):
+    """A requests session with the CSRF cookie set, logged in as context['users'][user] if given"""
+    import requests
+
+    session = requests.Session()
+    session.get(f'{base_url}/login/')
+    if user:
+        session.post(f'{base_url}/login/', allow_redirects=False, data={
+            'username': context['users'][user], 'password': context['password'],
+        }, headers={'X-CSRFToken': session.cookies.get('csrftoken', ''), 'Referer': f'{base_url}/login/'})
+    return session
+
+
+def http_worker(base_url, scenario, context, first, count):
+    """One load-generator process: its own session (and login), iterations first..first+count"""
+    session = http_session(base_url, context, scenario.user)
+
+    def send(method, path, data):
+        if method == 'POST':
+            headers = {'X-CSRFToken': session.cookies.get('csrftoken', ''), 'Referer': f'{base_url}{path}'}
+            return session.post(f'{base_url}{path}', data=data, headers=headers, allow_redirects=False)
+        return session.get(f'{base_url}{path}', allow_redirects=False)
+
+    samples = []
+    for iteration in range(first, first + count):
+        setup, timed = scenario.requests(context, iteration)
+        for spec in setup:
+            send(*spec)
+        started = time.perf_counter()
+        response = send(*timed)
+        samples.append(((time.perf_counter() - started) * 1000, response.status_code,
+                        queries_from_header(response.headers.get('Server-Timing'))))
+    return samples
+
+
+class HttpDriver:
+    """
+    Concurrent load against a running server, one process per worker.
+    Query counts are only reported when the server sends Server-Timing
+    (REQUEST_METRICS_SERVER_TIMING, on with DEBUG). Throughput is timed
+    requests per second of wall time, setup requests included.
+    """
+    name = 'http'
+
+    def __init__(self, base_url, iterations, warmup, workers):
+        self.base_url = base_url.rstrip('/')
+        self.iterations = iterations
+        self.warmup = warmup
+        self.workers = workers
+
+    def run(self, scenario, context):
+        # The first `extra` workers take one more iteration each, so exactly `iterations` run
+        share, extra = divmod(self.iterations, self.workers)
+        counts = [share + (worker < extra) for worker in range(self.workers)]
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            if self.warmup:
+                pool.submit(http_worker, self.base_url, scenario, context, 0, self.warmup).result()
+            started = time.perf_counter()
+            futures = [
+                pool.submit(http_worker, self.base_url, scenario, context, self.warmup + sum(counts[:worker]), count)
+                for worker, count in enumerate(counts) if count
+            ]
+            samples = [sample for future in futures for sample in future.result()]
+            elapsed = time.perf_counter() - started
+        return summarize(samples, elapsed)
+
+
+class KeepAliveConnection:
+    """Minimal HTTP/1.1 GET client on asyncio streams, reconnecting when the server closes"""
+
+    def __init__(self, base_url, cookies=''):
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.cookies = cookies
+        self.reader = self.writer = None
+
+    async def get(self, path):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(
+            f'GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nCookie: {self.cookies}\r\n\r\n'.encode()
+        )
+        await self.writer.drain()
+        status = int((await self.reader.readuntil(b'\r\n')).split()[1])
+        headers = {}
+        while (line := await self.reader.readuntil(b'\r\n')) != b'\r\n':
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, queries_from_header(headers.get('server-timing'))
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+async def run_concurrency(base_url, path, concurrency, duration, cookies='', timeout=10.0):
+    """`concurrency` connections requesting `path` back to back for `duration` seconds"""
+    samples = []
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        connection = KeepAliveConnection(base_url, cookies)
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                status, queries = await asyncio.wait_for(connection.get(path), timeout)
+            except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                status, queries = 599, None  # refused, reset or timed out: the server is saturated
+                await connection.close()
+            samples.append(((time.perf_counter() - started) * 1000, status, queries))
+        await connection.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return summarize(samples, time.perf_counter() - started)
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing each scenario against the baseline, and the names that regressed"""
+    lines, regressions = [], []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            lines.append(f"{name}: new scenario")
+            continue
+        p95_change = (current['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] if previous['p95_ms'] else 0
+        queries_before, queries_now = previous.get('queries_max'), current.get('queries_max')
+        regressed = p95_change > tolerance or (
+            queries_before is not None and queries_now is not None and queries_now > queries_before
+        )
+        lines.append(
+            f"{name}: p95 {previous['p95_ms']} -> {current['p95_ms']}ms ({p95_change:+.0%}), "
+            f"queries {queries_before} -> {queries_now}{'  REGRESSION' if regressed else ''}"
+        )
+        if regressed:
+            regressions.append(name)
+    return lines, regressions
+
+
+def load_json(path):
+    with open(path, encoding='utf-8') as handle:
+        return json.load(handle)
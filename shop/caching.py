@@ -0,0 +1,202 @@
+"""
+Project cache layer on top of Django's cache framework.
+
+Keys are namespaced per model (or any other name) and carry the
+namespace's generation number, so invalidate(namespace) drops every key
+in it at once without having to know them:
+
+    shop:<namespace>:<generation>:<key>
+
+Generations live in the cache too, where they can be evicted like any
+other key. A lost counter restarts from the current time in microseconds
+rather than from 1, so it never comes back to a generation whose keys
+may still be cached.
+
+get_or_compute() protects hot keys against stampedes in two ways.
+- Each entry records how long it took to compute. Readers start
+  recomputing a little before expiry, with a probability that rises as
+  expiry approaches ("XFetch", probabilistic early expiration).
+- Only the reader holding a short cache lock does the work. Everyone
+  else keeps serving the current value, or waits briefly for the lock
+  holder when there is no value at all.
+
+aget_or_compute() is the same for async views, using the cache's async
+API and an async compute().
+
+Hit/miss counters are kept per process; see cache_stats().
+"""
+import asyncio
+import math
+import random
+import threading
+import time
+from collections import Counter
+
+from django.core.cache import cache
+
+DEFAULT_TIMEOUT = 300
+LOCK_TIMEOUT = 30
+LOCK_WAIT = 2.0
+LOCK_POLL_INTERVAL = 0.05
+EARLY_RECOMPUTE_BETA = 1.0
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def record(event):
+    with _stats_lock:
+        _stats[event] += 1
+
+
+def cache_stats():
+    """Per-process counters: hits, misses, early recomputes, lock waits and computes"""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats.get('hits', 0) + stats.get('misses', 0)
+    stats['hit_rate'] = round(stats.get('hits', 0) / lookups, 4) if lookups else None
+    return stats
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def namespace_name(namespace):
+    """Accept a model class/instance or a plain string"""
+    meta = getattr(namespace, '_meta', None)
+    return meta.label_lower if meta else str(namespace)
+
+
+def new_generation():
+    # Past every generation handed out before, unless one was invalidated more than once per microsecond
+    return time.time_ns() // 1000
+
+
+def generation(namespace):
+    key = f'shop:{namespace_name(namespace)}:generation'
+    value = cache.get(key)
+    if value is None:
+        start = new_generation()
+        cache.add(key, start, None)
+        value = cache.get(key, start)
+    return value
+
+
+def invalidate(namespace):
+    """Drop every key in a namespace by moving it to the next generation"""
+    key = f'shop:{namespace_name(namespace)}:generation'
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, new_generation(), None)
+
+
+def make_key(namespace, key):
+    name = namespace_name(namespace)
+    return f'shop:{name}:{generation(name)}:{key}'
+
+
+def should_recompute_early(delta, expires_at, beta=EARLY_RECOMPUTE_BETA):
+    # XFetch: now - delta * beta * ln(rand) >= expiry, with rand in (0, 1]
+    return time.time() - delta * beta * math.log(1.0 - random.random()) >= expires_at
+
+
+def compute_and_store(cache_key, compute, timeout):
+    started = time.time()
+    value = compute()
+    delta = time.time() - started
+    cache.set(cache_key, (value, delta, time.time() + timeout), timeout)
+    record('computes')
+    return value
+
+
+def get_or_compute(namespace, key, compute, timeout=DEFAULT_TIMEOUT):
+    """
+    Cached value of compute() under namespace/key, recomputed by a single
+    caller when it expires. compute() must return something picklable.
+    """
+    cache_key = make_key(namespace, key)
+    lock_key = f'{cache_key}:lock'
+    entry = cache.get(cache_key)
+
+    if entry is not None:
+        value, delta, expires_at = entry
+        record('hits')
+        if should_recompute_early(delta, expires_at) and cache.add(lock_key, 1, LOCK_TIMEOUT):
+            record('early_recomputes')
+            try:
+                return compute_and_store(cache_key, compute, timeout)
+            finally:
+                cache.delete(lock_key)
+        return value
+
+    record('misses')
+    if not cache.add(lock_key, 1, LOCK_TIMEOUT):
+        # Someone else is computing it: give them a moment before doing it ourselves
+        record('lock_waits')
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            entry = cache.get(cache_key)
+            if entry is not None:
+                return entry[0]
+        return compute_and_store(cache_key, compute, timeout)
+    try:
+        return compute_and_store(cache_key, compute, timeout)
+    finally:
+        cache.delete(lock_key)
+
+
+async def ageneration(namespace):
+    key = f'shop:{namespace_name(namespace)}:generation'
+    value = await cache.aget(key)
+    if value is None:
+        start = new_generation()
+        await cache.aadd(key, start, None)
+        value = await cache.aget(key, start)
+    return value
+
+
+async def acompute_and_store(cache_key, compute, timeout):
+    started = time.time()
+    value = await compute()
+    delta = time.time() - started
+    await cache.aset(cache_key, (value, delta, time.time() + timeout), timeout)
+    record('computes')
+    return value
+
+
+async def aget_or_compute(namespace, key, compute, timeout=DEFAULT_TIMEOUT):
+    """Async get_or_compute(): compute is a coroutine function"""
+    name = namespace_name(namespace)
+    cache_key = f'shop:{name}:{await ageneration(name)}:{key}'
+    lock_key = f'{cache_key}:lock'
+    entry = await cache.aget(cache_key)
+
+    if entry is not None:
+        value, delta, expires_at = entry
+        record('hits')
+        if should_recompute_early(delta, expires_at) and await cache.aadd(lock_key, 1, LOCK_TIMEOUT):
+            record('early_recomputes')
+            try:
+                return await acompute_and_store(cache_key, compute, timeout)
+            finally:
+                await cache.adelete(lock_key)
+        return value
+
+    record('misses')
+    if not await cache.aadd(lock_key, 1, LOCK_TIMEOUT):
+        record('lock_waits')
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+            entry = await cache.aget(cache_key)
+            if entry is not None:
+                return entry[0]
+        return await acompute_and_store(cache_key, compute, timeout)
+    try:
+        return await acompute_and_store(cache_key, compute, timeout)
+    finally:
+        await cache.adelete(lock_key)
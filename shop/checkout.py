@@ -0,0 +1,155 @@
+"""
+Pricing and placing orders, shared by the checkout page and the JSON API.
+
+    total, lines = order_lines(cart_items)
+    order_id, placed = place_order(CartItem.objects.filter(cart=cart), address, user_id=user.pk, token=token)
+
+place_order() locks and prices the cart items, writes the address, the order and its
+items, takes the stock and removes the ordered items from the cart in one transaction, then queues the
+post-checkout tasks once it has committed. A checkout token that was
+already used returns the order it placed instead (placed is False), but
+only to the same user or guest session; anyone else gets TokenInUse.
+"""
+import logging
+from decimal import Decimal
+
+from django.db import router, transaction
+from django.db.models import F
+from django.db.models.deletion import Collector
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import Address, CheckoutSubmission, Order, OrderItem, Product, ProductVariant
+from .tasks import enqueue, record_order_sales, send_order_confirmation
+
+logger = logging.getLogger(__name__)
+
+
+class TokenInUse(Exception):
+    """The checkout token was already used by another user or session"""
+
+
+class EmptyCart(Exception):
+    """No cart items were left to order (a concurrent checkout took them)"""
+
+
+def order_lines(cart_items):
+    """
+    (total, lines) for cart items with product and variant loaded. Each line
+    holds the list price and the price charged: the discount price if any,
+    plus the variant's additional price.
+    """
+    total = Decimal('0')
+    lines = []
+    for cart_item in cart_items:
+        product, variant = cart_item.product, cart_item.variant
+        price = original_price = product.price
+        if product.discount_price:
+            price = product.discount_price
+        if variant and variant.additional_price:
+            price += variant.additional_price
+            original_price += variant.additional_price
+        item_total = price * cart_item.quantity
+        total += item_total
+        logger.debug("Checkout item", extra={'checkout': {
+            'cart_item_id': cart_item.pk, 'product_id': cart_item.product_id,
+            'variant_id': cart_item.variant_id, 'quantity': cart_item.quantity,
+            'price': price, 'item_total': item_total,
+        }})
+        lines.append({
+            'product': product,
+            'variant': variant,
+            'quantity': cart_item.quantity,
+            'price': original_price,
+            'discounted_price': price,
+            'total': item_total,
+        })
+    return total, lines
+
+
+def delete_items(items, **parent):
+    """
+    Delete loaded cart or wishlist items in one statement. Their signals
+    read the cart or wishlist, so load it with the items (select_related)
+    or pass it in (cart=...); a queryset delete would fetch it once per row.
+    """
+    items = list(items)
+    if not items:
+        return
+    for item in items:
+        for name, value in parent.items():
+            setattr(item, name, value)
+    collector = Collector(using=router.db_for_write(type(items[0])))
+    collector.collect(items)
+    collector.delete()
+
+
+def place_order(cart_items, address, user_id=None, token=None, session_key=None):
+    """
+    Order the items of a CartItem queryset for delivery to `address`; an
+    unsaved address is replaced by an identical one the same owner already
+    has. The items are locked before they are priced, so a concurrent cart
+    change or checkout waits for this one, and only these items are taken
+    out of the cart. Raises EmptyCart if there are none.
+
+    Returns (order_id, True), or (the first order's id, False) for a token
+    this user (or, for a guest, `session_key`) already used. Raises
+    TokenInUse for a token someone else used.
+    """
+    with transaction.atomic():
+        submission = None
+        if token:
+            # Taken first: a concurrent duplicate waits here, then gets our order back
+            submission, created = CheckoutSubmission.claim(token, user_id=user_id, session_key=session_key)
+            if not created:
+                if submission is None:
+                    raise TokenInUse(token)
+                return submission.order_id, False
+
+        cart_items = list(cart_items.select_related('cart', 'product', 'variant').select_for_update(of=('self',)))
+        if not cart_items:
+            raise EmptyCart()
+        total, lines = order_lines(cart_items)
+
+        if address.pk is None:
+            # Reused through the (user, fingerprint) index
+            existing = Address.objects.filter(
+                user_id=address.user_id, fingerprint=address.compute_fingerprint()
+            ).first()
+            if existing:
+                address = existing
+            else:
+                address.save()
+
+        order = Order.objects.create(user_id=user_id, delivery_address=address, total=total, status='processing')
+        if submission:
+            CheckoutSubmission.objects.filter(pk=submission.pk).update(order=order)
+
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order, product=line['product'], variant=line['variant'], quantity=line['quantity'],
+                price=line['price'], discounted_price=line['discounted_price'],
+            )
+            for line in lines
+        ])
+
+        # Update stock in place, without reloading or re-saving the rows
+        for line in lines:
+            Product.objects.filter(pk=line['product'].pk).update(
+                stock=Greatest(F('stock') - line['quantity'], 0), updated_at=timezone.now()
+            )
+            if line['variant']:
+                ProductVariant.objects.filter(pk=line['variant'].pk).update(
+                    stock=Greatest(F('stock') - line['quantity'], 0)
+                )
+
+        delete_items(cart_items)
+
+        # Committed with the order, so a crash can't lose them
+        enqueue(record_order_sales, order_id=order.id)
+        enqueue(send_order_confirmation, order_id=order.id)
+
+    logger.info("Order placed", extra={'checkout': {
+        'order_id': order.id, 'user_id': user_id, 'items': len(lines), 'total': total,
+    }})
+    return order.id, True
@@ -0,0 +1,188 @@
+"""
+Database routers.
+
+ReplicaRouter sends reads of catalog models, and any read made inside
+replica_reads(), to the replica alias (settings.REPLICA_DATABASE, default
+'replica') when one is configured. Writes always go to 'default'.
+
+Read-your-writes: once a request writes, the rest of it reads from the
+primary. ReplicaPinningMiddleware also pins a client to the primary for
+REPLICA_PIN_SECONDS after any POST/PUT/PATCH/DELETE, so the cart, checkout
+or review page that follows sees the write. The pin lasts for the
+middleware's primary_pin() block only: a write outside a request (a task
+worker, a management command, the shell) pins nothing. Reads inside a
+transaction on the primary always stay there, so code that reads back its
+own writes does so in transaction.atomic() or primary_pin(True).
+
+The replica is only used while it's reachable and no more than
+REPLICA_MAX_LAG_SECONDS behind. The check runs at most once every
+REPLICA_CHECK_SECONDS per process; otherwise reads fall back to the primary.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+CATALOG_MODELS = {'category', 'tag', 'brand', 'product', 'productimage', 'productvariant', 'review'}
+PIN_COOKIE = 'primary_pin'
+UNSAFE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+# Postgres replication lag in seconds (0 when caught up or not a standby)
+REPLICATION_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+# None outside a primary_pin() block, i.e. outside a request
+_pinned = ContextVar('replica_pinned', default=None)
+_replica_reads = ContextVar('replica_reads', default=False)
+_health = {}
+_health_lock = threading.Lock()
+
+
+def replica_alias():
+    alias = getattr(settings, 'REPLICA_DATABASE', 'replica')
+    return alias if alias in settings.DATABASES else None
+
+
+def pin_to_primary():
+    """Pin the rest of the current primary_pin() block; outside one there is nothing to pin"""
+    if _pinned.get() is not None:
+        _pinned.set(True)
+
+
+def is_pinned():
+    return bool(_pinned.get())
+
+
+@contextmanager
+def primary_pin(pinned):
+    """Set the pin for the duration of a request, restoring the previous state afterwards"""
+    token = _pinned.set(pinned)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+@contextmanager
+def replica_reads():
+    """Route every read in this block (e.g. reporting queries) to the replica; also a decorator"""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def check_replica(alias):
+    try:
+        with connections[alias].cursor() as cursor:
+            if connections[alias].vendor != 'postgresql':
+                cursor.execute('SELECT 1')
+                return True
+            cursor.execute(REPLICATION_LAG_SQL)
+            lag = cursor.fetchone()[0]
+    except DatabaseError:
+        logger.warning("Replica %s is unavailable, reading from the primary", alias, exc_info=True)
+        connections[alias].close()
+        return False
+    max_lag = getattr(settings, 'REPLICA_MAX_LAG_SECONDS', 5)
+    if lag > max_lag:
+        logger.warning("Replica %s is %.1fs behind, reading from the primary", alias, lag)
+        return False
+    return True
+
+
+def replica_available(alias):
+    interval = getattr(settings, 'REPLICA_CHECK_SECONDS', 5)
+    now = time.monotonic()
+    with _health_lock:
+        checked_at, healthy = _health.get(alias, (None, False))
+        if checked_at is not None and now - checked_at < interval:
+            return healthy
+        # Claim this check so concurrent requests keep using the previous answer meanwhile
+        _health[alias] = (now, healthy if checked_at is not None else False)
+    healthy = check_replica(alias)
+    with _health_lock:
+        _health[alias] = (time.monotonic(), healthy)
+    return healthy
+
+
+def reset_replica_health():
+    with _health_lock:
+        _health.clear()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = replica_alias()
+        if alias is None or is_pinned() or connections['default'].in_atomic_block:
+            return None
+        is_catalog = model._meta.app_label == 'shop' and model._meta.model_name in CATALOG_MODELS
+        if (is_catalog or _replica_reads.get()) and replica_available(alias):
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Reads after a write in the same request must see it
+        pin_to_primary()
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica mirrors the primary, so objects from either may be related
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+class ReplicaPinningMiddleware:
+    """Pin a client's reads to the primary for a short window after it writes"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if replica_alias() is None:
+            return self.get_response(request)
+
+        writes = request.method in UNSAFE_METHODS
+        with primary_pin(writes or PIN_COOKIE in request.COOKIES):
+            response = self.get_response(request)
+        return self.set_pin_cookie(response, writes)
+
+    async def __acall__(self, request):
+        if replica_alias() is None:
+            return await self.get_response(request)
+
+        writes = request.method in UNSAFE_METHODS
+        with primary_pin(writes or PIN_COOKIE in request.COOKIES):
+            response = await self.get_response(request)
+        return self.set_pin_cookie(response, writes)
+
+    def set_pin_cookie(self, response, writes):
+        if writes:
+            response.set_cookie(
+                PIN_COOKIE, '1',
+                max_age=getattr(settings, 'REPLICA_PIN_SECONDS', 10),
+                httponly=True, samesite='Lax',
+            )
+        return response
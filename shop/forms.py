@@ -114,3 +114,10 @@ class AddressForm(forms.ModelForm):
     class Meta:
         model = Address
         fields = ['street', 'city', 'state', 'postal_code', 'country', 'is_default']
+
+class ProductImportForm(forms.Form):
+    FORMAT_CHOICES = [('', 'Detect from file name'), ('csv', 'CSV'), ('jsonl', 'JSON Lines')]
+
+    feed = forms.FileField(help_text="CSV or JSONL product feed")
+    format = forms.ChoiceField(choices=FORMAT_CHOICES, required=False)
+    download_images = forms.BooleanField(required=False, initial=True)
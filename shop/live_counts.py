@@ -0,0 +1,92 @@
+"""
+Change notifications for the header's cart and wishlist counts.
+
+Cart and wishlist mutations publish to a per-visitor channel (the user,
+or the session for guests). The header_counts_stream view subscribes
+and re-reads the counts only when told something changed, pushing them
+to the browser as Server-Sent Events instead of being polled.
+
+The hub is in-process: a change made by another worker process isn't
+seen until the stream's periodic recheck (LIVE_COUNTS_RECHECK_SECONDS).
+A broker such as Redis pub/sub can replace it behind publish() and
+subscribe() when that delay matters.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.db import transaction
+
+
+def counts_channel(user_id=None, session_key=None):
+    if user_id:
+        return f'user:{user_id}'
+    if session_key:
+        return f'session:{session_key}'
+    return None
+
+
+class Subscription:
+    """An event that's set whenever its channel is published to; waiting clears it"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    async def wait(self, timeout):
+        """True if notified within timeout seconds"""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.event.clear()
+        return True
+
+
+class Hub:
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscription = Subscription(channel)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def publish(self, channel):
+        """Wake the channel's subscribers; safe to call from any thread"""
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.event.set)
+            except RuntimeError:
+                # Its event loop has shut down; the stream is gone
+                self.unsubscribe(subscription)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+
+hub = Hub()
+
+
+def publish_counts_changed(user_id=None, session_key=None):
+    """
+    Notify the visitor's streams once the current transaction (if any) has
+    committed. Sync code only; async views call hub.publish() directly.
+    """
+    channel = counts_channel(user_id, session_key)
+    if channel is not None:
+        transaction.on_commit(lambda: hub.publish(channel))
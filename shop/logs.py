@@ -0,0 +1,122 @@
+"""
+Structured, non-blocking logging.
+
+BackgroundHandler is a QueueHandler: the request thread only puts the
+record on an in-memory queue, and a QueueListener thread formats it as
+one JSON object per line and writes it out. A slow or blocked stderr/file
+therefore never holds up a request. The listener starts on first use and
+is flushed at exit. A forked child (e.g. a gunicorn worker) gets a queue
+and listener of its own on its first record; the parent's listener thread
+doesn't exist in the child, and their queue isn't shared.
+
+JsonFormatter includes anything passed as extra={...}, e.g. the
+'metrics' dict from shop.metrics or 'checkout' from the checkout view.
+
+SampleFilter keeps only a fraction of DEBUG records, for high-volume
+events such as per-item checkout lines.
+
+The handler, levels and sample rate are wired up in settings.LOGGING.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import weakref
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# Attributes every LogRecord has; anything else came from extra={...}
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+_background_handlers = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    for handler in list(_background_handlers):
+        handler.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """Let through `rate` (0..1) of the records below INFO; everything else passes"""
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.INFO or random.random() < self.rate
+
+
+class BackgroundHandler(QueueHandler):
+    def __init__(self, stream='stderr', filename=None):
+        super().__init__(queue.SimpleQueue())
+        self.target = logging.FileHandler(filename, encoding='utf-8') if filename else logging.StreamHandler(
+            getattr(sys, stream)
+        )
+        self.target.setFormatter(JsonFormatter())
+        self.listener = None
+        self._start_lock = threading.Lock()
+        self._stop_at_exit = False
+        _background_handlers.add(self)
+
+    def prepare(self, record):
+        # Render the message and traceback now, while the arguments are still current;
+        # extra={...} values stay on the copy for the formatter
+        prepared = logging.makeLogRecord(vars(record))
+        prepared.message = record.getMessage()
+        prepared.msg, prepared.args = prepared.message, None
+        if record.exc_info:
+            prepared.exc_text = JsonFormatter().formatException(record.exc_info)
+        prepared.exc_info = None
+        return prepared
+
+    def emit(self, record):
+        if self.listener is None:
+            self.start()
+        super().emit(record)
+
+    def start(self):
+        with self._start_lock:
+            if self.listener is not None:
+                return
+            self.listener = QueueListener(self.queue, self.target)
+            self.listener.start()
+            if not self._stop_at_exit:
+                self._stop_at_exit = True
+                atexit.register(self.flush_and_stop)
+
+    def reset_after_fork(self):
+        """In a forked child: drop the parent's queue and listener; the next record starts new ones"""
+        self.queue = queue.SimpleQueue()
+        self.listener = None
+        # Another thread may have held it at the fork
+        self._start_lock = threading.Lock()
+
+    def flush_and_stop(self):
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
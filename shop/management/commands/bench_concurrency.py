@@ -0,0 +1,59 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.benchmarks import benchmark_context, http_session, run_concurrency
+
+
+def target_argument(value):
+    label, _, url = value.partition('=')
+    if not url:
+        raise ValueError(value)
+    return label, url.rstrip('/')
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare running deployments (e.g. gunicorn/WSGI and uvicorn/ASGI) on one endpoint "
+        "at increasing numbers of concurrent connections"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', type=target_argument, action='append', required=True,
+                            help="label=base URL, e.g. wsgi=http://127.0.0.1:8000 (repeatable)")
+        parser.add_argument('--path', default='/api/header-counts/')
+        parser.add_argument('--concurrency', default='10,50,100,200',
+                            help="Comma-separated numbers of concurrent connections")
+        parser.add_argument('--duration', type=float, default=10, help="Seconds per level")
+        parser.add_argument('--user', choices=['customer', 'staff'],
+                            help="Log in as this generate_bench_data user first")
+        parser.add_argument('--output', help="Write the results JSON here (default: stdout)")
+
+    def handle(self, *args, **options):
+        levels = [int(level) for level in options['concurrency'].split(',')]
+        context = benchmark_context() if options['user'] else None
+        results = {'path': options['path'], 'duration': options['duration'], 'targets': {}}
+
+        for label, base_url in options['target']:
+            try:
+                session = http_session(base_url, context, options['user'])
+            except OSError as e:
+                raise CommandError(f"{label}: {base_url} is not reachable ({e})")
+            cookies = '; '.join(f'{name}={value}' for name, value in session.cookies.items())
+            results['targets'][label] = {'base_url': base_url, 'levels': {}}
+            for level in levels:
+                stats = asyncio.run(run_concurrency(base_url, options['path'], level, options['duration'], cookies))
+                results['targets'][label]['levels'][level] = stats
+                self.stderr.write(
+                    f"{label:8} {level:5} connections  {stats['throughput_rps']:8.1f} req/s  "
+                    f"p50 {stats['p50_ms']:8.2f}ms  p99 {stats['p99_ms']:8.2f}ms  "
+                    f"errors {stats['errors']}/{stats['requests']}"
+                )
+
+        report = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                output.write(report + '\n')
+        else:
+            self.stdout.write(report)
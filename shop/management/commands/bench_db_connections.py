@@ -0,0 +1,70 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.core.signals import request_finished, request_started
+from django.db import connections
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure per-request database connection cost: a fresh connection for every request "
+        "versus the configured settings (CONN_MAX_AGE / health checks / pool)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Simulated requests per worker")
+        parser.add_argument('--workers', type=int, default=4, help="Concurrent worker threads")
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        alias = options['database']
+        settings_dict = connections[alias].settings_dict
+        self.stdout.write(
+            f"{alias}: CONN_MAX_AGE={settings_dict['CONN_MAX_AGE']} "
+            f"CONN_HEALTH_CHECKS={settings_dict['CONN_HEALTH_CHECKS']} "
+            f"pool={'pool' in settings_dict['OPTIONS']}"
+        )
+        self.report('new connection per request', self.run(self.fresh_connection_request, alias, options))
+        self.report('configured settings', self.run(self.configured_request, alias, options))
+
+    def run(self, request, alias, options):
+        def worker(_):
+            samples = []
+            for _ in range(options['requests']):
+                started = time.perf_counter()
+                request(alias)
+                samples.append((time.perf_counter() - started) * 1000)
+            connections[alias].close()
+            return samples
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            return [sample for samples in executor.map(worker, range(options['workers'])) for sample in samples]
+
+    def fresh_connection_request(self, alias):
+        # What every request paid before: TCP + auth handshake, one query, disconnect
+        wrapper = connections[alias]
+        connection = wrapper.get_new_connection(wrapper.get_connection_params())
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        connection.close()
+
+    def configured_request(self, alias):
+        # Same request lifecycle Django runs, so CONN_MAX_AGE/health checks/pool apply
+        request_started.send(sender=self.__class__)
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT 1')
+        request_finished.send(sender=self.__class__)
+
+    def report(self, label, samples):
+        self.stdout.write(
+            f"{label}: {len(samples)} requests, mean {statistics.mean(samples):.2f}ms, "
+            f"p50 {percentile(samples, 0.5):.2f}ms, p95 {percentile(samples, 0.95):.2f}ms, "
+            f"p99 {percentile(samples, 0.99):.2f}ms"
+        )
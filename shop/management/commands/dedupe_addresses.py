@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from shop.models import Address, Order
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfill Address.fingerprint in batches, then merge addresses with the same user and fingerprint "
+        "into the default (or oldest) one, repointing their orders"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help="Report what would change without writing")
+
+    def handle(self, *args, **options):
+        batch_size, dry_run = options['batch_size'], options['dry_run']
+        # A dry run writes no fingerprints, so it groups the computed ones in memory
+        computed = {} if dry_run else None
+        backfilled = self.backfill(batch_size, computed)
+        groups, removed, repointed = self.plan_merge(computed) if dry_run else self.merge()
+        verb = "Would merge" if dry_run else "Merged"
+        self.stdout.write(self.style.SUCCESS(
+            f"Fingerprinted {backfilled} addresses. {verb} {groups} groups of duplicates: "
+            f"{removed} addresses removed, {repointed} orders repointed"
+        ))
+
+    def backfill(self, batch_size, computed=None):
+        """
+        Recompute every fingerprint (so canonicalization changes are picked up
+        too), one id range at a time. With `computed`, write nothing and
+        collect {(user_id, fingerprint): [(is_default, id), ...]} there instead.
+        """
+        changed, last_id = 0, 0
+        fields = ('id', 'fingerprint', 'user_id', 'is_default', *Address.FINGERPRINT_FIELDS)
+        while True:
+            batch = list(Address.objects.filter(id__gt=last_id).order_by('id').only(*fields)[:batch_size])
+            if not batch:
+                return changed
+            last_id = batch[-1].id
+            stale = []
+            for address in batch:
+                fingerprint = address.compute_fingerprint()
+                if address.fingerprint != fingerprint:
+                    address.fingerprint = fingerprint
+                    stale.append(address)
+                if computed is not None:
+                    computed.setdefault((address.user_id, fingerprint), []).append((address.is_default, address.id))
+            if stale and computed is None:
+                Address.objects.bulk_update(stale, ['fingerprint'])
+            changed += len(stale)
+
+    def plan_merge(self, computed):
+        """What merge() would do with the fingerprints backfill() computed"""
+        groups = removed = repointed = 0
+        for addresses in computed.values():
+            if len(addresses) < 2:
+                continue
+            # Same order as merge(): the default, else the oldest, is kept
+            duplicates = [address_id for _, address_id in sorted(addresses, key=lambda a: (not a[0], a[1]))[1:]]
+            repointed += Order.objects.filter(delivery_address_id__in=duplicates).count()
+            groups += 1
+            removed += len(duplicates)
+        return groups, removed, repointed
+
+    def merge(self):
+        groups = removed = repointed = 0
+        duplicated = (
+            Address.objects.exclude(fingerprint='')
+            .values('user_id', 'fingerprint')
+            .annotate(n=Count('id'))
+            .filter(n__gt=1)
+            .order_by()
+        )
+        for group in list(duplicated):
+            with transaction.atomic():
+                ids = list(
+                    Address.objects.select_for_update()
+                    .filter(user_id=group['user_id'], fingerprint=group['fingerprint'])
+                    .order_by('-is_default', 'id')
+                    .values_list('id', flat=True)
+                )
+                keep, duplicates = ids[0], ids[1:]
+                repointed += Order.objects.filter(delivery_address_id__in=duplicates).update(delivery_address_id=keep)
+                Address.objects.filter(id__in=duplicates).delete()
+            groups += 1
+            removed += len(duplicates)
+        return groups, removed, repointed
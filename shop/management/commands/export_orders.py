@@ -0,0 +1,50 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.order_export import EXPORT_FORMATS, export_lines, export_rows, parse_export_date
+
+
+class Command(BaseCommand):
+    help = "Stream order lines joined with their order and address as CSV or JSONL"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--output', help="File to write to (default: stdout)")
+        parser.add_argument('--start', help="First order date (YYYY-MM-DD)")
+        parser.add_argument('--end', help="Last order date (YYYY-MM-DD)")
+        parser.add_argument('--status', help="Only orders with this status")
+        parser.add_argument('--since-id', type=int, default=0,
+                            help="Only orders after this id (the last id of a previous export)")
+
+    def handle(self, *args, **options):
+        try:
+            rows = export_rows(
+                start=parse_export_date(options['start']),
+                end=parse_export_date(options['end']),
+                status=options['status'],
+                since_id=options['since_id'],
+            )
+        except ValueError as e:
+            raise CommandError(e)
+
+        last_order_id = options['since_id']
+        count = 0
+
+        def tracked(rows):
+            nonlocal last_order_id, count
+            for row in rows:
+                last_order_id = row[0]
+                count += 1
+                yield row
+
+        output = open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] else sys.stdout
+        try:
+            for line in export_lines(tracked(rows), options['format']):
+                output.write(line)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        # Resume point for the next incremental run
+        self.stderr.write(f"Exported {count} lines; last order id {last_order_id} (use --since-id {last_order_id})")
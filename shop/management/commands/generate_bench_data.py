@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.bench_data import DEFAULT_COUNTS, bench_users, flush, generate
+
+
+class Command(BaseCommand):
+    help = "Fill the database with deterministic benchmark data (everything prefixed 'bench')"
+
+    def add_arguments(self, parser):
+        for name, default in DEFAULT_COUNTS.items():
+            parser.add_argument(f'--{name}', type=int, default=default)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--flush', action='store_true', help="Remove existing benchmark data first")
+
+    def handle(self, *args, **options):
+        if options['flush']:
+            flush()
+            self.stdout.write("Removed existing benchmark data")
+        elif bench_users().exists():
+            raise CommandError("Benchmark data already exists; pass --flush to regenerate it")
+
+        generate({name: options[name] for name in DEFAULT_COUNTS}, seed=options['seed'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS("Benchmark data generated"))
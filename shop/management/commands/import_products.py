@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.product_import import ProductImporter, detect_format
+
+
+class Command(BaseCommand):
+    help = "Import or sync products from a CSV or JSONL feed (upserts on slug)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Path to the feed file")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Feed format (default: from file extension)")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--image-workers', type=int, default=4)
+        parser.add_argument('--no-images', action='store_true', help="Skip downloading image_urls")
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or detect_format(options['path'])
+        importer = ProductImporter(
+            batch_size=options['batch_size'],
+            image_workers=options['image_workers'],
+            download_images=not options['no_images'],
+            progress=lambda stats: self.stdout.write(
+                f"{stats.rows} rows ({stats.rows_per_second:.0f} rows/s)"
+            ),
+        )
+        try:
+            with open(options['path'], encoding='utf-8', newline='') as stream:
+                stats = importer.run(stream, fmt)
+        except OSError as e:
+            raise CommandError(e)
+
+        for error in stats.errors:
+            self.stderr.write(error)
+        self.stdout.write(self.style.SUCCESS(f"Imported {stats}"))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from shop.models import Product
+
+
+class Command(BaseCommand):
+    help = "Recompute Product.wishlist_count from wishlist items, one id range at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = Product.objects.aggregate(last=Max('id'))['last'] or 0
+        fixed = 0
+        for start_id in range(1, last_id + 1, batch_size):
+            # Each batch is its own short UPDATE, so live counter updates aren't blocked for long
+            fixed += Product.reconcile_wishlist_counts(start_id, start_id + batch_size)
+        self.stdout.write(self.style.SUCCESS(f"Reconciled wishlist counts for {last_id} ids; fixed {fixed} products"))
@@ -0,0 +1,89 @@
+import json
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from shop.benchmarks import ClientDriver, HttpDriver, benchmark_context, compare, load_json, select_scenarios
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the storefront hot paths against the generate_bench_data rows and report "
+        "latency percentiles, throughput and query counts as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--driver', choices=['client', 'http'], default='client',
+                            help="In-process test client, or concurrent HTTP load against --base-url")
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+        parser.add_argument('--workers', type=int, default=4, help="Load generator processes (http driver)")
+        parser.add_argument('--iterations', type=int, default=50, help="Timed requests per scenario")
+        parser.add_argument('--warmup', type=int, default=5, help="Untimed requests per scenario first")
+        parser.add_argument('--scenario', action='append', help="Only scenarios whose name contains this")
+        parser.add_argument('--output', help="Write the results JSON here (default: stdout)")
+        parser.add_argument('--baseline', help="Results JSON of an earlier run to compare against")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Allowed p95 slowdown against the baseline (0.2 = 20%%)")
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        scenarios = select_scenarios(options['scenario'])
+        if not scenarios:
+            raise CommandError("No scenario matches --scenario")
+        try:
+            context = benchmark_context()
+        except ValueError as e:
+            raise CommandError(e)
+
+        if options['driver'] == 'http':
+            driver = HttpDriver(options['base_url'], options['iterations'], options['warmup'], options['workers'])
+        else:
+            driver = ClientDriver(options['iterations'], options['warmup'])
+
+        results = {
+            'meta': {
+                'driver': driver.name,
+                'iterations': options['iterations'],
+                'warmup': options['warmup'],
+                'workers': options['workers'] if driver.name == 'http' else 1,
+                'revision': git_revision(),
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'started_at': datetime.now(timezone.utc).isoformat(),
+            },
+            'scenarios': {},
+        }
+        for scenario in scenarios:
+            stats = driver.run(scenario, context)
+            results['scenarios'][scenario.name] = stats
+            self.stderr.write(
+                f"{scenario.name:28} p50 {stats['p50_ms']:8.2f}ms  p95 {stats['p95_ms']:8.2f}ms  "
+                f"p99 {stats['p99_ms']:8.2f}ms  {stats['throughput_rps']:8.1f} req/s  "
+                f"queries {stats['queries_max']}  errors {stats['errors']}"
+            )
+
+        report = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                output.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+        if options['baseline']:
+            lines, regressions = compare(results, load_json(options['baseline']), options['tolerance'])
+            for line in lines:
+                self.stderr.write(line)
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f"Regressed against the baseline: {', '.join(regressions)}")
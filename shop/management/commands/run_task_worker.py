@@ -0,0 +1,52 @@
+import multiprocessing
+import os
+import signal
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from shop.tasks import Worker
+
+
+def work(options):
+    Worker(options['batch_size'], options['poll_interval'], options['burst']).run()
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Run background task workers (see shop.tasks); SIGTERM stops them after their current task"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=10, help="Tasks claimed per poll")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument('--burst', action='store_true', help="Exit once no tasks are due")
+
+    def handle(self, *args, **options):
+        processes = max(options['processes'], 1)
+        if processes == 1:
+            work(options)
+            return
+
+        # Children mustn't share the parent's database sockets
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        children = [context.Process(target=work, args=(options,), daemon=True) for _ in range(processes)]
+        for child in children:
+            child.start()
+        self.stdout.write(f"Started {processes} task workers: {', '.join(str(c.pid) for c in children)}")
+
+        def forward(signum, frame):
+            for child in children:
+                if child.is_alive():
+                    os.kill(child.pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        for child in children:
+            child.join()
+        failed = [child.pid for child in children if child.exitcode]
+        if failed:
+            self.stderr.write(f"Workers exited with errors: {failed}")
+        else:
+            self.stdout.write(self.style.SUCCESS("Task workers stopped"))
@@ -0,0 +1,204 @@
+"""
+Per-request instrumentation.
+
+RequestMetricsMiddleware records, for each request, the resolved URL
+name, the SQL query count and DB time, template render time and wall time,
+and flags duplicate queries (the same SQL run REQUEST_METRICS_DUPLICATE_THRESHOLD
+or more times, the usual N+1 signature). Every request is logged to the
+"shop.metrics" logger with the numbers in extra={'metrics': ...}; with
+REQUEST_METRICS_SERVER_TIMING on, they are also sent as a Server-Timing
+header for the browser's network panel. A streaming response is measured
+once its content has been consumed, and gets no Server-Timing header.
+
+Template time is measured by the TimedDjangoTemplates backend, which
+settings.TEMPLATES uses in place of Django's own; importing this module
+patches nothing.
+
+QUERY_BUDGETS maps URL names, or (URL name, HTTP method) pairs for views
+whose methods cost differently, to the most queries a request may run; a
+pair takes precedence over the bare name. Going over logs a warning, or raises QueryBudgetExceeded when
+QUERY_BUDGET_STRICT is set (on under `manage.py test`), which fails the
+test that made the request.
+"""
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+from django.conf import settings
+from django.db import connections
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template as DjangoTemplate, reraise
+
+logger = logging.getLogger('shop.metrics')
+
+_template_time = ContextVar('template_time', default=None)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class TimedTemplate(DjangoTemplate):
+    # Backend-level render only: {% include %} renders inside it and isn't counted twice
+    def render(self, context=None, request=None):
+        elapsed = _template_time.get()
+        if elapsed is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            elapsed[0] += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, with render time added to the current request's metrics"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class QueryRecorder:
+    """Execute wrapper collecting the SQL and time of every query on a connection"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            self.statements[sql] += 1
+
+    def duplicates(self, threshold):
+        return [(sql, count) for sql, count in self.statements.most_common() if count >= threshold]
+
+
+@contextmanager
+def recording_queries(recorder):
+    """
+    Run recorder as an execute wrapper on this thread's connections for the
+    block. Connections are per thread and the async ORM queries from a
+    worker thread, so this has to be entered where the queries run.
+    """
+    with ExitStack() as stack:
+        for connection in connections.all(initialized_only=False):
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield
+
+
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        recorder, template_time = QueryRecorder(), [0.0]
+        token = _template_time.set(template_time)
+        started = time.perf_counter()
+        try:
+            with recording_queries(recorder):
+                response = self.get_response(request)
+        finally:
+            _template_time.reset(token)
+        return self.finish(request, response, recorder, template_time[0], started)
+
+    async def __acall__(self, request):
+        recorder, template_time = QueryRecorder(), [0.0]
+        token = _template_time.set(template_time)
+        started = time.perf_counter()
+        # Entered and left in the thread the request's sync_to_async calls (the ORM's included) run in
+        recording = recording_queries(recorder)
+        await sync_to_async(recording.__enter__)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(recording.__exit__)(None, None, None)
+            _template_time.reset(token)
+        return self.finish(request, response, recorder, template_time[0], started)
+
+    def finish(self, request, response, recorder, template_time, started):
+        if not response.streaming:
+            self.report(request, response, recorder, template_time, time.perf_counter() - started)
+            return response
+        # A streaming view queries as its content is consumed, after get_response has returned,
+        # so the request is measured (and held to its budget) once the stream is exhausted
+        content = response.streaming_content
+        if response.is_async:
+            async def stream():
+                recording = recording_queries(recorder)
+                await sync_to_async(recording.__enter__)()
+                try:
+                    async for part in content:
+                        yield part
+                finally:
+                    await sync_to_async(recording.__exit__)(None, None, None)
+                self.report(request, response, recorder, template_time, time.perf_counter() - started)
+        else:
+            def stream():
+                with recording_queries(recorder):
+                    yield from content
+                self.report(request, response, recorder, template_time, time.perf_counter() - started)
+        response.streaming_content = stream()
+        return response
+
+    def report(self, request, response, recorder, template_time, wall_time):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else None
+        metrics = {
+            'view': view,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': recorder.count,
+            'db_ms': round(recorder.duration * 1000, 2),
+            'template_ms': round(template_time * 1000, 2),
+            'wall_ms': round(wall_time * 1000, 2),
+        }
+        duplicates = recorder.duplicates(getattr(settings, 'REQUEST_METRICS_DUPLICATE_THRESHOLD', 3))
+        if duplicates:
+            metrics['duplicate_queries'] = [{'sql': sql[:300], 'count': count} for sql, count in duplicates[:5]]
+            logger.warning("Repeated queries in %s: %s", view, duplicates[0][0][:300],
+                           extra={'metrics': metrics})
+        logger.info("%s %s %s", request.method, view, response.status_code, extra={'metrics': metrics})
+
+        # A streamed response's headers are sent before its numbers are known
+        if getattr(settings, 'REQUEST_METRICS_SERVER_TIMING', False) and not response.streaming:
+            response['Server-Timing'] = (
+                f'db;dur={metrics["db_ms"]};desc="{recorder.count} queries", '
+                f'tpl;dur={metrics["template_ms"]}, total;dur={metrics["wall_ms"]}'
+            )
+
+        self.check_budget(view, metrics)
+
+    def check_budget(self, view, metrics):
+        budgets = getattr(settings, 'QUERY_BUDGETS', {})
+        budget = budgets.get((view, metrics['method']), budgets.get(view))
+        if budget is None or metrics['queries'] <= budget:
+            return
+        message = f"{view} {metrics['method']} ran {metrics['queries']} queries (budget {budget})"
+        if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message, extra={'metrics': metrics})
@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-19 18:42
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.text
+import shop.models
+from django.conf import settings
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_order_status_event'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(shop.models.PhoneDigits('phone'), name='shop_address_phone_digits_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(django.db.models.functions.text.Lower('email'), name='shop_address_email_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('full_name'), name='gin_trgm_ops'), name='shop_address_name_trgm_idx'),
+        ),
+    ]
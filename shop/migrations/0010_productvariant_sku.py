@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-19 18:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_order_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productvariant',
+            name='sku',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+    ]
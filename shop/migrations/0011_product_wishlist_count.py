@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-19 18:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_productvariant_sku'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='wishlist_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        # Backfill; `manage.py reconcile_wishlist_counts` recomputes in batches later
+        migrations.RunSQL(
+            """
+            UPDATE shop_product SET wishlist_count = counts.total
+            FROM (SELECT product_id, COUNT(*) AS total FROM shop_wishlistitem GROUP BY product_id) AS counts
+            WHERE shop_product.id = counts.product_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-wishlist_count', 'id'], name='shop_product_wishlisted_idx'),
+        ),
+    ]
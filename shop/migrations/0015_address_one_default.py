@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-19 19:29
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0014_address_fingerprint'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Users left with several defaults by the old clear-then-save keep their newest one
+        migrations.RunSQL(
+            """
+            UPDATE shop_address SET is_default = false
+            WHERE is_default AND user_id IS NOT NULL AND id NOT IN (
+                SELECT MAX(id) FROM shop_address WHERE is_default AND user_id IS NOT NULL GROUP BY user_id
+            )
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='address',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_default', True)), fields=('user',), name='shop_address_one_default'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2 on 2026-10-19 20:45
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0017_checkoutsubmission_owner'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # The staff order search matches users with username__icontains and email__iexact, which
+        # compare UPPER(column); auth_user isn't ours to add Meta.indexes to, so they're created here
+        migrations.RunSQL(
+            'CREATE INDEX shop_user_username_trgm_idx ON auth_user USING gin (UPPER("username") gin_trgm_ops)',
+            'DROP INDEX shop_user_username_trgm_idx',
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX shop_user_email_upper_idx ON auth_user (UPPER("email"))',
+            'DROP INDEX shop_user_email_upper_idx',
+        ),
+    ]
@@ -5,13 +5,31 @@ from django.contrib.auth.models import User
 from datetime import timedelta
 from django.utils import timezone
 from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+import hashlib
+import re
 import uuid
-from django.db.models import Count, Q, F, ExpressionWrapper, IntegerField, Avg
+from django.db.models import Case, Count, Q, F, ExpressionWrapper, IntegerField, Avg, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest, Lower, Upper
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.core.exceptions import ValidationError
 from decimal import Decimal
+from .caching import get_or_compute, invalidate
+from .slugs import UniqueSlugMixin
 
 User = settings.AUTH_USER_MODEL 
 
+DEFAULT_ADDRESS_CACHE_TIMEOUT = 60 * 60
+SET_DEFAULT_ATTEMPTS = 5
+SET_DEFAULT_LOCK = 4817  # advisory lock class id for Address.set_default
+BULK_STATUS_MAX_ORDERS = 1000
+
+class PhoneDigits(models.Func):
+    """Phone number reduced to its digits; the same expression backs the Address phone index"""
+    function = 'REGEXP_REPLACE'
+    template = "%(function)s(%(expressions)s, '[^0-9]', '', 'g')"
+    output_field = models.CharField()
+
 class Address(models.Model):
     full_name = models.CharField(max_length=255)
     email = models.EmailField()
@@ -25,12 +43,93 @@ class Address(models.Model):
     slug = models.SlugField(unique=True, blank=True)
     is_default = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Hash of the canonicalized fields below; equal for addresses that differ only in case,
+    # spacing or phone punctuation (see make_fingerprint)
+    fingerprint = models.CharField(max_length=64, blank=True, editable=False)
+
+    FINGERPRINT_FIELDS = ('full_name', 'email', 'phone', 'street', 'city', 'state', 'postal_code', 'country')
+
+    class Meta:
+        indexes = [
+            # Staff order search: normalized phone/email lookups and name substring matches
+            models.Index(PhoneDigits('phone'), name='shop_address_phone_digits_idx'),
+            models.Index(Lower('email'), name='shop_address_email_lower_idx'),
+            GinIndex(OpClass(Upper('full_name'), name='gin_trgm_ops'), name='shop_address_name_trgm_idx'),
+            # Checkout and manage_address reuse an existing address with one probe
+            models.Index(fields=['user', 'fingerprint'], name='shop_address_fingerprint_idx'),
+        ]
+        constraints = [
+            # At most one default per user; also the index the default lookup uses
+            models.UniqueConstraint(fields=['user'], condition=Q(is_default=True), name='shop_address_one_default'),
+        ]
+
+    @classmethod
+    def make_fingerprint(cls, **values):
+        parts = []
+        for field in cls.FINGERPRINT_FIELDS:
+            value = ' '.join(str(values.get(field) or '').split()).casefold()
+            if field == 'phone':
+                value = re.sub(r'[^0-9]', '', value)
+            parts.append(value)
+        return hashlib.sha256('\x1f'.join(parts).encode()).hexdigest()
+
+    def compute_fingerprint(self):
+        return self.make_fingerprint(**{field: getattr(self, field) for field in self.FINGERPRINT_FIELDS})
+
+    @staticmethod
+    def default_cache_namespace(user_id):
+        return f'default-address:{user_id}'
+
+    @classmethod
+    def default_id_for(cls, user_id):
+        """The user's default address id (or None); cached until one of their addresses changes"""
+        return get_or_compute(cls.default_cache_namespace(user_id), 'id', lambda: (
+            cls.objects.filter(user_id=user_id, is_default=True).values_list('id', flat=True).first()
+        ), DEFAULT_ADDRESS_CACHE_TIMEOUT)
+
+    @classmethod
+    def set_default(cls, user_id, address_id):
+        """
+        Make one of the user's addresses their default in a single statement;
+        False if it isn't theirs. The old default is cleared in a CTE that
+        runs first, so the one-default index never sees two at once.
+
+        Two concurrent swaps can't both succeed: the loser hits the index.
+        Its retries first take a per-user advisory lock, so contending swaps
+        then queue up instead of colliding again.
+        """
+        table = connection.ops.quote_name(cls._meta.db_table)
+        sql = (
+            f'WITH cleared AS ('
+            f'UPDATE {table} SET "is_default" = false WHERE "user_id" = %s AND "is_default" AND "id" <> %s '
+            f'AND EXISTS (SELECT 1 FROM {table} WHERE "id" = %s AND "user_id" = %s) RETURNING "id") '
+            f'UPDATE {table} SET "is_default" = true WHERE "id" = %s AND "user_id" = %s '
+            f'AND (SELECT COUNT(*) FROM cleared) >= 0'
+        )
+        params = [user_id, address_id, address_id, user_id, address_id, user_id]
+        for attempt in range(SET_DEFAULT_ATTEMPTS):
+            try:
+                with transaction.atomic(), connection.cursor() as cursor:
+                    if attempt:
+                        cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [SET_DEFAULT_LOCK, user_id])
+                    cursor.execute(sql, params)
+                    updated = cursor.rowcount
+                break
+            except IntegrityError:
+                if attempt == SET_DEFAULT_ATTEMPTS - 1:
+                    raise
+        invalidate(cls.default_cache_namespace(user_id))
+        return bool(updated)
 
     def save(self, *args, **kwargs):
         if not self.slug:
             base_slug = slugify(f"{self.full_name}-{self.street}")
             unique_suffix = uuid.uuid4().hex[:8]
             self.slug = f"{base_slug}-{unique_suffix}"
+        self.fingerprint = self.compute_fingerprint()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and set(update_fields) & set(self.FINGERPRINT_FIELDS):
+            kwargs['update_fields'] = {*update_fields, 'fingerprint'}
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -45,6 +144,17 @@ class Order(models.Model):
         ('cancelled', 'Cancelled')
     ]
 
+    # Statuses an order may move to from its current status. Staff could always move an order
+    # anywhere (a delivered order is cancelled when it comes back); narrow an entry to refuse a move
+    # in the bulk, single-order and cancel endpoints alike
+    STATUS_TRANSITIONS = {
+        'processing': {'shipped', 'out_for_delivery', 'delivered', 'cancelled'},
+        'shipped': {'processing', 'out_for_delivery', 'delivered', 'cancelled'},
+        'out_for_delivery': {'processing', 'shipped', 'delivered', 'cancelled'},
+        'delivered': {'processing', 'shipped', 'out_for_delivery', 'cancelled'},
+        'cancelled': {'processing', 'shipped', 'out_for_delivery', 'delivered'},
+    }
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -68,9 +178,15 @@ class Order(models.Model):
         default='processing'
     )
 
+    class Meta:
+        indexes = [
+            # Backs the per-user order history/profile listings and status filters
+            models.Index(fields=['user', 'status', 'created_at'], name='shop_order_user_status_idx'),
+        ]
+
     def __str__(self):
         return f"Order #{self.id} - {self.get_status_display()}"
-    
+
     # NO custom save() method!
     
     def calculate_total(self):
@@ -95,15 +211,245 @@ class Order(models.Model):
                     total += item.discounted_price * item.quantity
                 else:
                     total += item.price * item.quantity
-        return total  
+        return total
 
-    
+    @classmethod
+    def can_transition(cls, from_status, to_status):
+        return to_status in cls.STATUS_TRANSITIONS.get(from_status, set())
+
+    @classmethod
+    def transition_results(cls, order_ids, new_status, found):
+        """Per-order outcome of a transition_status() call that returned `found`"""
+        results = {}
+        for order_id in order_ids:
+            if order_id not in found:
+                results[order_id] = 'not_found'
+            elif found[order_id] == new_status:
+                results[order_id] = 'unchanged'
+            elif cls.can_transition(found[order_id], new_status):
+                results[order_id] = 'updated'
+            else:
+                results[order_id] = 'invalid_transition'
+        return results
+
+    @classmethod
+    def transition_status(cls, order_ids, new_status, changed_by=None):
+        """
+        Move a set of orders to new_status with a single UPDATE and record an
+        OrderStatusEvent for every order that actually changed. Orders whose
+        current status can't move to new_status are left untouched.
+        Returns {order_id: previous_status} for every order that was found.
+        """
+        if new_status not in dict(cls.STATUS_CHOICES):
+            raise ValueError(f"Invalid order status: {new_status}")
+
+        changed_by_id = getattr(changed_by, 'pk', changed_by)
+        with transaction.atomic():
+            rows = list(
+                cls.objects.select_for_update()
+                .filter(id__in=set(order_ids))
+                .values_list('id', 'user_id', 'status')
+            )
+            changed = [
+                (order_id, user_id, status) for order_id, user_id, status in rows
+                if cls.can_transition(status, new_status)
+            ]
+            if changed:
+                cls.objects.filter(id__in=[row[0] for row in changed]).update(
+                    status=new_status,
+                    updated_at=timezone.now(),
+                )
+                OrderStatusEvent.objects.bulk_create([
+                    OrderStatusEvent(
+                        order_id=order_id,
+                        from_status=status,
+                        to_status=new_status,
+                        changed_by_id=changed_by_id,
+                    )
+                    for order_id, _, status in changed
+                ])
+
+                # Queryset updates skip the Order signals, keep the summaries in step here
+                deltas = {}
+                for _, user_id, status in changed:
+                    if user_id:
+                        user_deltas = deltas.setdefault(user_id, {})
+                        user_deltas[status] = user_deltas.get(status, 0) - 1
+                        user_deltas[new_status] = user_deltas.get(new_status, 0) + 1
+                for user_id, status_counts in deltas.items():
+                    OrderSummary.apply_delta(user_id, status_counts=status_counts)
+
+        return {order_id: status for order_id, _, status in rows}
+
+
+class OrderStatusEvent(models.Model):
+    """Append-only log of order status changes, read back as the tracking timeline"""
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='status_events')
+    from_status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES, blank=True)
+    to_status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    changed_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [
+            models.Index(fields=['order', 'created_at'], name='shop_status_event_order_idx'),
+        ]
+
+    def __str__(self):
+        return f"Order #{self.order_id}: {self.from_status or '-'} -> {self.to_status}"
+
+
+class OrderSummary(models.Model):
+    """
+    Per-user order rollup (count, total spent, counts by status).
+    Kept up to date incrementally from the Order signals so the profile and
+    order history pages don't have to aggregate over every order.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='order_summary')
+    order_count = models.PositiveIntegerField(default=0)
+    total_spent = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0'))
+    processing_count = models.PositiveIntegerField(default=0)
+    shipped_count = models.PositiveIntegerField(default=0)
+    out_for_delivery_count = models.PositiveIntegerField(default=0)
+    delivered_count = models.PositiveIntegerField(default=0)
+    cancelled_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
 
-class Category(models.Model):
+    class Meta:
+        verbose_name_plural = 'Order summaries'
+
+    def __str__(self):
+        return f"Order summary for user #{self.user_id}"
+
+    @staticmethod
+    def status_field(status):
+        return f"{status}_count"
+
+    @property
+    def active_count(self):
+        """Orders that are neither delivered nor cancelled"""
+        return self.order_count - self.delivered_count - self.cancelled_count
+
+    def count_for(self, status_filter):
+        """Number of orders matching an order history status filter"""
+        if status_filter == 'all':
+            return self.order_count
+        if status_filter == 'active':
+            return self.active_count
+        if status_filter in dict(Order.STATUS_CHOICES):
+            return getattr(self, self.status_field(status_filter))
+        return None
+
+    @classmethod
+    def rebuild(cls, user_id):
+        """Recompute the summary for a user from the orders table"""
+        orders = Order.objects.filter(user_id=user_id)
+        defaults = orders.aggregate(
+            order_count=Count('id'),
+            total_spent=models.Sum('total'),
+        )
+        defaults['total_spent'] = defaults['total_spent'] or Decimal('0')
+        by_status = dict(orders.order_by().values_list('status').annotate(n=Count('id')))
+        for status, _ in Order.STATUS_CHOICES:
+            defaults[cls.status_field(status)] = by_status.get(status, 0)
+        summary, _ = cls.objects.update_or_create(user_id=user_id, defaults=defaults)
+        return summary
+
+    @classmethod
+    def for_user(cls, user):
+        """Fetch the summary for a user, building it on first access"""
+        summary = cls.objects.filter(user=user).first()
+        if summary is None:
+            summary = cls.rebuild(user.pk)
+        return summary
+
+    @classmethod
+    def apply_delta(cls, user_id, count=0, total=Decimal('0'), status_counts=None, rebuild_missing=True):
+        """
+        Apply an incremental change with a single UPDATE. If the row doesn't
+        exist yet it is rebuilt from the orders table, which already reflects
+        the change being applied.
+        """
+        changes = {}
+        if count:
+            changes['order_count'] = F('order_count') + count
+        if total:
+            changes['total_spent'] = F('total_spent') + total
+        for status, delta in (status_counts or {}).items():
+            if delta:
+                field = cls.status_field(status)
+                changes[field] = F(field) + delta
+        if not changes:
+            return
+        changes['updated_at'] = timezone.now()
+        if not cls.objects.filter(user_id=user_id).update(**changes) and rebuild_missing:
+            cls.rebuild(user_id)
+
+
+class CheckoutSubmission(models.Model):
+    """
+    The token rendered into each checkout form. Recording it in the same
+    transaction as the order means a double-submitted or retried form gets
+    the original order back instead of placing a second one. The token is
+    only honoured for whoever used it first (the user, or the guest's
+    session), so holding someone else's token doesn't reveal their order.
+    """
+    token = models.UUIDField(unique=True)
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    session_key = models.CharField(max_length=40, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Checkout {self.token} -> order #{self.order_id}"
+
+    @staticmethod
+    def owned_by(user_id=None, session_key=None):
+        """Filter for the submissions of a user, or else of a guest session (never of a guest without one)"""
+        if user_id:
+            return Q(user_id=user_id)
+        if session_key:
+            return Q(user__isnull=True, session_key=session_key)
+        return Q(pk__in=[])
+
+    @classmethod
+    def claim(cls, token, user_id=None, session_key=None):
+        """
+        Record the token for this owner, or fetch the owner's submission that
+        already has it: returns (submission, created), with submission None
+        when the token belongs to someone else. INSERT ... ON CONFLICT DO
+        NOTHING is a single statement; a concurrent claim of the same token
+        waits for the first transaction to finish and then comes back empty,
+        so only one request ever goes on to place the order.
+        """
+        session_key = '' if user_id else session_key or ''
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} ("token", "user_id", "session_key", "created_at") VALUES (%s, %s, %s, %s) '
+                f'ON CONFLICT ("token") DO NOTHING RETURNING "id"',
+                [token, user_id, session_key, timezone.now()],
+            )
+            row = cursor.fetchone()
+        if row:
+            return cls(pk=row[0], token=token, user_id=user_id, session_key=session_key), True
+        return cls.objects.filter(cls.owned_by(user_id, session_key), token=token).first(), False
+
+
+
+class Category(UniqueSlugMixin, models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(unique=True, blank=True)  # Made blank=True to allow manual entry
     description = models.TextField(blank=True)
     image = models.ImageField(upload_to='categories/', blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         verbose_name_plural = 'Categories'
@@ -112,46 +458,32 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
-    def save(self, *args, **kwargs):
-        if not self.slug:  # Only generate slug if not manually provided
-            self.slug = slugify(self.name)
-        super().save(*args, **kwargs)
-
-class Tag(models.Model):
+class Tag(UniqueSlugMixin, models.Model):
     name = models.CharField(max_length=50)
     slug = models.SlugField(unique=True, blank=True)  # Made blank=True to allow manual entry
 
     def __str__(self):
         return self.name
 
-    def save(self, *args, **kwargs):
-        if not self.slug:  # Only generate slug if not manually provided
-            self.slug = slugify(self.name)
-        super().save(*args, **kwargs)
-
-class Brand(models.Model):
+class Brand(UniqueSlugMixin, models.Model):
     name = models.CharField(max_length=100, unique=True)
     slug = models.SlugField(unique=True, blank=True)
     description = models.TextField(blank=True, null=True)
     logo = models.ImageField(upload_to='brands/', blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
-
-    def save(self, *args, **kwargs):
-        if not self.slug:
-            self.slug = slugify(self.name)
-        super().save(*args, **kwargs)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
 
-class Product(models.Model):
+class Product(UniqueSlugMixin, models.Model):
     name = models.CharField(max_length=200)
     slug = models.SlugField(unique=True, blank=True)  # Allow manual entry if needed
     description = models.TextField()
     price = models.DecimalField(
         max_digits=10, 
         decimal_places=2,
-        validators=[MinValueValidator(0)]
+        validators=[MinValueValidator(Decimal(0))]
     )
     discount_price = models.DecimalField(
         max_digits=10,
@@ -171,23 +503,30 @@ class Product(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     featured = models.BooleanField(default=False)
+    # sold and last_sold are updated by the record_order_sales task, so only while run_task_worker is running
     sold = models.PositiveIntegerField(default=0)
     weight = models.CharField(max_length=20, blank=True)
     views = models.PositiveIntegerField(default=0)
     view_count = models.PositiveIntegerField(default=0)
     last_sold = models.DateTimeField(null=True, blank=True)
+    # Number of wishlists holding this product; kept up to date by the WishlistItem signals
+    wishlist_count = models.PositiveIntegerField(default=0)
+
+    # What the cached home rails and autocomplete read; saving other fields keeps the cache
+    CACHED_FIELDS = ('name', 'slug', 'price', 'discount_price', 'sold', 'wishlist_count', 'created_at')
+    # Invalidated when orders add to `sold`, which they do without saving the product
+    SALES_CACHE_NAMESPACE = 'product-sales'
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # "Popular" rail: most-wishlisted first
+            models.Index(fields=['-wishlist_count', 'id'], name='shop_product_wishlisted_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
-    def save(self, *args, **kwargs):
-        if not self.slug:  # Auto-generate slug if not provided
-            self.slug = slugify(self.name)
-        super().save(*args, **kwargs)
-
     @property
     def average_rating(self):
         avg = self.reviews.aggregate(avg_rating=Avg('rating'))['avg_rating']
@@ -197,6 +536,38 @@ class Product(models.Model):
     def review_count(self):
         return self.reviews.count()
 
+    @classmethod
+    def touch(cls, product_ids):
+        """Bump updated_at (which the API's ETags are built from) after changes made around save()"""
+        cls.objects.filter(pk__in=product_ids).update(updated_at=timezone.now())
+
+    @classmethod
+    def adjust_wishlist_count(cls, product_id, delta):
+        cls.objects.filter(pk=product_id).update(
+            wishlist_count=Greatest(F('wishlist_count') + delta, 0)
+        )
+
+    @classmethod
+    def adjust_wishlist_counts(cls, deltas):
+        """adjust_wishlist_count() for many products in one UPDATE; deltas maps product id to change"""
+        deltas = {product_id: delta for product_id, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        change = Case(*(When(pk=product_id, then=Value(delta)) for product_id, delta in deltas.items()),
+                      output_field=IntegerField())
+        cls.objects.filter(pk__in=deltas).update(wishlist_count=Greatest(F('wishlist_count') + change, 0))
+
+    @classmethod
+    def reconcile_wishlist_counts(cls, start_id, end_id):
+        """Recompute wishlist_count for products with start_id <= id < end_id; returns rows fixed"""
+        actual = Coalesce(Subquery(
+            WishlistItem.objects.filter(product_id=OuterRef('pk')).order_by()
+            .values('product_id').annotate(total=Count('id')).values('total')
+        ), 0)
+        return cls.objects.filter(pk__gte=start_id, pk__lt=end_id).annotate(actual=actual).exclude(
+            wishlist_count=F('actual')
+        ).update(wishlist_count=actual)
+
     @classmethod
     def get_trending_products(cls):
         thirty_days_ago = timezone.now() - timedelta(days=30)
@@ -259,6 +630,8 @@ class ProductVariant(models.Model):
     You can add attributes such as wattage, color, shape, size, etc.
     """
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='variants')
+    # Supplier SKU; feed imports upsert variants on it
+    sku = models.CharField(max_length=64, unique=True, blank=True, null=True)
     wattage = models.PositiveIntegerField(blank=True, null=True)
     color = models.CharField(max_length=50, blank=True, null=True)
     shape = models.CharField(max_length=50, blank=True, null=True)
@@ -403,3 +776,43 @@ class CartItem(models.Model):
 
     def __str__(self):
         return f"{self.quantity} x {self.product.name}"
+
+
+class Task(models.Model):
+    """
+    A unit of background work, queued in the database (see shop.tasks).
+    Finished tasks are deleted; failed ones stay for inspection and retry.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (FAILED, 'Failed'),
+    )
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    # When a queued task becomes due; for a running one, when its lease runs out
+    run_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['run_at', 'id']
+        indexes = [
+            # The workers' claim query; failed tasks are left out of the index
+            models.Index(
+                fields=['run_at', 'id'],
+                name='shop_task_due_idx',
+                condition=Q(status__in=['queued', 'running']),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
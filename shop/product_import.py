@@ -0,0 +1,446 @@
+"""
+Streaming product feed import (CSV or JSONL).
+
+Rows flow through a generator pipeline:
+
+    read_rows -> parse_rows -> batched -> ProductImporter.import_batch
+
+so memory stays proportional to the batch size rather than the feed size.
+Products are upserted on slug and variants on sku with
+bulk_create(update_conflicts=True); categories, brands and tags are resolved
+through in-memory caches; image downloads run on a thread pool while the
+next batches are being written.
+
+Feed columns (JSONL uses the same keys):
+    name, slug, description, price, discount_price, stock, available,
+    featured, weight, category, brand, tags, image_urls, variants
+
+In CSV, tags and image_urls are separated by "|" and variants is a JSON
+list of {sku, wattage, color, shape, size, additional_price, stock}.
+"""
+import csv
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from urllib.parse import urlparse
+
+import requests
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .caching import invalidate
+from .models import Brand, Category, Product, ProductImage, ProductVariant, Tag
+from .slugs import slug_base
+
+PRODUCT_UPDATE_FIELDS = [
+    'name', 'description', 'price', 'discount_price', 'category', 'brand',
+    'stock', 'available', 'featured', 'weight', 'updated_at',
+]
+VARIANT_UPDATE_FIELDS = ['product', 'wattage', 'color', 'shape', 'size', 'additional_price', 'stock']
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 'on'}
+MAX_REPORTED_ERRORS = 100
+IMAGE_DOWNLOAD_TIMEOUT = 20
+SLUG_LENGTH = Product._meta.get_field('slug').max_length
+
+
+class FeedError(ValueError):
+    """A feed row that can't be imported"""
+
+
+def detect_format(path):
+    return 'jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson', '.json') else 'csv'
+
+
+def read_rows(stream, fmt):
+    """Yield (line_number, raw_row) pairs from a text stream without loading it whole"""
+    if fmt == 'csv':
+        for line_number, row in enumerate(csv.DictReader(stream), start=2):
+            yield line_number, row
+    else:
+        for line_number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if line:
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError as e:
+                    yield line_number, FeedError(f"Invalid JSON: {e}")
+
+
+def split_list(value):
+    if value in (None, ''):
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(item).strip() for item in value if str(item).strip()]
+    return [item.strip() for item in str(value).split('|') if item.strip()]
+
+
+def check_column(value, label, model, name):
+    """Reject a value the column can't store (too long, too many digits, out of range)"""
+    try:
+        model._meta.get_field(name).run_validators(value)
+    except ValidationError as e:
+        raise FeedError(f"{label}: {' '.join(e.messages)}")
+    return value
+
+
+def parse_text(value, field, model=None, name=None):
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        raise FeedError(f"{field} is not text: {value!r}")
+    if model:
+        check_column(value.strip(), field, model, name)
+    return value
+
+
+def parse_decimal(value, field, model, name, required=False):
+    if value in (None, ''):
+        if required:
+            raise FeedError(f"{field} is required")
+        return None
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation:
+        raise FeedError(f"{field} is not a number: {value!r}")
+    if not number.is_finite():
+        raise FeedError(f"{field} is not a number: {value!r}")
+    if number < 0:
+        raise FeedError(f"{field} is negative: {value!r}")
+    return check_column(number, field, model, name)
+
+
+def parse_int(value, field, model, name, default=0):
+    if value in (None, ''):
+        return default
+    try:
+        number = max(int(value), 0)
+    except (TypeError, ValueError):
+        raise FeedError(f"{field} is not an integer: {value!r}")
+    return check_column(number, field, model, name)
+
+
+def parse_bool(value, default):
+    if value in (None, ''):
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in TRUE_VALUES
+
+
+def parse_variants(value):
+    if value in (None, ''):
+        return []
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise FeedError("variants is not valid JSON")
+    if not isinstance(value, list) or not all(isinstance(variant, dict) for variant in value):
+        raise FeedError("variants is not a list of objects")
+    variants = []
+    for variant in value:
+        sku = str(variant.get('sku') or '').strip()
+        if not sku:
+            raise FeedError("every variant needs a sku")
+        check_column(sku, 'variant sku', ProductVariant, 'sku')
+        for name in ('color', 'shape', 'size'):
+            if variant.get(name):
+                check_column(str(variant[name]), f'variant {name}', ProductVariant, name)
+        variants.append({
+            'sku': sku,
+            'wattage': parse_int(variant.get('wattage'), 'variant wattage', ProductVariant, 'wattage', default=None),
+            'color': variant.get('color') or None,
+            'shape': variant.get('shape') or None,
+            'size': variant.get('size') or None,
+            'additional_price': parse_decimal(
+                variant.get('additional_price'), 'variant additional_price', ProductVariant, 'additional_price'
+            ),
+            'stock': parse_int(variant.get('stock'), 'variant stock', ProductVariant, 'stock'),
+        })
+    return variants
+
+
+def parse_row(raw):
+    """Normalize one raw feed row into the fields the importer writes"""
+    if isinstance(raw, Exception):
+        raise raw
+    if not isinstance(raw, dict):
+        raise FeedError(f"row is not an object: {raw!r}")
+    name = parse_text(raw.get('name'), 'name', Product, 'name').strip()
+    if not name:
+        raise FeedError("name is required")
+    slug = slug_key(parse_text(raw.get('slug'), 'slug') or name)
+    if not slug:
+        raise FeedError("could not build a slug from the name")
+    category = parse_text(raw.get('category'), 'category', Category, 'name').strip()
+    if not slug_key(category):
+        raise FeedError("category is required")
+    # None means "column absent": leave existing tags alone
+    tags = split_list(raw['tags']) if 'tags' in raw else None
+    for tag in tags or []:
+        check_column(tag, 'tag', Tag, 'name')
+    return {
+        'slug': slug,
+        'name': name,
+        'description': parse_text(raw.get('description'), 'description'),
+        'price': parse_decimal(raw.get('price'), 'price', Product, 'price', required=True),
+        'discount_price': parse_decimal(raw.get('discount_price'), 'discount_price', Product, 'discount_price'),
+        'stock': parse_int(raw.get('stock'), 'stock', Product, 'stock'),
+        'available': parse_bool(raw.get('available'), True),
+        'featured': parse_bool(raw.get('featured'), False),
+        'weight': check_column(str(raw.get('weight') or ''), 'weight', Product, 'weight'),
+        'category': category,
+        'brand': parse_text(raw.get('brand'), 'brand', Brand, 'name').strip(),
+        'tags': tags,
+        'image_urls': split_list(raw.get('image_urls')),
+        'variants': parse_variants(raw.get('variants')),
+    }
+
+
+def parse_rows(rows, stats):
+    """Parse raw rows, recording and skipping the ones that fail"""
+    for line_number, raw in rows:
+        stats.rows += 1
+        try:
+            row = parse_row(raw)
+        except FeedError as e:
+            stats.add_error(line_number, e)
+        else:
+            row['line'] = line_number
+            yield row
+
+
+def slug_key(name):
+    # Feed names map to taxonomy slugs deterministically, so re-imports find the same rows
+    return slug_base(name, SLUG_LENGTH, fallback='')
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def download_image(url):
+    response = requests.get(url, timeout=IMAGE_DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+
+class ImportStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.rows = 0
+        self.products = 0
+        self.variants = 0
+        self.images = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, line_number, error):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"line {line_number}: {error}")
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.rows} rows, {self.products} products, {self.variants} variants, "
+            f"{self.images} images, {self.error_count} errors in {self.elapsed:.1f}s "
+            f"({self.rows_per_second:.0f} rows/s)"
+        )
+
+
+class ProductImporter:
+    def __init__(self, batch_size=500, image_workers=4, download_images=True, progress=None):
+        self.batch_size = batch_size
+        self.image_workers = image_workers
+        self.download_images = download_images and image_workers > 0
+        self.progress = progress
+        # slug -> id caches, filled lazily as the feed references them
+        self.categories = {}
+        self.brands = {}
+        self.tags = {}
+        self.stats = ImportStats()
+        self.pending_images = {}
+
+    def run(self, stream, fmt):
+        executor = ThreadPoolExecutor(max_workers=self.image_workers) if self.download_images else None
+        try:
+            for batch in batched(parse_rows(read_rows(stream, fmt), self.stats), self.batch_size):
+                try:
+                    with transaction.atomic():
+                        image_jobs = self.import_batch(batch)
+                except DatabaseError as e:
+                    # Whatever the rows checks missed: skip the batch, keep going
+                    self.forget_taxonomy()
+                    self.stats.add_error(f"{batch[0]['line']}-{batch[-1]['line']}", f"batch not imported: {e}")
+                    image_jobs = []
+                if executor:
+                    for job in image_jobs:
+                        self.queue_image(executor, *job)
+                if self.progress:
+                    self.progress(self.stats)
+            if executor:
+                self.collect_images(wait_for=None)
+        finally:
+            if executor:
+                executor.shutdown(wait=True)
+            # Bulk writes skip the model signals that normally clear these
+            for model in (Product, Category, Brand, Tag):
+                invalidate(model)
+        return self.stats
+
+    # --- Taxonomy resolution ---
+
+    def forget_taxonomy(self):
+        # Ids cached by a batch that rolled back may not exist
+        self.categories.clear()
+        self.brands.clear()
+        self.tags.clear()
+
+    def resolve_categories(self, names):
+        missing = {slug_key(name): name for name in names if slug_key(name) not in self.categories}
+        if missing:
+            existing = dict(Category.objects.filter(slug__in=missing).values_list('slug', 'id'))
+            new = [Category(name=name, slug=slug) for slug, name in missing.items() if slug not in existing]
+            if new:
+                Category.objects.bulk_create(new, ignore_conflicts=True)
+                existing = dict(Category.objects.filter(slug__in=missing).values_list('slug', 'id'))
+            self.categories.update(existing)
+
+    def resolve_brands(self, names):
+        missing = {slug_key(name): name for name in names if slug_key(name) not in self.brands}
+        if missing:
+            lookup = Q(slug__in=missing) | Q(name__in=missing.values())
+            existing = {slug_key(name): pk for name, pk in Brand.objects.filter(lookup).values_list('name', 'id')}
+            existing.update(Brand.objects.filter(slug__in=missing).values_list('slug', 'id'))
+            new = [Brand(name=name, slug=slug) for slug, name in missing.items() if slug not in existing]
+            if new:
+                Brand.objects.bulk_create(new, ignore_conflicts=True)
+                existing.update(Brand.objects.filter(slug__in=[brand.slug for brand in new]).values_list('slug', 'id'))
+            self.brands.update(existing)
+
+    def resolve_tags(self, names):
+        missing = {slug_key(name): name for name in names if slug_key(name) not in self.tags}
+        if missing:
+            existing = dict(Tag.objects.filter(slug__in=missing).values_list('slug', 'id'))
+            new = [Tag(name=name, slug=slug) for slug, name in missing.items() if slug not in existing]
+            if new:
+                Tag.objects.bulk_create(new, ignore_conflicts=True)
+                existing = dict(Tag.objects.filter(slug__in=missing).values_list('slug', 'id'))
+            self.tags.update(existing)
+
+    # --- Batch writes ---
+
+    def import_batch(self, rows):
+        """Upsert one batch; returns (product_id, name, urls) image jobs for products without images"""
+        # Last row wins when a slug repeats inside a batch
+        rows = list({row['slug']: row for row in rows}.values())
+        self.resolve_categories({row['category'] for row in rows})
+        self.resolve_brands({row['brand'] for row in rows if row['brand']})
+        self.resolve_tags({tag for row in rows for tag in row['tags'] or []})
+
+        now = timezone.now()
+        products = [
+            Product(
+                slug=row['slug'],
+                name=row['name'],
+                description=row['description'],
+                price=row['price'],
+                discount_price=row['discount_price'],
+                category_id=self.categories[slug_key(row['category'])],
+                brand_id=self.brands[slug_key(row['brand'])] if row['brand'] else None,
+                stock=row['stock'],
+                available=row['available'],
+                featured=row['featured'],
+                weight=row['weight'],
+                updated_at=now,
+            )
+            for row in rows
+        ]
+
+        with transaction.atomic():
+            Product.objects.bulk_create(
+                products,
+                update_conflicts=True,
+                unique_fields=['slug'],
+                update_fields=PRODUCT_UPDATE_FIELDS,
+            )
+            product_ids = {product.slug: product.pk for product in products}
+
+            variants = {
+                variant['sku']: ProductVariant(product_id=product_ids[row['slug']], **variant)
+                for row in rows for variant in row['variants']
+            }
+            if variants:
+                ProductVariant.objects.bulk_create(
+                    variants.values(),
+                    update_conflicts=True,
+                    unique_fields=['sku'],
+                    update_fields=VARIANT_UPDATE_FIELDS,
+                )
+
+            tagged = [row for row in rows if row['tags'] is not None]
+            if tagged:
+                ProductTag = Product.tags.through
+                ProductTag.objects.filter(product_id__in=[product_ids[row['slug']] for row in tagged]).delete()
+                ProductTag.objects.bulk_create([
+                    ProductTag(product_id=product_ids[row['slug']], tag_id=self.tags[slug_key(tag)])
+                    for row in tagged for tag in row['tags']
+                ], ignore_conflicts=True)
+
+        self.stats.products += len(products)
+        self.stats.variants += len(variants)
+
+        with_urls = {product_ids[row['slug']]: row for row in rows if row['image_urls']}
+        if not self.download_images or not with_urls:
+            return []
+        has_images = set(
+            ProductImage.objects.filter(product_id__in=with_urls).values_list('product_id', flat=True).distinct()
+        )
+        return [
+            (product_id, row['name'], row['image_urls'])
+            for product_id, row in with_urls.items()
+            if product_id not in has_images
+        ]
+
+    # --- Deferred images ---
+
+    def queue_image(self, executor, product_id, name, urls):
+        for position, url in enumerate(urls):
+            # Keep a bounded number of downloads in flight so memory stays flat
+            if len(self.pending_images) >= self.image_workers * 4:
+                self.collect_images(wait_for=FIRST_COMPLETED)
+            future = executor.submit(download_image, url)
+            self.pending_images[future] = (product_id, name, url, position)
+
+    def collect_images(self, wait_for):
+        """Save finished downloads; wait_for=None drains everything"""
+        if not self.pending_images:
+            return
+        done, _ = wait(self.pending_images, return_when=wait_for or 'ALL_COMPLETED')
+        for future in done:
+            product_id, name, url, position = self.pending_images.pop(future)
+            try:
+                content = future.result()
+            except requests.RequestException as e:
+                self.stats.add_error(url, f"image download failed: {e}")
+                continue
+            filename = os.path.basename(urlparse(url).path) or f"{slug_key(name)}-{position}.jpg"
+            image = ProductImage(product_id=product_id, alt_text=name[:200], is_main=position == 0)
+            image.image.save(filename, ContentFile(content), save=True)
+            self.stats.images += 1
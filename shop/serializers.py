@@ -0,0 +1,128 @@
+"""
+Serializers for the JSON API (see shop.api).
+
+SparseFieldsetSerializer takes fields=[...] and drops every other field,
+so a ?fields= request only serializes (and, through the view's field
+plans, only loads) what was asked for. The cart, wishlist, checkout and
+staff endpoints only validate input here; their responses are built by hand.
+"""
+from rest_framework import serializers
+
+from .models import BULK_STATUS_MAX_ORDERS, Address, Brand, Category, Order, Product, ProductImage, ProductVariant, Tag
+
+
+class SparseFieldsetSerializer(serializers.ModelSerializer):
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class CategorySerializer(SparseFieldsetSerializer):
+    class Meta:
+        model = Category
+        fields = ['id', 'name', 'slug', 'description', 'image', 'updated_at']
+
+
+class BrandSerializer(SparseFieldsetSerializer):
+    class Meta:
+        model = Brand
+        fields = ['id', 'name', 'slug', 'description', 'logo', 'updated_at']
+
+
+class CategorySummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Category
+        fields = ['id', 'name', 'slug']
+
+
+class BrandSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Brand
+        fields = ['id', 'name', 'slug']
+
+
+class TagSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Tag
+        fields = ['id', 'name', 'slug']
+
+
+class ProductImageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ProductImage
+        fields = ['id', 'image', 'alt_text', 'is_main']
+
+
+class ProductVariantSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ProductVariant
+        fields = ['id', 'sku', 'wattage', 'color', 'shape', 'size', 'additional_price', 'stock']
+
+
+class ProductSerializer(SparseFieldsetSerializer):
+    category = CategorySummarySerializer(read_only=True)
+    brand = BrandSummarySerializer(read_only=True)
+    tags = TagSerializer(many=True, read_only=True)
+    images = ProductImageSerializer(many=True, read_only=True)
+    variants = ProductVariantSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Product
+        fields = [
+            'id', 'name', 'slug', 'description', 'price', 'discount_price', 'stock', 'available', 'featured',
+            'weight', 'category', 'brand', 'tags', 'images', 'variants', 'created_at', 'updated_at',
+        ]
+
+
+# ---- Cart, wishlist and checkout input ----
+
+class CartOpSerializer(serializers.Serializer):
+    """add: quantity more (default 1); set: exactly quantity (0 removes); remove: drop the line"""
+    op = serializers.ChoiceField(choices=['add', 'set', 'remove'])
+    product = serializers.IntegerField()
+    variant = serializers.IntegerField(required=False, allow_null=True, default=None)
+    quantity = serializers.IntegerField(required=False, min_value=0, max_value=1000)
+
+    def validate(self, data):
+        if data['op'] == 'set' and 'quantity' not in data:
+            raise serializers.ValidationError({'quantity': "Required for set."})
+        data.setdefault('quantity', 1)
+        return data
+
+
+class CartOpsSerializer(serializers.Serializer):
+    ops = CartOpSerializer(many=True, allow_empty=False, max_length=50)
+
+
+class WishlistChangeSerializer(serializers.Serializer):
+    add = serializers.ListField(child=serializers.IntegerField(), required=False, default=list, max_length=100)
+    remove = serializers.ListField(child=serializers.IntegerField(), required=False, default=list, max_length=100)
+
+
+class AddressInputSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Address
+        fields = list(Address.FINGERPRINT_FIELDS)
+
+
+class CheckoutSerializer(serializers.Serializer):
+    token = serializers.UUIDField()
+    address = AddressInputSerializer(required=False)
+    address_id = serializers.IntegerField(required=False)
+    save_address = serializers.BooleanField(default=False)
+
+    def validate(self, data):
+        if ('address' in data) == ('address_id' in data):
+            raise serializers.ValidationError("Send either address or address_id.")
+        return data
+
+
+# ---- Staff input ----
+
+class BulkOrderStatusSerializer(serializers.Serializer):
+    order_ids = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False, max_length=BULK_STATUS_MAX_ORDERS,
+    )
+    status = serializers.ChoiceField(choices=Order.STATUS_CHOICES)
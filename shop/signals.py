@@ -1,11 +1,223 @@
 # signals.py
-from django.db.models.signals import post_save
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db.models.signals import m2m_changed, post_save, post_init, post_delete, pre_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import Cart, Wishlist
+from .models import Cart, CartItem, Wishlist, Order, OrderStatusEvent, OrderSummary, Address, Product, ProductImage, ProductVariant, Category, Brand, Tag, Review, WishlistItem
+from .caching import invalidate
+from .live_counts import publish_counts_changed
+from .utils import clear_address_cities
 
 @receiver(post_save, sender=User)
 def create_user_cart_wishlist(sender, instance, created, **kwargs):
     if created:
         Cart.objects.create(user=instance)
-        Wishlist.objects.create(user=instance)
\ No newline at end of file
+        Wishlist.objects.create(user=instance)
+
+
+# --- Order status log and summary maintenance ---
+
+SUMMARY_FIELDS = ('user_id', 'status', 'total')
+
+def order_summary_state(instance):
+    # Only the loaded fields: reading a deferred one would cost a query per instance
+    return {field: instance.__dict__[field] for field in SUMMARY_FIELDS if field in instance.__dict__}
+
+def refresh_order_summary(user_id):
+    """Rebuild a summary whose delta can't be worked out, if it exists (it may be going away in a cascade)"""
+    if user_id and OrderSummary.objects.filter(user_id=user_id).exists():
+        OrderSummary.rebuild(user_id)
+
+@receiver(post_init, sender=Order)
+def remember_order_state(sender, instance, **kwargs):
+    # Snapshot of the persisted values so post_save can work out the delta
+    instance._summary_state = order_summary_state(instance) if instance.pk else None
+
+@receiver(post_save, sender=Order)
+def record_status_event(sender, instance, created, **kwargs):
+    # Registered before update_order_summary, which refreshes the snapshot
+    previous = None if created else instance._summary_state or {}
+    if 'status' not in instance.__dict__:
+        return  # deferred and never assigned, so this save didn't write it
+    previous_status = previous.get('status') if previous is not None else None
+    if created or previous_status != instance.status:
+        OrderStatusEvent.objects.create(
+            order=instance,
+            from_status=previous_status or '',
+            to_status=instance.status,
+        )
+
+@receiver(post_save, sender=Order)
+def update_order_summary(sender, instance, created, **kwargs):
+    previous = None if created else instance._summary_state or {}
+    loaded = order_summary_state(instance)
+    instance._summary_state = loaded
+    if previous is not None and len(previous) < len(SUMMARY_FIELDS):
+        # Loaded with only()/defer(): no delta to apply, so recount if a field this save wrote may have changed
+        missing = object()
+        if any(previous.get(field, missing) != value for field, value in loaded.items()):
+            refresh_order_summary(previous.get('user_id'))
+            if instance.user_id != previous.get('user_id'):
+                refresh_order_summary(instance.user_id)
+        return
+    previous = tuple(previous[field] for field in SUMMARY_FIELDS) if previous is not None else None
+    current = tuple(loaded[field] for field in SUMMARY_FIELDS)
+    if previous == current:
+        return
+
+    if previous and previous[0] and previous[0] != instance.user_id:
+        # Order moved to another user: take it off the old summary entirely
+        OrderSummary.apply_delta(previous[0], count=-1, total=-(previous[2] or 0),
+                                 status_counts={previous[1]: -1})
+        previous = None
+
+    if not instance.user_id:
+        return
+    if previous is None:
+        OrderSummary.apply_delta(instance.user_id, count=1, total=instance.total or 0,
+                                 status_counts={instance.status: 1})
+    else:
+        status_counts = {}
+        if previous[1] != instance.status:
+            status_counts = {previous[1]: -1, instance.status: 1}
+        OrderSummary.apply_delta(instance.user_id, total=(instance.total or 0) - (previous[2] or 0),
+                                 status_counts=status_counts)
+
+@receiver(pre_delete, sender=Order)
+def remember_order_owner(sender, instance, **kwargs):
+    # A deferred owner can't be loaded once the row is gone
+    if instance._summary_state is not None and 'user_id' not in instance._summary_state:
+        instance._summary_state['user_id'] = instance.user_id
+
+@receiver(post_delete, sender=Order)
+def remove_from_order_summary(sender, instance, **kwargs):
+    state = instance._summary_state
+    if state and len(state) < len(SUMMARY_FIELDS):
+        # The row is gone, so the orders table already has the count without it
+        refresh_order_summary(state['user_id'])
+    elif state and state['user_id']:
+        # No rebuild here: the user (and its summary) may be going away in the same cascade
+        OrderSummary.apply_delta(state['user_id'], count=-1, total=-(state['total'] or 0),
+                                 status_counts={state['status']: -1}, rebuild_missing=False)
+
+
+# --- Product popularity counters ---
+
+_wishlist_batch = ContextVar('wishlist_batch', default=None)
+
+@contextmanager
+def batched_wishlist_changes():
+    """
+    For deletes that cascade through many wishlist items (a category, a
+    brand): the WishlistItem receivers only collect their changes, which
+    are applied on the way out as one counter UPDATE and one notification
+    per wishlist owner. Nothing is applied if the block raises.
+    """
+    batch = {'counts': Counter(), 'wishlists': set()}
+    token = _wishlist_batch.set(batch)
+    try:
+        yield
+    finally:
+        _wishlist_batch.reset(token)
+    Product.adjust_wishlist_counts(batch['counts'])
+    if batch['wishlists']:
+        for user_id in set(Wishlist.objects.filter(pk__in=batch['wishlists']).values_list('user_id', flat=True)):
+            publish_counts_changed(user_id)
+
+@receiver(post_save, sender=WishlistItem)
+def count_wishlist_add(sender, instance, created, **kwargs):
+    if created:
+        Product.adjust_wishlist_count(instance.product_id, 1)
+
+@receiver(post_delete, sender=WishlistItem)
+def count_wishlist_remove(sender, instance, **kwargs):
+    # Also runs per row for queryset and cascade deletes, unless batched
+    batch = _wishlist_batch.get()
+    if batch is not None:
+        batch['counts'][instance.product_id] -= 1
+    else:
+        Product.adjust_wishlist_count(instance.product_id, -1)
+
+
+# --- Product freshness for API ETags ---
+
+@receiver([post_save, post_delete], sender=ProductVariant)
+@receiver([post_save, post_delete], sender=ProductImage)
+def touch_product_for_child(sender, instance, **kwargs):
+    Product.touch([instance.product_id])
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def touch_product_for_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            Product.touch([instance.pk])
+    elif action == 'pre_clear':
+        # tag.product_set.clear(): the products are only known beforehand
+        Product.touch(instance.product_set.values('pk'))
+    elif action in ('post_add', 'post_remove'):
+        Product.touch(pk_set)
+
+@receiver(post_save, sender=Tag)
+def touch_products_for_tag(sender, instance, created, **kwargs):
+    if not created:
+        Product.touch(instance.product_set.values('pk'))
+
+
+# --- Live header counts ---
+
+@receiver([post_save, post_delete], sender=CartItem)
+def publish_cart_change(sender, instance, **kwargs):
+    # The views pass their cart object in, so instance.cart is usually cached
+    cart = instance.cart
+    publish_counts_changed(cart.user_id, cart.session_key)
+
+@receiver([post_save, post_delete], sender=WishlistItem)
+def publish_wishlist_change(sender, instance, **kwargs):
+    batch = _wishlist_batch.get()
+    if batch is not None:
+        batch['wishlists'].add(instance.wishlist_id)
+    else:
+        publish_counts_changed(instance.wishlist.user_id)
+
+
+# --- Cached admin lookups ---
+
+@receiver(post_save, sender=Address)
+@receiver(post_delete, sender=Address)
+def invalidate_address_cities(sender, **kwargs):
+    clear_address_cities()
+
+@receiver([post_save, post_delete], sender=Address)
+def invalidate_default_address(sender, instance, **kwargs):
+    if instance.user_id:
+        invalidate(Address.default_cache_namespace(instance.user_id))
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Brand)
+@receiver([post_save, post_delete], sender=Tag)
+@receiver([post_save, post_delete], sender=Review)
+def invalidate_catalog_cache(sender, **kwargs):
+    invalidate(sender)
+
+def cached_product_state(instance):
+    # Only the loaded fields: reading a deferred one would cost a query per instance
+    return {field: instance.__dict__[field] for field in Product.CACHED_FIELDS if field in instance.__dict__}
+
+@receiver(post_init, sender=Product)
+def remember_cached_product_state(sender, instance, **kwargs):
+    instance._cached_state = cached_product_state(instance) if instance.pk else None
+
+@receiver(post_save, sender=Product)
+def invalidate_product_cache(sender, instance, created, **kwargs):
+    previous, current = instance._cached_state, cached_product_state(instance)
+    instance._cached_state = current
+    missing = object()
+    if created or previous is None or any(previous.get(field, missing) != value for field, value in current.items()):
+        invalidate(Product)
+
+@receiver(post_delete, sender=Product)
+def invalidate_deleted_product_cache(sender, **kwargs):
+    invalidate(Product)
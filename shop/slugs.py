@@ -0,0 +1,109 @@
+"""
+Unique slug allocation.
+
+Slugs are derived from a source field (usually the name). When the plain
+slug is taken, the next free "-<n>" suffix is worked out from a single
+aggregate over the slugs sharing the prefix, instead of probing -2, -3, ...
+one query at a time. Saves retry inside a savepoint if a concurrent insert
+takes the slug first, and allocate_slugs() assigns slugs to a whole batch
+of unsaved objects with one query before a bulk_create.
+"""
+import re
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import Max, Value
+from django.db.models.functions import Cast, NullIf, Substr
+from django.utils.text import slugify
+
+SLUG_SAVE_ATTEMPTS = 3
+MAX_SUFFIX_DIGITS = 9
+
+
+def slug_base(value, max_length, fallback='item'):
+    return slugify(value)[:max_length].strip('-') or fallback
+
+
+def with_suffix(base, number, max_length):
+    suffix = f'-{number}'
+    return f"{base[:max_length - len(suffix)].strip('-')}{suffix}"
+
+
+def suffix_pattern(bases):
+    alternatives = '|'.join(re.escape(base) for base in bases)
+    return rf'^({alternatives})(-[0-9]{{1,{MAX_SUFFIX_DIGITS}}})?$'
+
+
+def next_free_slug(model, value, field='slug', exclude_pk=None):
+    """The slug for value, suffixed with the next free number if it is already taken"""
+    max_length = model._meta.get_field(field).max_length
+    base = slug_base(value, max_length, fallback=model._meta.model_name)
+    while True:
+        taken = model._default_manager.filter(**{f'{field}__regex': suffix_pattern([base])})
+        if exclude_pk is not None:
+            taken = taken.exclude(pk=exclude_pk)
+        # Suffix after "<base>-": NULL for the bare base, so Max() only sees numbered slugs
+        suffix = NullIf(Substr(field, len(base) + 2), Value(''))
+        result = taken.aggregate(
+            base_taken=models.Count('pk', filter=models.Q(**{field: base})),
+            highest=Max(Cast(suffix, models.BigIntegerField())),
+        )
+        if not result['base_taken']:
+            return base
+        slug = with_suffix(base, max(result['highest'] or 1, 1) + 1, max_length)
+        if slug.startswith(f'{base}-'):
+            return slug
+        # The suffix didn't fit: shorten the base and look again
+        base = slug[:slug.rindex('-')]
+
+
+def allocate_slugs(model, objects, source='name', field='slug'):
+    """Fill in missing slugs on unsaved objects, unique against the table and each other"""
+    max_length = model._meta.get_field(field).max_length
+    pending = [obj for obj in objects if not getattr(obj, field)]
+    if not pending:
+        return objects
+    # Bases leave room for a suffix up front, so numbering never changes the prefix
+    base_length = max_length - MAX_SUFFIX_DIGITS - 1
+    bases = [(obj, slug_base(getattr(obj, source), base_length, fallback=model._meta.model_name)) for obj in pending]
+
+    taken = {getattr(obj, field) for obj in objects if getattr(obj, field)}
+    taken.update(model._default_manager.filter(
+        **{f'{field}__regex': suffix_pattern({base for _, base in bases})}
+    ).values_list(field, flat=True))
+
+    highest = {}
+    for slug in taken:
+        base, _, number = slug.rpartition('-')
+        if number.isdigit():
+            highest[base] = max(highest.get(base, 1), int(number))
+
+    for obj, base in bases:
+        slug = base
+        # A bare base can itself look numbered ("acme-2"), so every candidate is checked
+        while slug in taken:
+            highest[base] = highest.get(base, 1) + 1
+            slug = f'{base}-{highest[base]}'
+        taken.add(slug)
+        setattr(obj, field, slug)
+    return objects
+
+
+class UniqueSlugMixin:
+    """Model mixin: generate a unique slug from slug_source when none is set"""
+    slug_source = 'name'
+
+    def save(self, *args, **kwargs):
+        if self.slug:
+            return super().save(*args, **kwargs)
+
+        for attempt in range(SLUG_SAVE_ATTEMPTS):
+            self.slug = next_free_slug(type(self), getattr(self, self.slug_source), exclude_pk=self.pk)
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                # Only retry when another insert took our slug in the meantime
+                taken = type(self)._default_manager.filter(slug=self.slug).exclude(pk=self.pk).exists()
+                self.slug = ''
+                if not taken or attempt == SLUG_SAVE_ATTEMPTS - 1:
+                    raise
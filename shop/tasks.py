@@ -0,0 +1,230 @@
+"""
+Database-backed background tasks.
+
+Work that doesn't have to finish before a response is sent (confirmation
+email, sales counters, ...) is written to the Task table and picked up by
+`manage.py run_task_worker`:
+
+    @task
+    def send_order_confirmation(order_id):
+        ...
+
+    with transaction.atomic():
+        order = Order.objects.create(...)
+        enqueue(send_order_confirmation, order_id=order.id)
+
+Payloads are keyword arguments and must be JSON-serialisable; pass ids,
+not model instances. Queue a task inside the transaction that writes the
+rows it reads: it commits (or rolls back) with them, and workers can't
+see it before then.
+
+Workers claim due tasks with SELECT ... FOR UPDATE SKIP LOCKED, so any
+number of them can poll the same table without handing out a task twice.
+A claimed task is leased for TASK_LEASE_SECONDS; if its worker dies, it
+becomes due again once the lease runs out. A handler runs in the same
+transaction that deletes its task, so its database changes and the task's
+completion commit together. A handler that raises is retried with
+exponential backoff until it has been tried max_attempts times, then left
+in the table as failed (the Task admin can requeue it). Side effects outside
+the database, like email, go in transaction.on_commit(), so a retry or a
+rolled-back completion doesn't repeat them.
+
+Nothing runs these tasks but run_task_worker: without a worker, orders are
+still placed, but no confirmation email goes out and Product.sold and
+last_sold (and the best-seller rails) stay where they were.
+"""
+import logging
+import random
+import signal
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import F, Sum
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .caching import invalidate
+from .models import Order, OrderItem, Product, Task
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+def task(func=None, *, name=None, max_attempts=None):
+    """Register func as a task handler, under its function name by default"""
+    def register(func):
+        func.task_name = name or func.__name__
+        func.max_attempts = max_attempts
+        registry[func.task_name] = func
+        return func
+    return register(func) if func else register
+
+
+def enqueue(handler, delay=None, **payload):
+    """Queue a task now; it commits with the surrounding transaction, if any"""
+    name = getattr(handler, 'task_name', handler)
+    max_attempts = getattr(registry.get(name), 'max_attempts', None)
+    return Task.objects.create(
+        name=name,
+        payload=payload,
+        run_at=timezone.now() + (delay or timedelta()),
+        max_attempts=max_attempts or getattr(settings, 'TASK_MAX_ATTEMPTS', 5),
+    )
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter for the retry after the given number of attempts"""
+    base = getattr(settings, 'TASK_RETRY_BASE_SECONDS', 10)
+    ceiling = getattr(settings, 'TASK_RETRY_MAX_SECONDS', 3600)
+    delay = min(ceiling, base * 2 ** max(attempts - 1, 0))
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+def claim(limit=1):
+    """Lease up to `limit` due tasks to this worker"""
+    now = timezone.now()
+    lease_expires = now + timedelta(seconds=getattr(settings, 'TASK_LEASE_SECONDS', 300))
+    with transaction.atomic():
+        tasks = list(
+            Task.objects.select_for_update(skip_locked=True)
+            .filter(status__in=[Task.QUEUED, Task.RUNNING], run_at__lte=now)
+            .order_by('run_at', 'id')[:limit]
+        )
+        if tasks:
+            Task.objects.filter(pk__in=[t.pk for t in tasks]).update(
+                status=Task.RUNNING, attempts=F('attempts') + 1, run_at=lease_expires, updated_at=now,
+            )
+    for claimed in tasks:
+        claimed.status, claimed.attempts, claimed.run_at = Task.RUNNING, claimed.attempts + 1, lease_expires
+    return tasks
+
+
+def run(claimed):
+    """Run a claimed task; True if it succeeded (or was already done elsewhere)"""
+    handler = registry.get(claimed.name)
+    started = time.perf_counter()
+    try:
+        if handler is None:
+            raise LookupError(f"No task registered as {claimed.name!r}")
+        if claimed.attempts > claimed.max_attempts:
+            # Claimed again after its lease ran out, i.e. its workers keep dying on it
+            raise RuntimeError(f"Lease expired on attempt {claimed.attempts - 1}")
+        with transaction.atomic():
+            # Deleting first locks the row, so a worker reclaiming it after a lease
+            # expiry skips it; if attempts moved on, that worker already has it
+            if not Task.objects.filter(pk=claimed.pk, attempts=claimed.attempts).delete()[0]:
+                return True
+            handler(**claimed.payload)
+    except Exception as e:
+        if claimed.attempts >= claimed.max_attempts:
+            give_up(claimed, e)
+        else:
+            reschedule(claimed, e)
+        return False
+    logger.debug("Task %s done", claimed.name, extra={'task': {
+        'id': claimed.pk, 'name': claimed.name, 'attempts': claimed.attempts,
+        'ms': round((time.perf_counter() - started) * 1000, 2),
+    }})
+    return True
+
+
+def reschedule(claimed, error):
+    delay = retry_delay(claimed.attempts)
+    Task.objects.filter(pk=claimed.pk, attempts=claimed.attempts).update(
+        status=Task.QUEUED, run_at=timezone.now() + delay, last_error=traceback.format_exc(),
+        updated_at=timezone.now(),
+    )
+    logger.warning("Task %s failed, retrying in %ds: %s", claimed.name, delay.total_seconds(), error,
+                   extra={'task': {'id': claimed.pk, 'name': claimed.name, 'attempts': claimed.attempts}})
+
+
+def give_up(claimed, error):
+    Task.objects.filter(pk=claimed.pk, attempts=claimed.attempts).update(
+        status=Task.FAILED, last_error=traceback.format_exc(), updated_at=timezone.now(),
+    )
+    logger.error("Task %s failed after %d attempts: %s", claimed.name, claimed.attempts, error,
+                 extra={'task': {'id': claimed.pk, 'name': claimed.name, 'payload': claimed.payload}})
+
+
+def run_pending(limit=None):
+    """Run due tasks in this process until none are left (or `limit` have run); returns how many ran"""
+    count = 0
+    while limit is None or count < limit:
+        tasks = claim()
+        if not tasks:
+            break
+        run(tasks[0])
+        count += 1
+    return count
+
+
+class Worker:
+    """Polling loop for one worker process; SIGTERM/SIGINT stop it after the current task"""
+
+    def __init__(self, batch_size=10, poll_interval=1.0, burst=False):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.burst = burst
+        self.stopping = False
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self.stopping:
+            tasks = claim(self.batch_size)
+            for index, claimed in enumerate(tasks):
+                if self.stopping:
+                    # Hand the rest back rather than sitting on them until the lease runs out
+                    Task.objects.filter(pk__in=[t.pk for t in tasks[index:]]).update(
+                        status=Task.QUEUED, run_at=timezone.now(), attempts=F('attempts') - 1,
+                    )
+                    break
+                run(claimed)
+            if not tasks:
+                if self.burst:
+                    break
+                self.sleep()
+
+    def sleep(self):
+        deadline = time.monotonic() + self.poll_interval
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(min(0.2, self.poll_interval))
+
+
+# ========== ORDER PLACED ==========
+
+@task
+def record_order_sales(order_id):
+    """Add the order's quantities to its products' sold counters"""
+    now = timezone.now()
+    lines = OrderItem.objects.filter(order_id=order_id).values('product_id').annotate(quantity=Sum('quantity'))
+    for line in lines.order_by('product_id'):
+        Product.objects.filter(pk=line['product_id']).update(sold=F('sold') + line['quantity'], last_sold=now)
+    # Only the rankings by sales; the rest of the catalog cache stays warm
+    invalidate(Product.SALES_CACHE_NAMESPACE)
+
+
+@task
+def send_order_confirmation(order_id):
+    order = Order.objects.select_related('delivery_address', 'user').filter(pk=order_id).first()
+    if order is None:
+        return
+    address = order.delivery_address
+    recipient = (address.email if address else '') or (order.user.email if order.user else '')
+    if not recipient:
+        return
+    items = order.items.select_related('product', 'variant')
+    body = render_to_string('emails/order_confirmation.txt', {'order': order, 'items': items, 'address': address})
+    # Sent once the task's deletion has committed: at most once, never again on a retry.
+    # robust: a mail error is logged rather than failing a task that is already gone
+    transaction.on_commit(
+        lambda: send_mail(f"Your Newgate order #{order.id}", body, None, [recipient]), robust=True,
+    )
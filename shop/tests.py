@@ -1,3 +1,1402 @@
-from django.test import TestCase
+import asyncio
+import io
+import logging
+import os
+import tempfile
+import uuid
+from unittest import mock, skipUnless
+import json
+from datetime import date, timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.contrib.messages import get_messages
+from django.db import IntegrityError, connection, transaction
+from django.template.backends.django import Template as DjangoTemplate
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import (
+    Address, Brand, Cart, CartItem, Category, CheckoutSubmission, Order, OrderItem, OrderStatusEvent, OrderSummary, Product,
+    ProductImage, ProductVariant, Review, Task, Wishlist, WishlistItem,
+)
+from .bench_data import flush as flush_bench_data, generate as generate_bench_data
+from .benchmarks import ClientDriver, benchmark_context, compare, select_scenarios
+from .checkout import EmptyCart, place_order
+from .caching import cache_stats, generation, get_or_compute, invalidate, reset_cache_stats
+from .order_export import start_of_day
+from .live_counts import counts_channel, hub
+from .logs import BackgroundHandler, SampleFilter
+from .metrics import QueryBudgetExceeded
+from .db_routers import PIN_COOKIE, primary_pin, replica_reads, reset_replica_health
+from .product_import import ProductImporter
+from .signals import batched_wishlist_changes
+from .slugs import allocate_slugs
+from .views import search_orders
+from . import logs, tasks
+
+User = get_user_model()
+
+
+class OrderTestData(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', 'staff@example.com', 'pass', is_staff=True)
+        customer = User.objects.create_user('customer', 'customer@example.com', 'pass')
+        category = Category.objects.create(name='Lamps')
+        cls.products = []
+        for n in range(3):
+            product = Product.objects.create(
+                name=f'Lamp {n}', description='Lamp', price=Decimal('100'), category=category, stock=10
+            )
+            ProductImage.objects.create(product=product, image=f'products/lamp-{n}.jpg')
+            ProductImage.objects.create(product=product, image=f'products/lamp-{n}-main.jpg', is_main=True)
+            cls.products.append(product)
+        cls.variant = ProductVariant.objects.create(product=cls.products[0], color='Red', additional_price=Decimal('5'))
+        cls.address = Address.objects.create(
+            full_name='Test Customer', email='customer@example.com', street='1 Street', city='Lahore',
+            state='Punjab', postal_code='54000', country='Pakistan', phone='03001234567', user=customer,
+        )
+        cls.customer = customer
+
+    def create_orders(self, count):
+        for _ in range(count):
+            order = Order.objects.create(user=self.customer, delivery_address=self.address, total=Decimal('295'))
+            OrderItem.objects.create(
+                order=order, product=self.products[0], variant=self.variant, quantity=1,
+                price=Decimal('105'), discounted_price=Decimal('95'),
+            )
+            for product in self.products[1:]:
+                OrderItem.objects.create(order=order, product=product, quantity=1, price=Decimal('100'))
+
+
+class StaffOrderListQueryTests(OrderTestData):
+    def get_order_list(self):
+        return self.client.get(reverse('order_list'))
+
+    def test_query_count_does_not_grow_with_orders(self):
+        self.client.force_login(self.staff)
+        self.create_orders(2)
+        # session + user, count, order page, line items, header counts (4)
+        with self.assertNumQueries(9):
+            self.get_order_list()
+        self.create_orders(8)
+        with self.assertNumQueries(9):
+            response = self.get_order_list()
+        self.assertEqual(len(response.context['orders']), 10)
+
+    def test_totals_and_thumbnails(self):
+        self.client.force_login(self.staff)
+        self.create_orders(1)
+        order = self.get_order_list().context['orders'][0]
+        self.assertEqual(order.line_count, 3)
+        self.assertEqual(order.items_total, Decimal('295'))
+        self.assertEqual(order.items_total, Order.objects.get(pk=order.pk).final_total)
+        self.assertEqual([line.thumbnail_url for line in order.lines], [
+            f'/media/products/lamp-{n}-main.jpg' for n in range(3)
+        ])
+
+
+class OrderSearchTests(OrderTestData):
+    def setUp(self):
+        self.create_orders(1)
+        other = Address.objects.create(
+            full_name='Bilal Ahmed', email='bilal@example.com', street='2 Street', city='Karachi',
+            state='Sindh', postal_code='74000', country='Pakistan', phone='+92-321-7654321',
+        )
+        self.mine = Order.objects.get()
+        self.theirs = Order.objects.create(delivery_address=other, total=Decimal('10'))
+
+    def search(self, query):
+        return set(search_orders(Order.objects.all(), query).values_list('id', flat=True))
+
+    def test_each_branch(self):
+        self.assertEqual(self.search(f'#{self.theirs.id}'), {self.theirs.id})
+        self.assertEqual(self.search('0321-7654321'), set())  # different country prefix, different digits
+        self.assertEqual(self.search('+92 321 7654321'), {self.theirs.id})
+        self.assertEqual(self.search('923217654321'), {self.theirs.id})  # all digits: id or phone
+        self.assertEqual(self.search('BILAL@example.com'), {self.theirs.id})
+        self.assertEqual(self.search('customer@example.com'), {self.mine.id})  # address and user email
+        self.assertEqual(self.search('bil'), {self.theirs.id})
+        self.assertEqual(self.search('custom'), {self.mine.id})  # partial username
+        self.assertEqual(self.search('nobody'), set())
+
+    def test_non_ascii_digits_fall_through_to_text_search(self):
+        # str.isdigit() accepts these, int() doesn't (or reads them as an id)
+        for query in ('²', '#²', '١٢', '⑤'):
+            self.assertEqual(self.search(query), set(), query)
+        self.assertEqual(self.search('9' * 30), set())
+
+    def test_matches_are_subqueries(self):
+        sql = str(search_orders(Order.objects.all(), 'a').query)
+        self.assertEqual(sql.count('SELECT'), 3)
+
+    def test_user_lookups_can_use_their_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')  # a handful of rows would be scanned anyway
+        self.assertIn('shop_user_username_trgm_idx', User.objects.filter(username__icontains='cust').explain())
+        self.assertIn('shop_user_email_upper_idx', User.objects.filter(email__iexact='A@example.com').explain())
+
+
+class OrderExportTests(OrderTestData):
+    def export(self, **params):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('export_orders'), params)
+        return b''.join(response.streaming_content).decode().splitlines()
+
+    def test_csv_export_streams_order_lines(self):
+        self.create_orders(2)
+        lines = self.export()
+        self.assertTrue(lines[0].startswith('order_id,order_created_at,order_status'))
+        self.assertEqual(len(lines), 1 + 2 * 3)
+        self.assertIn('Lahore', lines[1])
+
+    def test_since_id_and_status_filters(self):
+        self.create_orders(2)
+        first, second = Order.objects.order_by('id')
+        Order.transition_status([second.id], 'shipped')
+        rows = [json.loads(line) for line in self.export(format='jsonl', since_id=first.id)]
+        self.assertEqual({row['order_id'] for row in rows}, {second.id})
+        self.assertEqual(len(self.export(status='delivered')), 1)  # header only
+
+    def test_malformed_dates_are_rejected_not_ignored(self):
+        self.create_orders(1)
+        self.client.force_login(self.staff)
+        for value in ('yesterday', '2024-13-40'):
+            response = self.client.get(reverse('export_orders'), {'start': value})
+            self.assertEqual(response.status_code, 400)
+            with self.assertRaisesMessage(CommandError, f'Invalid date: {value}'):
+                call_command('export_orders', end=value, stdout=io.StringIO(), stderr=io.StringIO())
+        today = timezone.localdate().isoformat()
+        self.assertEqual(len(self.export(start=today, end=today)), 1 + 3)
+
+
+    @override_settings(TIME_ZONE='Asia/Karachi')
+    def test_dates_are_days_in_the_current_time_zone(self):
+        self.create_orders(2)
+        first, second = Order.objects.order_by('id')
+        day = date(2024, 3, 10)
+        # 23:59 and 00:00 Karachi time, i.e. 18:59 and 19:00 UTC on the 10th
+        Order.objects.filter(pk=first.pk).update(created_at=start_of_day(day) + timedelta(hours=23, minutes=59))
+        Order.objects.filter(pk=second.pk).update(created_at=start_of_day(day + timedelta(days=1)))
+        rows = [json.loads(line) for line in self.export(format='jsonl', start='2024-03-10', end='2024-03-10')]
+        self.assertEqual({row['order_id'] for row in rows}, {first.id})
+        rows = [json.loads(line) for line in self.export(format='jsonl', start='2024-03-11')]
+        self.assertEqual({row['order_id'] for row in rows}, {second.id})
+
+class OrderStatusEndpointTests(OrderTestData):
+    def setUp(self):
+        self.client.force_login(self.staff)
+        self.create_orders(3)
+        self.orders = list(Order.objects.order_by('id'))
+
+    def bulk(self, payload):
+        return self.client.post(reverse('bulk_update_order_status'), payload, content_type='application/json')
+
+    @mock.patch.dict(Order.STATUS_TRANSITIONS, {'delivered': set()})
+    def test_bulk_results_per_order(self):
+        first, second, third = self.orders
+        Order.transition_status([second.id], 'delivered')
+        Order.transition_status([third.id], 'shipped')
+        response = self.bulk({'order_ids': [first.id, str(second.id), third.id, 999999], 'status': 'shipped'})
+        body = response.json()
+        self.assertEqual(body['results'], {
+            str(first.id): 'updated', str(second.id): 'invalid_transition',
+            str(third.id): 'unchanged', '999999': 'not_found',
+        })
+        self.assertEqual(body['updated'], 1)
+        self.assertEqual(
+            list(Order.objects.order_by('id').values_list('status', flat=True)), ['shipped', 'delivered', 'shipped']
+        )
+
+    def test_bulk_rejects_malformed_ids_and_oversized_batches(self):
+        for order_ids in ['123', {str(self.orders[0].id): 1}, [True], [[1]], ['x']]:
+            response = self.bulk({'order_ids': order_ids, 'status': 'cancelled'})
+            self.assertEqual(response.status_code, 400, order_ids)
+        with mock.patch('shop.views.BULK_STATUS_MAX_ORDERS', 2):
+            response = self.bulk({'order_ids': [order.id for order in self.orders], 'status': 'cancelled'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.filter(status='cancelled').exists())
+
+    def test_bulk_api_takes_a_staff_token_instead_of_a_session(self):
+        client = Client()
+
+        def bulk_api(payload, username=None):
+            auth = {}
+            if username:
+                token = client.post(reverse('api_token'), {'username': username, 'password': 'pass'},
+                                    content_type='application/json').json()['access']
+                auth['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+            return client.post(reverse('api_order_bulk_status'), payload, content_type='application/json', **auth)
+
+        first, second, _ = self.orders
+        payload = {'order_ids': [first.id, second.id, first.id], 'status': 'shipped'}
+        self.assertEqual(bulk_api(payload).status_code, 401)
+        self.assertEqual(bulk_api(payload, 'customer').status_code, 403)
+        for order_ids in ['123', [True], [], ['x']]:
+            self.assertEqual(bulk_api({'order_ids': order_ids, 'status': 'shipped'}, 'staff').status_code, 400)
+        self.assertEqual(bulk_api({'order_ids': [first.id], 'status': 'lost'}, 'staff').status_code, 400)
+
+        response = bulk_api(payload, 'staff')
+        self.assertEqual(response.json(), {
+            'status': 'shipped', 'updated': 2, 'results': {str(first.id): 'updated', str(second.id): 'updated'},
+        })
+        self.assertEqual(
+            list(OrderStatusEvent.objects.filter(to_status='shipped').values_list('changed_by', flat=True)),
+            [self.staff.pk, self.staff.pk],
+        )
+
+    def test_delivered_orders_can_still_be_cancelled_or_reopened(self):
+        first, second, _ = self.orders
+        Order.transition_status([first.id, second.id], 'delivered')
+        self.assertTrue(self.client.post(reverse('cancel_order', args=[first.id])).json()['success'])
+        response = self.bulk({'order_ids': [second.id], 'status': 'processing'})
+        self.assertEqual(response.json()['results'], {str(second.id): 'updated'})
+        self.assertEqual(
+            list(Order.objects.order_by('id').values_list('status', flat=True)), ['cancelled', 'processing', 'processing']
+        )
+
+    @mock.patch.dict(Order.STATUS_TRANSITIONS, {'delivered': set()})
+    def test_single_order_endpoints_refuse_invalid_transitions(self):
+        order = self.orders[0]
+        Order.transition_status([order.id], 'delivered')
+        response = self.client.post(reverse('update_order_status', args=[order.id]), {'status': 'processing'})
+        self.assertFalse(response.json()['success'])
+        response = self.client.post(reverse('cancel_order', args=[order.id]))
+        self.assertFalse(response.json()['success'])
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'delivered')
+        response = self.client.post(reverse('update_order_status', args=[self.orders[1].id]), {'status': 'shipped'})
+        self.assertTrue(response.json()['success'])
+
+
+class OrderSummaryTests(OrderTestData):
+    def summary_values(self, summary):
+        return {
+            field.name: getattr(summary, field.name) for field in OrderSummary._meta.fields
+            if field.name.endswith('_count') or field.name == 'total_spent'
+        }
+
+    def assertSummaryRebuilds(self, user, **expected):
+        kept = self.summary_values(OrderSummary.objects.get(user=user))
+        self.assertEqual(kept, self.summary_values(OrderSummary.rebuild(user.pk)))
+        self.assertEqual({field: kept[field] for field in expected}, expected)
+
+    def test_summary_follows_order_changes(self):
+        self.create_orders(3)
+        first, second, third = Order.objects.order_by('id')
+        self.assertSummaryRebuilds(self.customer, order_count=3, total_spent=Decimal('885'), processing_count=3)
+
+        first.status, first.total = 'shipped', Decimal('300')
+        first.save()
+        Order.transition_status([second.pk, third.pk], 'delivered')
+        Order.transition_status([second.pk], 'cancelled')
+        self.assertSummaryRebuilds(self.customer, order_count=3, total_spent=Decimal('890'),
+                                   processing_count=0, shipped_count=1, delivered_count=1, cancelled_count=1)
+
+        first.user = self.staff
+        first.save()
+        Order.objects.get(pk=second.pk).delete()
+        self.assertSummaryRebuilds(self.customer, order_count=1, total_spent=Decimal('295'),
+                                   shipped_count=0, delivered_count=1)
+        self.assertSummaryRebuilds(self.staff, order_count=1, total_spent=Decimal('300'), shipped_count=1)
+
+    def test_deferred_orders_load_without_queries_and_still_update_the_summary(self):
+        self.create_orders(3)
+        with self.assertNumQueries(1):
+            orders = list(Order.objects.only('id', 'status').order_by('id'))
+            [order.status for order in orders]
+        first, second, _ = orders
+        first.status = 'shipped'
+        first.save()
+        second.delete()
+        self.assertSummaryRebuilds(self.customer, order_count=2, total_spent=Decimal('590'),
+                                   processing_count=1, shipped_count=1)
+        self.assertTrue(OrderStatusEvent.objects.filter(order=first, from_status='processing', to_status='shipped').exists())
+
+    def test_order_history_counts_come_from_the_summary(self):
+        self.create_orders(12)
+        Order.transition_status(Order.objects.order_by('id').values_list('id', flat=True)[:2], 'delivered')
+        self.client.force_login(self.customer)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('order_history'))
+        self.assertEqual(response.context['orders'].paginator.count, 12)
+        self.assertEqual(len(response.context['orders']), 10)
+        self.assertEqual(response.context['total_spent'], Decimal('3540'))
+        self.assertFalse([query['sql'] for query in queries if 'COUNT(' in query['sql'] and '"shop_order"' in query['sql']])
+        for status_filter, count in (('active', 10), ('delivered', 2), ('cancelled', 0)):
+            response = self.client.get(reverse('order_history'), {'status': status_filter})
+            self.assertEqual(response.context['orders'].paginator.count, count)
+
+    def test_order_history_query_count_does_not_grow_with_line_items(self):
+        self.create_orders(12)
+        self.client.force_login(self.customer)
+        self.client.get(reverse('order_history'))
+        # Session, user, summary, a page of orders, their line items with thumbnails, header counts
+        with self.assertNumQueries(9):
+            response = self.client.get(reverse('order_history'))
+        self.assertContains(response, '/media/products/lamp-1-main.jpg')
+        self.assertNotContains(response, '/media/products/lamp-1.jpg')
+
+
+class OrderStatusEventTests(OrderTestData):
+    def test_status_changes_are_logged_and_shown_on_the_timeline(self):
+        self.create_orders(2)
+        order, other = Order.objects.order_by('id')
+        order.status = 'shipped'
+        order.save()
+        order.total = Decimal('300')
+        order.save()  # no status change, no event
+        Order.transition_status([order.pk, other.pk], 'delivered', changed_by=self.staff)
+        Order.transition_status([order.pk], 'delivered', changed_by=self.staff)  # already there: no event
+
+        def events(order):
+            return list(order.status_events.values_list('from_status', 'to_status', 'changed_by'))
+        self.assertEqual(events(order), [
+            ('', 'processing', None), ('processing', 'shipped', None), ('shipped', 'delivered', self.staff.pk),
+        ])
+        self.assertEqual(events(other), [('', 'processing', None), ('processing', 'delivered', self.staff.pk)])
+
+        self.client.force_login(self.customer)
+        response = self.client.get(reverse('order_tracking', args=[order.pk]))
+        self.assertEqual(
+            [(event.from_status, event.to_status) for event in response.context['events']],
+            [('', 'processing'), ('processing', 'shipped'), ('shipped', 'delivered')],
+        )
+        content = response.content.decode()
+        steps = [content.index(f'<strong>{label}</strong>') for label in ('Processing', 'Shipped', 'Delivered')]
+        self.assertEqual(steps, sorted(steps))
+        self.assertContains(response, '(from Shipped)')
+        self.assertNotContains(response, 'Cancelled</strong>')
+
+        # Only the order's owner sees its timeline
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(reverse('order_tracking', args=[order.pk])).status_code, 404)
+
+
+class HomePageQueryTests(OrderTestData):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.customer)
+
+    def add_catalog(self, count):
+        category = Category.objects.first()
+        for n in range(count):
+            product = Product.objects.create(name=f'Extra {n}', description='', price=10, stock=1, category=category)
+            ProductImage.objects.create(product=product, image=f'products/extra-{n}.jpg')
+            Review.objects.create(product=product, user=self.staff, rating=4, comment='Nice')
+
+    def test_cached_render_only_queries_the_overlay(self):
+        self.client.get(reverse('home'))
+        # session + user, wishlist ids, cart ids, header counts (4)
+        with self.assertNumQueries(8):
+            self.client.get(reverse('home'))
+
+    def test_rebuild_is_bounded(self):
+        self.add_catalog(2)
+        self.client.get(reverse('home'))
+        self.add_catalog(10)
+        # overlay (8) + one query per product/review rail (4); categories didn't change
+        with self.assertNumQueries(12):
+            response = self.client.get(reverse('home'))
+        self.assertEqual(len(response.context['new_arrivals']), 8)
+        self.assertEqual(response.context['new_arrivals'][0].image_url, '/media/products/extra-9.jpg')
+        self.assertEqual(response.context['new_arrivals'][0].rating_count, 1)
+
+    def test_recorded_sales_rebuild_only_the_best_sellers(self):
+        self.create_orders(1)
+        self.client.get(reverse('home'))
+        catalog_generation = generation(Product)
+        tasks.record_order_sales(order_id=Order.objects.get().pk)
+        self.assertEqual(generation(Product), catalog_generation)
+        # overlay (8) + the best sellers rail
+        with self.assertNumQueries(9):
+            response = self.client.get(reverse('home'))
+        self.assertEqual([product.sold for product in response.context['most_sold']], [1, 1, 1])
+
+
+class AsyncEndpointTests(OrderTestData):
+    def setUp(self):
+        cache.clear()
+
+    async def test_cart_mutations_and_header_counts(self):
+        await self.async_client.aforce_login(self.customer)
+        product = self.products[0]
+        for _ in range(2):
+            response = await self.async_client.post(reverse('add_to_cart', args=[product.pk]))
+        self.assertEqual(response.json()['cart_count'], 2)
+
+        response = await self.async_client.post(reverse('update_cart', args=[product.pk, 'decrease']))
+        self.assertEqual(response.json()['quantity'], 1)
+        self.assertEqual(response.json()['total'], 100.0)
+        response = await self.async_client.post(reverse('update_cart', args=[product.pk, 'decrease']))
+        self.assertTrue(response.json()['removed'])
+
+        await self.async_client.post(reverse('add_to_cart', args=[self.products[1].pk]))
+        await WishlistItem.objects.acreate(wishlist=await Wishlist.objects.aget(user=self.customer), product=product)
+        response = await self.async_client.get(reverse('header_counts_api'))
+        self.assertEqual(response.json(), {'success': True, 'cart_count': 1, 'wishlist_count': 1})
+
+    async def test_guest_header_counts_dont_create_a_session(self):
+        response = await self.async_client.get(reverse('header_counts_api'))
+        self.assertEqual(response.json()['cart_count'], 0)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+    def test_autocomplete_is_cached_per_prefix(self):
+        names = self.client.get(reverse('autocomplete'), {'term': 'lamp'}).json()
+        self.assertEqual(sorted(names), ['Lamp 0', 'Lamp 1', 'Lamp 2'])
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.client.get(reverse('autocomplete'), {'term': 'LAMP'}).json()), 3)
+
+
+class LiveCountsTests(OrderTestData):
+    def add_to_cart_and_commit(self):
+        # The CartItem signal publishes on commit, on the main thread's connection
+        self.client.force_login(self.customer)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('add_to_cart', args=[self.products[0].pk]))
+
+    async def test_stream_pushes_counts_when_they_change(self):
+        await self.async_client.aforce_login(self.customer)
+        response = await self.async_client.get(reverse('header_counts_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = aiter(response.streaming_content)
+        try:
+            self.assertTrue((await anext(events)).startswith(b'retry:'))
+            self.assertIn(b'{"cart_count": 0, "wishlist_count": 0}', await anext(events))
+            self.assertEqual(hub.subscriber_count(), 1)
+
+            await sync_to_async(self.add_to_cart_and_commit)()
+            self.assertIn(b'{"cart_count": 1,', await asyncio.wait_for(anext(events), 5))
+            # Queryset update: published by the view rather than a signal
+            await self.async_client.post(reverse('add_to_cart', args=[self.products[0].pk]))
+            self.assertIn(b'{"cart_count": 2,', await asyncio.wait_for(anext(events), 5))
+        finally:
+            await events.aclose()
+
+    def test_wsgi_and_sessionless_clients_are_told_to_poll(self):
+        self.client.force_login(self.customer)
+        self.assertEqual(self.client.get(reverse('header_counts_stream')).status_code, 204)
+
+    async def test_publish_from_another_thread_wakes_subscribers(self):
+        subscription = hub.subscribe(counts_channel(session_key='abc'))
+        try:
+            self.assertFalse(await subscription.wait(0.01))
+            await asyncio.to_thread(hub.publish, 'session:abc')
+            self.assertTrue(await subscription.wait(1))
+        finally:
+            hub.unsubscribe(subscription)
+
+
+class WishlistCountTests(OrderTestData):
+    def wishlist_count(self, product):
+        return Product.objects.get(pk=product.pk).wishlist_count
+
+    def test_toggle_updates_counter(self):
+        self.client.force_login(self.customer)
+        url = reverse('add_to_wishlist', args=[self.products[0].id])
+        self.client.post(url)
+        self.assertEqual(self.wishlist_count(self.products[0]), 1)
+        self.client.post(url)
+        self.assertEqual(self.wishlist_count(self.products[0]), 0)
+
+    def test_bulk_and_cascade_deletes_update_counter(self):
+        for product in self.products:
+            WishlistItem.objects.create(wishlist=self.staff.wishlist, product=product)
+            WishlistItem.objects.create(wishlist=self.customer.wishlist, product=product)
+        WishlistItem.objects.filter(wishlist=self.staff.wishlist).delete()
+        self.assertEqual(self.wishlist_count(self.products[1]), 1)
+        Wishlist.objects.filter(user=self.customer).delete()
+        self.assertEqual(self.wishlist_count(self.products[1]), 0)
+
+    def test_reconcile_fixes_drift(self):
+        WishlistItem.objects.create(wishlist=self.customer.wishlist, product=self.products[0])
+        Product.objects.update(wishlist_count=7)
+        fixed = Product.reconcile_wishlist_counts(0, max(p.pk for p in self.products) + 1)
+        self.assertEqual(fixed, 3)
+        self.assertEqual([self.wishlist_count(p) for p in self.products], [1, 0, 0])
+
+
+class TaskQueueTests(OrderTestData):
+    def test_checkout_queues_side_effects_with_the_order(self):
+        self.client.force_login(self.customer)
+        CartItem.objects.create(cart=Cart.objects.get(user=self.customer), product=self.products[0], variant=self.variant,
+                                quantity=2)
+        with self.assertLogs('shop', 'INFO'):
+            response = self.client.post(reverse('checkout'), {
+                'full_name': 'Test Customer', 'email': 'customer@example.com', 'street': '1 Street',
+                'city': 'Lahore', 'state': 'Punjab', 'postal_code': '54000', 'country': 'Pakistan',
+                'phone': '03001234567',
+            })
+        order = Order.objects.get(user=self.customer)
+        self.assertRedirects(response, reverse('order_confirmation', args=[order.id]), fetch_redirect_response=False)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock, 8)
+        # Written in the order's transaction: TestCase never runs on-commit hooks
+        self.assertEqual(sorted(Task.objects.values_list('name', flat=True)),
+                         ['record_order_sales', 'send_order_confirmation'])
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertEqual(tasks.run_pending(), 2)
+        self.assertFalse(Task.objects.exists())
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).sold, 2)
+        # Not sent until the task's deletion commits
+        self.assertEqual(mail.outbox, [])
+        for callback in callbacks:
+            callback()
+        self.assertEqual(mail.outbox[0].to, ['customer@example.com'])
+        self.assertIn(f'order #{order.id}', mail.outbox[0].body)
+
+    def test_failures_back_off_then_give_up(self):
+        calls = []
+
+        @tasks.task(name='test_flaky', max_attempts=2)
+        def flaky(**payload):
+            calls.append(payload)
+            raise ValueError('boom')
+
+        self.addCleanup(tasks.registry.pop, 'test_flaky')
+        queued = tasks.enqueue(flaky, n=1)
+        with self.assertLogs('shop.tasks', 'WARNING'):
+            self.assertEqual(tasks.run_pending(), 1)
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Task.QUEUED, 1))
+        self.assertGreater(queued.run_at, timezone.now())
+        self.assertIn('ValueError: boom', queued.last_error)
+        self.assertEqual(tasks.run_pending(), 0)  # not due yet
+
+        Task.objects.update(run_at=timezone.now())
+        with self.assertLogs('shop.tasks', 'ERROR'):
+            tasks.run_pending()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Task.FAILED, 2))
+        self.assertEqual(calls, [{'n': 1}, {'n': 1}])
+        self.assertEqual(tasks.run_pending(), 0)
+
+    def test_expired_lease_is_reclaimed(self):
+        queued = tasks.enqueue(tasks.record_order_sales, order_id=0)
+        self.assertEqual([t.pk for t in tasks.claim()], [queued.pk])
+        self.assertEqual(tasks.claim(), [])
+        Task.objects.update(run_at=timezone.now())
+        reclaimed = tasks.claim()
+        self.assertEqual(reclaimed[0].attempts, 2)
+        self.assertTrue(tasks.run(reclaimed[0]))
+        self.assertFalse(Task.objects.exists())
+
+
+class CheckoutIdempotencyTests(OrderTestData):
+    def submit(self, token, client=None):
+        return (client or self.client).post(reverse('checkout'), {
+            'full_name': 'Test Customer', 'email': 'customer@example.com', 'street': '1 Street',
+            'city': 'Lahore', 'state': 'Punjab', 'postal_code': '54000', 'country': 'Pakistan',
+            'phone': '03001234567', 'checkout_token': token,
+        })
+
+    def checkout(self, token, client=None):
+        with self.assertLogs('shop', 'INFO'):
+            return self.submit(token, client)
+
+    def test_resubmitted_form_returns_the_first_order(self):
+        self.client.force_login(self.customer)
+        response = self.client.get(reverse('checkout'))
+        token = str(response.context['checkout_token'])
+        self.assertContains(response, f'name="checkout_token" value="{token}"')
+
+        cart = Cart.objects.get(user=self.customer)
+        CartItem.objects.create(cart=cart, product=self.products[1], quantity=2)
+        first = self.checkout(token)
+        # A retry that arrives while the cart still has items (e.g. re-added) must not order them again
+        CartItem.objects.create(cart=cart, product=self.products[1], quantity=2)
+        second = self.checkout(token)
+        CartItem.objects.filter(cart=cart).delete()
+        third = self.checkout(token)
+
+        order = Order.objects.get(user=self.customer)
+        for response in (first, second, third):
+            self.assertRedirects(response, reverse('order_confirmation', args=[order.id]),
+                                 fetch_redirect_response=False)
+        self.assertEqual(Product.objects.get(pk=self.products[1].pk).stock, 8)
+        self.assertEqual(CheckoutSubmission.objects.get(token=token).order, order)
+
+    def test_failed_checkout_leaves_no_address_or_token_behind(self):
+        self.client.force_login(self.customer)
+        CartItem.objects.create(cart=Cart.objects.get(user=self.customer), product=self.products[1], quantity=1)
+        addresses = Address.objects.count()
+        token = str(uuid.uuid4())
+        with mock.patch.object(OrderItem.objects, 'bulk_create', side_effect=RuntimeError('boom')):
+            response = self.checkout(token)
+        self.assertRedirects(response, reverse('cart'), fetch_redirect_response=False)
+        self.assertEqual(Address.objects.count(), addresses)
+        self.assertFalse(CheckoutSubmission.objects.exists())
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(Task.objects.exists())
+
+    def test_cart_items_are_locked_and_priced_inside_the_order_transaction(self):
+        cart = Cart.objects.get(user=self.customer)
+        CartItem.objects.create(cart=cart, product=self.products[1], quantity=2)
+        with CaptureQueriesContext(connection) as queries, self.assertLogs('shop', 'INFO'):
+            place_order(CartItem.objects.filter(cart=cart), self.address, user_id=self.customer.pk, token=uuid.uuid4())
+        sql = [query['sql'] for query in queries]
+        claim = next(n for n, query in enumerate(sql) if 'ON CONFLICT' in query)
+        lock = next(n for n, query in enumerate(sql) if 'FOR UPDATE' in query)
+        self.assertLess(claim, lock)
+        self.assertIn('FOR UPDATE OF "shop_cartitem"', sql[lock])
+        self.assertEqual(Order.objects.get().total, Decimal('200'))
+
+        # A concurrent checkout took the items: nothing is written, the token included
+        with self.assertRaises(EmptyCart):
+            place_order(CartItem.objects.filter(cart=cart), self.address, user_id=self.customer.pk, token=uuid.uuid4())
+        self.assertEqual(CheckoutSubmission.objects.count(), 1)
+
+    def guest_with_cart(self):
+        client = Client()
+        client.get(reverse('cart'))  # starts the session and its cart
+        cart = Cart.objects.get(session_key=client.session.session_key)
+        CartItem.objects.create(cart=cart, product=self.products[1], quantity=1)
+        return client
+
+    def test_token_is_not_replayed_for_another_guest(self):
+        token = str(uuid.uuid4())
+        first = self.guest_with_cart()
+        self.checkout(token, first)
+        order = Order.objects.get()
+
+        # Another visitor holding the token gets an order of their own, not a view of the first one
+        other = self.guest_with_cart()
+        response = self.checkout(token, other)
+        placed = Order.objects.exclude(pk=order.pk).get()
+        self.assertRedirects(response, reverse('order_confirmation', args=[placed.id]),
+                             fetch_redirect_response=False)
+        self.assertEqual(other.session['guest_order_id'], placed.id)
+
+        # With an empty cart there is nothing to replay for them either
+        response = self.submit(token, other)
+        self.assertRedirects(response, reverse('cart'), fetch_redirect_response=False)
+        self.assertEqual(other.session['guest_order_id'], placed.id)
+        self.assertEqual(CheckoutSubmission.objects.get(token=token).order, order)
+
+        # The first guest still gets their order back
+        response = self.checkout(token, first)
+        self.assertRedirects(response, reverse('order_confirmation', args=[order.id]),
+                             fetch_redirect_response=False)
+
+    def test_token_is_not_replayed_for_another_user(self):
+        token = str(uuid.uuid4())
+        self.client.force_login(self.customer)
+        CartItem.objects.create(cart=Cart.objects.get(user=self.customer), product=self.products[1], quantity=1)
+        self.checkout(token)
+
+        other = User.objects.create_user('other', 'other@example.com', 'pass')
+        self.client.force_login(other)
+        response = self.submit(token)
+        self.assertRedirects(response, reverse('cart'), fetch_redirect_response=False)
+        CartItem.objects.create(cart=Cart.objects.get(user=other), product=self.products[1], quantity=1)
+        response = self.checkout(token)
+        placed = Order.objects.get(user=other)
+        self.assertRedirects(response, reverse('order_confirmation', args=[placed.id]),
+                             fetch_redirect_response=False)
+        self.assertEqual(CheckoutSubmission.objects.get(token=token).user, self.customer)
+
+
+class AddressFingerprintTests(OrderTestData):
+    def test_fingerprint_ignores_case_spacing_and_phone_punctuation(self):
+        other = Address(
+            full_name=' test  customer ', email='Customer@Example.com', street='1 street', city='LAHORE',
+            state='Punjab', postal_code='54000', country='Pakistan', phone='0300-123 4567', user=self.customer,
+        )
+        self.assertEqual(other.compute_fingerprint(), Address.objects.get(pk=self.address.pk).fingerprint)
+        other.street = '2 Street'
+        self.assertNotEqual(other.compute_fingerprint(), self.address.fingerprint)
+
+    def test_checkout_reuses_a_matching_saved_address(self):
+        self.client.force_login(self.customer)
+        CartItem.objects.create(cart=Cart.objects.get(user=self.customer), product=self.products[1], quantity=1)
+        with self.assertLogs('shop', 'INFO'):
+            self.client.post(reverse('checkout'), {
+                'full_name': 'TEST CUSTOMER', 'email': 'customer@example.com', 'street': '1 Street',
+                'city': 'Lahore', 'state': 'Punjab', 'postal_code': '54000', 'country': 'Pakistan',
+                'phone': '0300 1234567', 'save_address': 'on',
+            })
+        self.assertEqual(Order.objects.get(user=self.customer).delivery_address_id, self.address.pk)
+        self.assertEqual(Address.objects.count(), 1)
+
+    def test_dedupe_command_merges_and_repoints_orders(self):
+        self.create_orders(1)
+        duplicate = Address.objects.create(**{
+            field: getattr(self.address, field) for field in Address.FINGERPRINT_FIELDS
+        }, user=self.customer, is_default=True)
+        Address.objects.update(fingerprint='')  # rows from before the column existed
+
+        out = io.StringIO()
+        call_command('dedupe_addresses', batch_size=1, dry_run=True, stdout=out)
+        self.assertIn('Would merge 1 groups of duplicates: 1 addresses removed, 1 orders repointed', out.getvalue())
+        self.assertEqual(Address.objects.filter(fingerprint='').count(), 2)
+
+        out = io.StringIO()
+        call_command('dedupe_addresses', batch_size=1, stdout=out)
+        self.assertIn('1 addresses removed, 1 orders repointed', out.getvalue())
+        # The default address is the one kept
+        self.assertEqual(list(Address.objects.values_list('id', flat=True)), [duplicate.pk])
+        self.assertEqual(Order.objects.get().delivery_address_id, duplicate.pk)
+        self.assertEqual(Address.objects.get().fingerprint, self.address.fingerprint)
+
+
+class DefaultAddressTests(OrderTestData):
+    def setUp(self):
+        cache.clear()
+        self.other = Address.objects.create(**{
+            field: getattr(self.address, field) for field in Address.FINGERPRINT_FIELDS
+        } | {'street': '2 Street'}, user=self.customer, is_default=True)
+
+    def test_one_default_per_user(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Address.objects.filter(pk=self.address.pk).update(is_default=True)
+
+    def test_swap_is_one_statement_and_refreshes_the_cached_id(self):
+        self.assertEqual(Address.default_id_for(self.customer.pk), self.other.pk)
+        with self.assertNumQueries(0):
+            Address.default_id_for(self.customer.pk)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(Address.set_default(self.customer.pk, self.address.pk))
+        statements = [query['sql'] for query in queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), 1)  # inside the savepoint a retry needs
+        self.assertEqual(Address.default_id_for(self.customer.pk), self.address.pk)
+        self.assertEqual(list(Address.objects.filter(is_default=True).values_list('id', flat=True)), [self.address.pk])
+        # Someone else's address: nothing changes
+        self.assertFalse(Address.set_default(self.staff.pk, self.other.pk))
+        self.assertEqual(Address.default_id_for(self.customer.pk), self.address.pk)
+
+    def test_profile_and_checkout_use_the_new_default(self):
+        self.client.force_login(self.customer)
+        self.client.post(reverse('profile'), {'set_default_address_id': self.address.pk})
+        response = self.client.get(reverse('checkout'))
+        self.assertEqual(response.context['default_address'], self.address)
+        response = self.client.post(reverse('profile'), {'set_default_address_id': 'x'})
+        self.assertEqual([str(m) for m in get_messages(response.wsgi_request)], ['Address not found.'])
+
+    def address_form(self, address, **changes):
+        data = {field: getattr(address, field) for field in ('street', 'city', 'state', 'postal_code', 'country')}
+        return self.client.post(reverse('edit_address', args=[address.pk]), data | changes)
+
+    def test_unchecking_the_default_hands_it_over_or_clears_it(self):
+        self.client.force_login(self.customer)
+        self.address_form(self.other)
+        self.assertEqual(Address.default_id_for(self.customer.pk), self.address.pk)
+        # On the only address there is no one to hand it to: it is cleared
+        self.other.delete()
+        self.address_form(self.address)
+        self.assertFalse(Address.objects.filter(user=self.customer, is_default=True).exists())
+        self.assertIsNone(Address.default_id_for(self.customer.pk))
+
+    def test_lost_default_swap_is_reported_and_saves_nothing(self):
+        self.client.force_login(self.customer)
+        with mock.patch.object(Address, 'set_default', side_effect=IntegrityError):
+            response = self.address_form(self.address, city='Karachi', is_default='on')
+        self.assertRedirects(response, reverse('profile'), fetch_redirect_response=False)
+        self.assertEqual(
+            [str(m) for m in get_messages(response.wsgi_request)],
+            ["Your addresses were being changed elsewhere. Please try again."],
+        )
+        self.assertEqual(Address.objects.get(pk=self.address.pk).city, 'Lahore')
+
+
+class CatalogApiTests(OrderTestData):
+    def test_sparse_fieldset_loads_only_what_was_asked_for(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api_product_list'), {'fields': 'name,price,category'})
+        self.assertEqual(response.status_code, 200)
+        first = response.json()['results'][0]
+        self.assertEqual(set(first), {'id', 'name', 'price', 'category'})
+        self.assertEqual(first['category']['name'], 'Lamps')
+        # Versions, then rows with their category joined; no prefetches, no description
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('"shop_product"."description"', queries[1]['sql'])
+        with self.assertNumQueries(4):  # versions, rows, images, variants
+            self.client.get(reverse('api_product_list'), {'fields': 'name,images,variants'})
+        response = self.client.get(reverse('api_product_list'), {'fields': 'name,sold'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor_pagination(self):
+        response = self.client.get(reverse('api_product_list'), {'fields': 'name', 'page_size': 2})
+        page = response.json()
+        self.assertEqual([p['id'] for p in page['results']], [self.products[2].pk, self.products[1].pk])
+        page = self.client.get(page['next']).json()
+        self.assertEqual([p['id'] for p in page['results']], [self.products[0].pk])
+        self.assertIsNone(page['next'])
+
+    def test_bulk_fetch_keeps_the_requested_order(self):
+        ids = f'{self.products[1].pk},999999,{self.products[0].pk}'
+        with self.assertNumQueries(2):  # the products, then their images
+            response = self.client.get(reverse('api_product_list'), {'ids': ids, 'fields': 'name,images'})
+        body = response.json()
+        self.assertEqual([p['id'] for p in body['results']], [self.products[1].pk, self.products[0].pk])
+        self.assertEqual(body['missing'], [999999])
+        self.assertTrue(body['results'][0]['images'][0]['is_main'])
+        for ids in ['1,x', ','.join(map(str, range(1, 102)))]:
+            self.assertEqual(self.client.get(reverse('api_product_list'), {'ids': ids}).status_code, 400)
+
+    def test_etag_revalidation(self):
+        url = reverse('api_product_detail', args=[self.products[0].pk])
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertEqual(response.json()['variants'][0]['color'], 'Red')
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # A variant change bumps the product, even though the product row itself wasn't saved
+        ProductVariant.objects.filter(pk=self.variant.pk).first().save()
+        self.assertNotEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        etag = self.client.get(url)['ETag']
+        Category.objects.get(name='Lamps').save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        # ...but a field set without the category doesn't depend on it
+        etag = self.client.get(url, {'fields': 'name'})['ETag']
+        Category.objects.get(name='Lamps').save()
+        self.assertEqual(self.client.get(url, {'fields': 'name'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(reverse('api_product_detail', args=[999999])).status_code, 404)
+
+
+class AccountApiTests(OrderTestData):
+    def setUp(self):
+        response = self.client.post(
+            reverse('api_token'), {'username': 'customer', 'password': 'pass'}, content_type='application/json'
+        )
+        self.auth = {'HTTP_AUTHORIZATION': f"Bearer {response.json()['access']}"}
+
+    def api(self, method, name, data=None):
+        return getattr(self.client, method)(reverse(name), data, content_type='application/json', **self.auth)
+
+    def test_token_is_required_and_enough(self):
+        self.assertEqual(self.client.get(reverse('api_cart')).status_code, 401)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.api('get', 'api_cart')
+        self.assertEqual(response.json(), {'count': 0, 'total': '0', 'items': []})
+        tables = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('django_session', tables)
+        self.assertNotIn('auth_user', tables)
+        self.assertNotIn('sessionid', response.cookies)
+
+    def test_batched_cart_ops(self):
+        first, second, third = self.products
+        self.api('post', 'api_cart', {'ops': [{'op': 'add', 'product': third.pk}]})
+        response = self.api('post', 'api_cart', {'ops': [
+            {'op': 'add', 'product': first.pk, 'variant': self.variant.pk, 'quantity': 2},
+            {'op': 'add', 'product': second.pk},
+            {'op': 'add', 'product': second.pk},
+            {'op': 'remove', 'product': third.pk},
+        ]})
+        body = response.json()
+        self.assertEqual(body['count'], 4)
+        # Priced like checkout: the variant's additional price is included
+        self.assertEqual(body['total'], '410.00')
+        self.assertEqual([(i['product'], i['variant'], i['quantity']) for i in body['items']], [
+            (first.pk, self.variant.pk, 2), (second.pk, None, 2),
+        ])
+        self.assertEqual(CartItem.objects.filter(cart__user=self.customer).count(), 2)
+        body = self.api('post', 'api_cart', {'ops': [{'op': 'set', 'product': second.pk, 'quantity': 0}]}).json()
+        self.assertEqual(body['count'], 2)
+
+        response = self.api('post', 'api_cart', {'ops': [
+            {'op': 'add', 'product': second.pk},
+            {'op': 'add', 'product': second.pk, 'variant': self.variant.pk},
+            {'op': 'set', 'product': 999999, 'quantity': 1},
+        ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['ops']), {'1', '2'})
+        self.assertEqual(self.api('post', 'api_cart', {'ops': [{'op': 'set', 'product': first.pk}]}).status_code, 400)
+        self.assertEqual(self.api('delete', 'api_cart').json()['count'], 0)
+
+    def test_wishlist_batch(self):
+        first, second, third = self.products
+        with CaptureQueriesContext(connection) as queries:
+            body = self.api('post', 'api_wishlist', {'add': [first.pk, second.pk, third.pk]}).json()
+        self.assertEqual(body['count'], 3)
+        # The wishlist row is locked before its items are read, so concurrent adds can't both insert
+        wishlist_queries = [query['sql'] for query in queries if 'FROM "shop_wishlist"' in query['sql']]
+        self.assertIn('FOR UPDATE', wishlist_queries[0])
+        body = self.api('post', 'api_wishlist', {'add': [first.pk]}).json()
+        self.assertEqual(body['count'], 3)
+        body = self.api('post', 'api_wishlist', {'add': [first.pk], 'remove': [second.pk, third.pk]}).json()
+        self.assertEqual(body['products'], [first.pk])
+        self.assertEqual(
+            list(Product.objects.filter(pk__in=[first.pk, second.pk]).order_by('pk').values_list('wishlist_count', flat=True)),
+            [1, 0],
+        )
+        self.assertEqual(self.api('post', 'api_wishlist', {'add': [999999]}).status_code, 400)
+
+    def test_checkout_places_the_order_once(self):
+        self.api('post', 'api_cart', {'ops': [
+            {'op': 'add', 'product': self.products[0].pk, 'variant': self.variant.pk, 'quantity': 2},
+        ]})
+        token = str(uuid.uuid4())
+        self.assertEqual(self.api('post', 'api_checkout', {'token': token}).status_code, 400)
+        with self.assertLogs('shop', 'INFO'), self.captureOnCommitCallbacks(execute=True):
+            response = self.api('post', 'api_checkout', {'token': token, 'address_id': self.address.pk})
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get(pk=response.json()['order'])
+        self.assertEqual((order.user_id, order.delivery_address_id, order.total), (self.customer.pk, self.address.pk, Decimal('210')))
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock, 8)
+        self.assertEqual(Task.objects.filter(payload={'order_id': order.pk}).count(), 2)
+        # A retry gets the same order back
+        response = self.api('post', 'api_checkout', {'token': token, 'address_id': self.address.pk})
+        self.assertEqual((response.status_code, response.json()['order']), (200, order.pk))
+        self.assertEqual(self.api('post', 'api_checkout', {'token': str(uuid.uuid4()), 'address_id': self.address.pk}).status_code, 400)
+
+        self.api('post', 'api_cart', {'ops': [{'op': 'add', 'product': self.products[1].pk}]})
+        address = {field: getattr(self.address, field) for field in Address.FINGERPRINT_FIELDS}
+        with self.assertLogs('shop', 'INFO'):
+            response = self.api('post', 'api_checkout', {'token': str(uuid.uuid4()), 'address': address | {'street': '9 Street'}})
+        order = Order.objects.get(pk=response.json()['order'])
+        self.assertIsNone(order.delivery_address.user_id)  # not saved to the address book
+
+    def test_checkout_token_of_another_user_is_a_conflict(self):
+        token = uuid.uuid4()
+        other = User.objects.create_user('other', 'other@example.com', 'pass')
+        address = Address.objects.create(**{
+            field: getattr(self.address, field) for field in Address.FINGERPRINT_FIELDS
+        }, user=other)
+        order = Order.objects.create(user=other, delivery_address=address, total=Decimal('100'))
+        CheckoutSubmission.objects.create(token=token, user=other, order=order)
+
+        # Neither a retry with an empty cart nor a new checkout reveals their order
+        response = self.api('post', 'api_checkout', {'token': str(token), 'address_id': self.address.pk})
+        self.assertEqual(response.status_code, 400)
+        self.api('post', 'api_cart', {'ops': [{'op': 'add', 'product': self.products[1].pk}]})
+        response = self.api('post', 'api_checkout', {'token': str(token), 'address_id': self.address.pk})
+        self.assertEqual(response.status_code, 409)
+        self.assertNotIn('order', response.json())
+        self.assertFalse(Order.objects.filter(user=self.customer).exists())
+        self.assertEqual(CartItem.objects.filter(cart__user=self.customer).count(), 1)
+
+
+class RequestMetricsTests(OrderTestData):
+    @override_settings(REQUEST_METRICS_SERVER_TIMING=True)
+    def test_metrics_are_logged_and_sent_as_server_timing(self):
+        with self.assertLogs('shop.metrics', 'INFO') as logs:
+            response = self.client.get(reverse('home'))
+        metrics = logs.records[-1].metrics
+        self.assertEqual(metrics['view'], 'home')
+        self.assertGreater(metrics['queries'], 0)
+        self.assertGreater(metrics['template_ms'], 0)
+        # Timed by the template backend, not by patching Django's Template class
+        self.assertEqual(DjangoTemplate.render.__module__, 'django.template.backends.django')
+        self.assertIn(f'db;dur={metrics["db_ms"]};desc="{metrics["queries"]} queries"', response['Server-Timing'])
+
+    @override_settings(REQUEST_METRICS_DUPLICATE_THRESHOLD=2)
+    def test_repeated_queries_are_reported(self):
+        self.client.force_login(self.customer)
+        # The cart view and the header's cart count each look the cart up
+        with self.assertLogs('shop.metrics', 'WARNING') as logs:
+            self.client.get(reverse('cart'))
+        self.assertIn('duplicate_queries', logs.records[0].metrics)
+
+    @override_settings(QUERY_BUDGETS={'home': 1})
+    def test_budget_overrun_fails_in_strict_mode(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get(reverse('home'))
+
+    @override_settings(QUERY_BUDGETS={'home': 1, ('home', 'GET'): 50, ('home', 'POST'): 0})
+    def test_method_budget_takes_precedence(self):
+        self.assertEqual(self.client.get(reverse('home')).status_code, 200)
+
+
+    @override_settings(QUERY_BUDGETS={'export_orders': 2})
+    def test_streamed_queries_count_towards_the_budget(self):
+        self.create_orders(1)
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('export_orders'))
+        with self.assertLogs('shop.metrics', 'INFO') as logs, self.assertRaises(QueryBudgetExceeded):
+            b''.join(response.streaming_content)
+        self.assertEqual(logs.records[-1].metrics['view'], 'export_orders')
+
+
+class BenchmarkTests(TestCase):
+    counts = {
+        'categories': 2, 'brands': 2, 'tags': 3, 'products': 6, 'users': 3, 'orders': 5, 'reviews': 4, 'wishlists': 2,
+    }
+
+    def test_generated_data_is_deterministic(self):
+        def order_ages():
+            # Relative to when the data was generated, so comparable between runs
+            created = list(Order.objects.order_by('id').values_list('created_at', flat=True))
+            return [max(created) - stamp for stamp in created]
+
+        generate_bench_data(self.counts, seed=7)
+        first = list(Product.objects.order_by('slug').values_list('name', 'price', 'category__slug'))
+        first_ages = order_ages()
+        flush_bench_data()
+        self.assertFalse(Product.objects.exists())
+        generate_bench_data(self.counts, seed=7)
+        self.assertEqual(list(Product.objects.order_by('slug').values_list('name', 'price', 'category__slug')), first)
+        self.assertEqual(Order.objects.count(), 5)
+        self.assertEqual(order_ages(), first_ages)
+
+    def test_checkout_submit_places_an_order_per_iteration(self):
+        generate_bench_data(self.counts)
+        Product.objects.update(stock=100)
+        before = Order.objects.count()
+        result = ClientDriver(iterations=2, warmup=0).run(select_scenarios(['checkout_submit'])[0], benchmark_context())
+        self.assertEqual((result['requests'], result['errors']), (2, 0))
+        self.assertEqual(Order.objects.count(), before + 2)
+        self.assertEqual(CheckoutSubmission.objects.filter(order__isnull=False).count(), 2)
+
+    def test_client_driver_reports_latency_and_queries(self):
+        generate_bench_data(self.counts)
+        scenarios = select_scenarios(['home', 'autocomplete'])
+        results = {'scenarios': {
+            scenario.name: ClientDriver(iterations=3, warmup=1).run(scenario, benchmark_context())
+            for scenario in scenarios
+        }}
+        home = results['scenarios']['home_anonymous']
+        self.assertEqual((home['requests'], home['errors']), (3, 0))
+        self.assertLessEqual(home['p50_ms'], home['p99_ms'])
+        self.assertLessEqual(results['scenarios']['autocomplete']['queries_max'], 1)  # cached per prefix
+        self.assertGreater(results['scenarios']['home_customer']['queries_max'], home['queries_max'])
+
+        baseline = json.loads(json.dumps(results))
+        baseline['scenarios']['autocomplete']['queries_max'] = -1
+        _, regressions = compare(results, baseline, tolerance=1000)
+        self.assertEqual(regressions, ['autocomplete'])
+
+
+class StructuredLoggingTests(TestCase):
+    def test_background_handler_writes_json_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'shop.log')
+            handler = BackgroundHandler(filename=filename)
+            logger = logging.getLogger('shop.tests.background')
+            logger.addHandler(handler)
+            logger.propagate = False
+            try:
+                logger.warning("Order %s placed", 7, extra={'checkout': {'order_id': 7, 'total': Decimal('9.50')}})
+                try:
+                    raise ValueError('boom')
+                except ValueError:
+                    logger.exception("Checkout failed")
+            finally:
+                logger.removeHandler(handler)
+                logger.propagate = True
+                handler.flush_and_stop()
+                handler.target.close()
+            with open(filename, encoding='utf-8') as log_file:
+                placed, failed = [json.loads(line) for line in log_file]
+        self.assertEqual(placed['message'], 'Order 7 placed')
+        self.assertEqual(placed['checkout'], {'order_id': 7, 'total': '9.50'})
+        self.assertEqual(failed['level'], 'ERROR')
+        self.assertIn('ValueError: boom', failed['exception'])
+
+    def test_forked_child_gets_its_own_queue_and_listener(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'shop.log')
+            handler = BackgroundHandler(filename=filename)
+            try:
+                handler.handle(logging.makeLogRecord({'msg': 'parent', 'levelno': logging.INFO}))
+                parent_queue, parent_listener = handler.queue, handler.listener
+                logs._reset_after_fork()  # what os.fork() runs in the child
+                self.assertIsNone(handler.listener)
+                self.assertIsNot(handler.queue, parent_queue)
+                handler.handle(logging.makeLogRecord({'msg': 'child', 'levelno': logging.INFO}))
+                self.assertIsNot(handler.listener, parent_listener)
+                self.assertIs(handler.listener.queue, handler.queue)
+                parent_listener.stop()
+            finally:
+                handler.flush_and_stop()
+                handler.target.close()
+            with open(filename, encoding='utf-8') as log_file:
+                messages = sorted(json.loads(line)['message'] for line in log_file)
+        self.assertEqual(messages, ['child', 'parent'])
+
+    def test_sampling_only_drops_debug_records(self):
+        never = SampleFilter(rate=0)
+        debug = logging.makeLogRecord({'levelno': logging.DEBUG})
+        info = logging.makeLogRecord({'levelno': logging.INFO})
+        self.assertFalse(never.filter(debug))
+        self.assertTrue(never.filter(info))
+        self.assertTrue(SampleFilter(rate=1).filter(debug))
+
+
+class AdminChangelistQueryTests(OrderTestData):
+    def setUp(self):
+        cache.clear()
+        self.staff.is_superuser = True
+        self.staff.save()
+        self.client.force_login(self.staff)
+
+    def test_order_changelist_query_count_is_bounded(self):
+        url = reverse('admin:shop_order_changelist')
+        self.create_orders(2)
+        self.client.get(url)  # warm the cached city lookup
+        with self.assertNumQueries(12) as first:
+            self.client.get(url)
+        self.create_orders(8)
+        with self.assertNumQueries(len(first.captured_queries)):
+            response = self.client.get(url)
+        self.assertContains(response, 'Lahore')
+
+    def test_city_lookup_cache_is_cleared_on_address_save(self):
+        url = reverse('admin:shop_address_changelist')
+        self.assertNotContains(self.client.get(url), 'Karachi')
+        self.address.city = 'Karachi'
+        self.address.save()
+        self.assertContains(self.client.get(url), 'Karachi')
+
+    def test_catalog_deletes_update_wishlist_counts_once(self):
+        wishlist = Wishlist.objects.get(user=self.customer)
+        for product in self.products:
+            WishlistItem.objects.create(wishlist=wishlist, product=product)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('admin:shop_product_changelist'), {
+                'action': 'delete_selected', '_selected_action': [p.pk for p in self.products[:2]], 'post': 'yes',
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(Product.objects.values_list('pk', flat=True)), [self.products[2].pk])
+        counter_updates = [query['sql'] for query in queries if '"wishlist_count"' in query['sql'] and query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(counter_updates), 1)
+
+        # Products that stay get the collected change
+        other = User.objects.create_user('other', 'other@example.com', 'pass')
+        WishlistItem.objects.create(wishlist=Wishlist.objects.get(user=other), product=self.products[2])
+        self.assertEqual(Product.objects.get(pk=self.products[2].pk).wishlist_count, 2)
+        with batched_wishlist_changes():
+            WishlistItem.objects.filter(product=self.products[2]).delete()
+        self.assertEqual(Product.objects.get(pk=self.products[2].pk).wishlist_count, 0)
+
+    def test_review_changelist_selects_related(self):
+        url = reverse('admin:shop_review_changelist')
+        for n, product in enumerate(self.products[:2]):
+            Review.objects.create(product=product, user=self.customer, rating=n + 1, comment='Good')
+        with self.assertNumQueries(10) as first:
+            self.client.get(url)
+        Review.objects.create(product=self.products[2], user=self.customer, rating=5, comment='Great')
+        with self.assertNumQueries(len(first.captured_queries)):
+            self.client.get(url)
+
+
+class ProductImportTests(TestCase):
+    FEED = (
+        'name,slug,price,stock,category,brand,tags,variants\n'
+        'Desk Lamp,,120.00,5,Lamps,Lumo,desk|led,"[{""sku"": ""DL-1"", ""color"": ""Black""}]"\n'
+        'Floor Lamp,floor-lamp,250,2,Lamps,Lumo,,\n'
+        'Broken,,not-a-price,1,Lamps,,,\n'
+    )
+
+    def run_import(self, feed):
+        return ProductImporter(batch_size=2, download_images=False).run(io.StringIO(feed), 'csv')
+
+    def test_import_creates_products_and_taxonomy(self):
+        stats = self.run_import(self.FEED)
+
+        self.assertEqual((stats.rows, stats.products, stats.variants, stats.error_count), (3, 2, 1, 1))
+        lamp = Product.objects.get(slug='desk-lamp')
+        self.assertEqual(lamp.category.slug, 'lamps')
+        self.assertEqual(lamp.brand.name, 'Lumo')
+        self.assertEqual(sorted(lamp.tags.values_list('slug', flat=True)), ['desk', 'led'])
+        self.assertEqual(lamp.variants.get().sku, 'DL-1')
+
+    def test_reimport_updates_in_place(self):
+        self.run_import(self.FEED)
+        self.run_import(self.FEED.replace('120.00', '99.00').replace('""Black""', '""White""'))
+
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(Category.objects.count(), 1)
+        self.assertEqual(Product.objects.get(slug='desk-lamp').price, Decimal('99.00'))
+        self.assertEqual(ProductVariant.objects.get(sku='DL-1').color, 'White')
+
+    def test_malformed_jsonl_rows_are_reported_not_fatal(self):
+        feed = '\n'.join([
+            '[1, 2]',
+            '"x"',
+            '{"name": 5, "price": 1, "category": "Lamps"}',
+            '{"name": "Lamp", "price": 1, "category": "Lamps", "variants": [1]}',
+            '{"name": "Lamp", "price": 1, "category": "Lamps", "variants": {"sku": "A"}}',
+            '{"name": "Lamp", "price": 1, "category": ["Lamps"]}',
+            '{"name": "Good Lamp", "price": 1, "category": "Lamps"}',
+        ])
+        stats = ProductImporter(batch_size=2, download_images=False).run(io.StringIO(feed), 'jsonl')
+        self.assertEqual((stats.rows, stats.products, stats.error_count), (7, 1, 6))
+        self.assertTrue(Product.objects.filter(slug='good-lamp').exists())
+
+    def test_values_the_columns_cannot_store_are_bad_rows(self):
+        rows = [
+            {'price': 'NaN'}, {'price': 'Infinity'}, {'price': '-1'}, {'price': '123456789.00'}, {'price': '1.005'},
+            {'discount_price': '-5'}, {'stock': 2 ** 40}, {'name': 'x' * 201}, {'category': 'c' * 101},
+            {'brand': 'b' * 101}, {'tags': ['t' * 51]}, {'weight': 'w' * 21},
+            {'variants': [{'sku': 's' * 65}]}, {'variants': [{'sku': 'A', 'color': 'c' * 51}]},
+            {'variants': [{'sku': 'A', 'additional_price': 'NaN'}]},
+        ]
+        base = {'name': 'Lamp', 'price': '10', 'category': 'Lamps'}
+        feed = '\n'.join(json.dumps(base | row) for row in rows + [{'name': 'Good Lamp'}])
+        stats = ProductImporter(batch_size=2, download_images=False).run(io.StringIO(feed), 'jsonl')
+        self.assertEqual((stats.rows, stats.products, stats.error_count), (len(rows) + 1, 1, len(rows)))
+        self.assertIn('line 1: price is not a number', stats.errors[0])
+        self.assertTrue(Product.objects.filter(slug='good-lamp').exists())
+
+    def test_admin_upload_reports_an_unreadable_feed(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pass'))
+        url = reverse('admin:shop_product_import')
+        feed = SimpleUploadedFile('feed.csv', 'name,price,category\nLampe à poser,10,Lampes\n'.encode('latin-1'))
+        response = self.client.post(url, {'feed': feed, 'format': 'csv'})
+        self.assertContains(response, 'The feed could not be read: it is not UTF-8 text.')
+        self.assertFalse(Product.objects.exists())
+
+        feed = SimpleUploadedFile('feed.csv', self.FEED.encode())
+        response = self.client.post(url, {'feed': feed})
+        self.assertRedirects(response, reverse('admin:shop_product_changelist'), fetch_redirect_response=False)
+        self.assertEqual(Product.objects.count(), 2)
+
+    def test_database_errors_skip_the_batch_not_the_import(self):
+        feed = self.FEED + 'Third Lamp,,10,1,Lamps,,,\n'
+        import_batch = ProductImporter.import_batch
+        calls = []
+
+        def failing_first(importer, rows):
+            calls.append(rows)
+            if len(calls) == 1:
+                Product.objects.create(name='x', slug='x', description='', price=1, stock=-1, category_id=0)
+            return import_batch(importer, rows)
+
+        with mock.patch.object(ProductImporter, 'import_batch', failing_first):
+            stats = self.run_import(feed)
+        self.assertEqual(stats.error_count, 2)
+        self.assertIn('line 2-3: batch not imported', stats.errors[0])
+        self.assertEqual(list(Product.objects.values_list('slug', flat=True)), ['third-lamp'])
+
+
+class SlugAllocationTests(TestCase):
+    def test_duplicate_names_get_numbered_slugs(self):
+        category = Category.objects.create(name='Lamps')
+        Category.objects.create(name='Lamps 5')
+        with self.assertNumQueries(4):  # aggregate, savepoint, insert, release
+            second = Category.objects.create(name='Lamps')
+        third = Category.objects.create(name='Lamps')
+        self.assertEqual([category.slug, second.slug, third.slug], ['lamps', 'lamps-6', 'lamps-7'])
+
+    def test_long_names_are_trimmed_to_fit(self):
+        name = 'Very long product name ' * 5
+        category = Category.objects.create(name='Lamps')
+        first, second = [
+            Product.objects.create(name=name, description='', price=1, stock=1, category=category)
+            for _ in range(2)
+        ]
+        self.assertEqual(len(first.slug), 50)
+        self.assertNotEqual(first.slug, second.slug)
+        self.assertLessEqual(len(second.slug), 50)
+
+    def test_bulk_allocation_uses_one_query(self):
+        Brand.objects.create(name='Lumo')
+        brands = [Brand(name='Lumo!'), Brand(name='lumo.'), Brand(name='Halo')]
+        with self.assertNumQueries(1):
+            allocate_slugs(Brand, brands)
+        self.assertEqual([brand.slug for brand in brands], ['lumo-2', 'lumo-3', 'halo'])
+        Brand.objects.bulk_create(brands)
+
+    def test_bulk_allocation_skips_bare_bases_that_look_numbered(self):
+        Brand.objects.create(name='Acme')
+        brands = [Brand(name='Acme 2'), Brand(name='acme!')]
+        allocate_slugs(Brand, brands)
+        self.assertEqual([brand.slug for brand in brands], ['acme-2', 'acme-3'])
+        Brand.objects.bulk_create(brands)
+
+
+class CachingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_cache_stats()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return ['value', self.calls]
+
+    def test_value_is_computed_once_until_invalidated(self):
+        self.assertEqual(get_or_compute(Product, 'rail', self.compute), ['value', 1])
+        self.assertEqual(get_or_compute(Product, 'rail', self.compute), ['value', 1])
+        invalidate(Product)
+        self.assertEqual(get_or_compute(Product, 'rail', self.compute), ['value', 2])
+        # Other namespaces are unaffected
+        get_or_compute(Category, 'rail', self.compute)
+        invalidate(Product)
+        self.assertEqual(get_or_compute(Category, 'rail', self.compute), ['value', 3])
+        self.assertEqual(cache_stats()['hits'], 2)
+        self.assertEqual(cache_stats()['misses'], 3)
+
+    def test_catalog_saves_invalidate_namespace(self):
+        get_or_compute(Category, 'all', self.compute)
+        Category.objects.create(name='Lamps')
+        get_or_compute(Category, 'all', self.compute)
+        self.assertEqual(self.calls, 2)
+
+    def test_lost_generation_does_not_bring_back_old_keys(self):
+        get_or_compute(Product, 'rail', self.compute)
+        invalidate(Product)
+        get_or_compute(Product, 'rail', self.compute)
+        # As if the counter had been culled: starting over from the first generation would serve ['value', 1]
+        cache.delete('shop:shop.product:generation')
+        self.assertEqual(get_or_compute(Product, 'rail', self.compute), ['value', 3])
+
+    def test_product_saves_invalidate_only_when_cached_fields_change(self):
+        product = Product.objects.create(
+            name='Lamp', description='Lamp', price=Decimal('100'), category=Category.objects.create(name='Lamps'), stock=1
+        )
+        get_or_compute(Product, 'rail', self.compute)
+        product.view_count += 1
+        product.save()
+        Product.objects.get(pk=product.pk).save()  # e.g. the review form's save
+        get_or_compute(Product, 'rail', self.compute)
+        self.assertEqual(self.calls, 1)
+
+        product.discount_price = Decimal('90')
+        product.save()
+        get_or_compute(Product, 'rail', self.compute)
+        product.delete()
+        get_or_compute(Product, 'rail', self.compute)
+        self.assertEqual(self.calls, 3)
+
+
+@skipUnless('replica' in settings.DATABASES, "set DB_REPLICA_HOST to test replica routing")
+class ReplicaRoutingTests(TransactionTestCase):
+    # Committed rows, so the replica connection (a mirror of the test database) sees them;
+    # a TestCase's transaction would keep every read on the primary
+    databases = set(settings.DATABASES) & {'default', 'replica'}
+
+    def setUp(self):
+        self.customer = User.objects.create_user('customer', 'customer@example.com', 'pass')
+        self.product = Product.objects.create(
+            name='Lamp', description='Lamp', price=Decimal('100'), category=Category.objects.create(name='Lamps'),
+            stock=10,
+        )
+        reset_replica_health()
+
+    def test_catalog_reads_use_replica_until_a_write(self):
+        with primary_pin(False):
+            self.assertEqual(Product.objects.all().db, 'replica')
+            self.assertEqual(Order.objects.all().db, 'default')
+            Product.objects.filter(pk=self.product.pk).update(stock=5)
+            self.assertEqual(Product.objects.all().db, 'default')
+
+    def test_writes_outside_a_request_do_not_pin(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=5)
+        self.assertEqual(Product.objects.all().db, 'replica')
+
+    def test_reads_in_a_transaction_use_the_primary(self):
+        with transaction.atomic():
+            self.assertEqual(Product.objects.all().db, 'default')
+
+    def test_reporting_reads_use_replica(self):
+        with replica_reads():
+            self.assertEqual(Order.objects.all().db, 'replica')
+
+    def test_writes_pin_the_client_to_the_primary(self):
+        self.client.force_login(self.customer)
+        response = self.client.post(reverse('add_to_cart', args=[self.product.id]), {'quantity': 1})
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+    @override_settings(REPLICA_MAX_LAG_SECONDS=-1)
+    def test_lagging_replica_falls_back_to_primary(self):
+        self.assertEqual(Product.objects.all().db, 'default')
@@ -1,5 +1,6 @@
 from django.urls import path
-from . import views
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from . import api, views
 from .views import * 
 
 urlpatterns = [
@@ -16,6 +17,7 @@ urlpatterns = [
     path('checkout/', views.CheckoutView.as_view(), name='checkout'),
     path('order/confirmation/<int:order_id>/', views.OrderConfirmationView.as_view(), name='order_confirmation'),
     path('order/<int:order_id>/', views.OrderDetailView.as_view(), name='order_detail'),
+    path('order/<int:order_id>/tracking/', views.OrderTrackingView.as_view(), name='order_tracking'),
     path("logout/", views.logout_view, name="logout_view"),
     path('search/', views.search_view, name='search'),
     path('autocomplete/', views.autocomplete, name='autocomplete'),
@@ -45,15 +47,31 @@ urlpatterns = [
     
     # API URLs
     path('api/header-counts/', views.header_counts_api, name='header_counts_api'),
+    path('api/header-counts/stream/', views.header_counts_stream, name='header_counts_stream'),
+    path('api/v1/products/', api.ProductViewSet.as_view({'get': 'list'}), name='api_product_list'),
+    path('api/v1/products/<int:pk>/', api.ProductViewSet.as_view({'get': 'retrieve'}), name='api_product_detail'),
+    path('api/v1/categories/', api.CategoryViewSet.as_view({'get': 'list'}), name='api_category_list'),
+    path('api/v1/categories/<int:pk>/', api.CategoryViewSet.as_view({'get': 'retrieve'}), name='api_category_detail'),
+    path('api/v1/brands/', api.BrandViewSet.as_view({'get': 'list'}), name='api_brand_list'),
+    path('api/v1/brands/<int:pk>/', api.BrandViewSet.as_view({'get': 'retrieve'}), name='api_brand_detail'),
+    path('api/v1/token/', TokenObtainPairView.as_view(), name='api_token'),
+    path('api/v1/token/refresh/', TokenRefreshView.as_view(), name='api_token_refresh'),
+    path('api/v1/cart/', api.CartView.as_view(), name='api_cart'),
+    path('api/v1/wishlist/', api.WishlistView.as_view(), name='api_wishlist'),
+    path('api/v1/checkout/', api.CheckoutView.as_view(), name='api_checkout'),
+    path('api/v1/orders/bulk-status/', api.OrderStatusBulkView.as_view(), name='api_order_bulk_status'),
     
 
     # DASBOARD
     path('dashboard/', admin_dashboard, name='dashboard'),
+    path('dashboard/cache-stats/', views.cache_stats_api, name='cache_stats'),
     path("products-listing/", views.product_list, name="product_list"),
     
     
     # Order Management
     path('orders/', views.order_list, name='order_list'),
+    path('orders/export/', views.export_orders, name='export_orders'),
+    path('orders/bulk-update-status/', views.bulk_update_order_status, name='bulk_update_order_status'),
     path('orders/<int:order_id>/update-status/', views.update_order_status, name='update_order_status'),
     path('orders/<int:order_id>/cancel/', views.cancel_order, name='cancel_order'),
     
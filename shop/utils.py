@@ -1,9 +1,22 @@
 from decimal import Decimal
-from .models import Cart
+from .caching import get_or_compute, invalidate
+from .models import Cart, Address
+
+ADDRESS_CITIES_CACHE_TIMEOUT = 60 * 60
 
 def calculate_total(cart_items):
     return sum(
         item.product.price * item.quantity
         for item in cart_items
         if item.product and item.product.price
-    )
\ No newline at end of file
+    )
+
+def get_address_cities():
+    """Distinct, sorted address cities. Cached; cleared whenever an Address is saved or deleted."""
+    return get_or_compute(Address, 'cities', lambda: [
+        city for city in Address.objects.order_by('city').values_list('city', flat=True).distinct()
+        if city
+    ], ADDRESS_CITIES_CACHE_TIMEOUT)
+
+def clear_address_cities():
+    invalidate(Address)
@@ -1,11 +1,11 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.core.paginator import Paginator
 from django.db.models import Case, When, F, DecimalField, Q, Sum, Count, Prefetch, Avg
 from .models import *
 from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required, user_passes_test
 from .forms import CustomUserCreationForm, CustomAuthenticationForm, AddressForm
-from django.http import JsonResponse
+from django.http import JsonResponse, Http404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 import logging
@@ -13,7 +13,9 @@ from django.views.decorators.http import require_POST
 from django.contrib import messages
 from django.db import transaction
 from django.forms.models import model_to_dict
+import hashlib
 import json
+import re
 from django.views import View
 from django.contrib.auth import get_user_model
 from decimal import Decimal, InvalidOperation
@@ -24,12 +26,35 @@ from datetime import timedelta
 from django.conf import settings
 from django.db import IntegrityError
 from django.views.decorators.http import require_GET
+from django.db.models.functions import Lower, Coalesce, NullIf
+from django.db.models import ExpressionWrapper, OuterRef, Subquery, Value
+from django.core.files.storage import default_storage
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connections
+from asgiref.sync import sync_to_async
+import time
+import uuid
+from .caching import aget_or_compute, cache_stats, generation, get_or_compute
+from .checkout import EmptyCart, TokenInUse, place_order
+from .db_routers import replica_reads
+from .live_counts import counts_channel, hub, publish_counts_changed
+from .order_export import CONTENT_TYPES, EXPORT_FORMATS, export_lines, export_rows, parse_export_date
 
 User = get_user_model()
 
 logger = logging.getLogger(__name__)
 
+AUTOCOMPLETE_TIMEOUT = 300
+
 # ========== UTILITY FUNCTIONS ==========
+def checkout_token(value):
+    """The checkout form's idempotency token as a UUID, or None if missing or malformed"""
+    try:
+        return uuid.UUID(value)
+    except (TypeError, ValueError):
+        return None
+
 def get_cart(request):
     """Get or create cart for user or session"""
     if request.user.is_authenticated:
@@ -66,6 +91,46 @@ def get_user_wishlist(user):
     wishlist_obj, _ = Wishlist.objects.get_or_create(user=user)
     return wishlist_obj
 
+async def aget_cart(request):
+    """get_cart() for async views"""
+    user = await request.auser()
+    if user.is_authenticated:
+        cart, _ = await Cart.objects.aget_or_create(user=user)
+    else:
+        if not request.session.session_key:
+            await request.session.acreate()
+        cart, _ = await Cart.objects.aget_or_create(session_key=request.session.session_key)
+    return cart
+
+async def acart_count(cart_items):
+    """Total quantity of the given cart items, summed in the database"""
+    totals = await cart_items.aaggregate(count=Coalesce(Sum('quantity'), 0))
+    return totals['count']
+
+async def aheader_counts(user, session):
+    """Cart and wishlist counts for the header; a guest without a session has neither"""
+    if user.is_authenticated:
+        return {
+            'cart_count': await acart_count(CartItem.objects.filter(cart__user=user)),
+            'wishlist_count': await WishlistItem.objects.filter(wishlist__user=user).acount(),
+        }
+    if not session.session_key:
+        return {'cart_count': 0, 'wishlist_count': 0}
+    return {
+        'cart_count': await acart_count(CartItem.objects.filter(cart__session_key=session.session_key)),
+        'wishlist_count': len(await session.aget('wishlist', [])),
+    }
+
+def release_connections():
+    """Close this thread's connections, unless one is inside a transaction"""
+    for connection in connections.all(initialized_only=True):
+        if not connection.in_atomic_block:
+            connection.close()
+
+def notify_cart_streams(cart):
+    """For changes that bypass CartItem signals (queryset updates in the async views)"""
+    hub.publish(counts_channel(cart.user_id, cart.session_key))
+
 # ========== CONTEXT PROCESSORS ==========
 def cart_count(request):
     """Returns the number of items in the user's cart."""
@@ -76,76 +141,70 @@ def wishlist_count_processor(request):
     return {'wishlist_count': get_wishlist_count(request)}
 
 # ========== API ENDPOINTS ==========
-# shop/views.py - Update the header_counts_api function
-
 @require_GET
 @csrf_exempt
-def header_counts_api(request):
-    """API endpoint to get cart and wishlist counts for the header"""
+async def header_counts_api(request):
+    """API endpoint to get cart and wishlist counts for the header (async: polled by every open tab)"""
     try:
-        # Initialize counts
-        cart_count = 0
-        wishlist_count = 0
-        
-        # Get cart count
-        if request.user.is_authenticated:
-            # For logged-in users
-            try:
-                cart = Cart.objects.get(user=request.user)
-                cart_items = CartItem.objects.filter(cart=cart)
-                cart_count = sum(item.quantity for item in cart_items)
-            except Cart.DoesNotExist:
-                cart_count = 0
-            
-            # Get wishlist count for logged-in users
-            try:
-                wishlist = Wishlist.objects.get(user=request.user)
-                wishlist_count = WishlistItem.objects.filter(wishlist=wishlist).count()
-            except Wishlist.DoesNotExist:
-                wishlist_count = 0
-        else:
-            # For guest users - use session
-            session_key = request.session.session_key
-            
-            # Ensure session exists
-            if not session_key:
-                request.session.create()
-                session_key = request.session.session_key
-                request.session.save()
-            
-            # Get cart count from session cart
-            try:
-                cart = Cart.objects.get(session_key=session_key)
-                cart_items = CartItem.objects.filter(cart=cart)
-                cart_count = sum(item.quantity for item in cart_items)
-            except Cart.DoesNotExist:
-                cart_count = 0
-            
-            # Get wishlist count from session
-            session_wishlist = request.session.get('wishlist', [])
-            wishlist_count = len(session_wishlist)
-        
-        return JsonResponse({
-            'success': True,
-            'cart_count': cart_count,
-            'wishlist_count': wishlist_count
-        })
-        
+        # No session yet means no cart either; don't create one just to answer a poll
+        counts = await aheader_counts(await request.auser(), request.session)
+        return JsonResponse({'success': True, **counts})
+
     except Exception as e:
-        # Log the error
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"Error in header_counts_api: {str(e)}")
-        print(f"Traceback: {error_details}")
-        
+        logger.exception("Error in header_counts_api: %s", e)
+
         # Return safe default values
         return JsonResponse({
             'success': False,
-            'error': 'Internal server error',
             'cart_count': 0,
             'wishlist_count': 0
         }, status=500)
-    
+
+@require_GET
+async def header_counts_stream(request):
+    """
+    Server-Sent Events: a 'counts' event with the header counts now and
+    whenever a cart or wishlist change is published for this visitor. Only
+    served under ASGI (under WSGI each open stream would hold a worker);
+    otherwise, or for a visitor without a session, it answers 204, which
+    tells EventSource to stop and base.html to keep polling.
+    """
+    user = await request.auser()
+    channel = counts_channel(user.pk, request.session.session_key)
+    if not isinstance(request, ASGIRequest) or channel is None:
+        return HttpResponse(status=204)
+
+    heartbeat = getattr(settings, 'LIVE_COUNTS_HEARTBEAT_SECONDS', 20)
+    recheck = getattr(settings, 'LIVE_COUNTS_RECHECK_SECONDS', 120)
+    session_class, session_key = request.session.__class__, request.session.session_key
+
+    async def events():
+        subscription = hub.subscribe(channel)
+        try:
+            yield f'retry: {heartbeat * 1000}\n\n'
+            last, last_checked = None, 0.0
+            while True:
+                # Fresh session each time: the guest wishlist lives in the session, changed by other requests
+                counts = await aheader_counts(user, session_class(session_key))
+                last_checked = time.monotonic()
+                # Don't keep a database connection for every open stream
+                await sync_to_async(release_connections)()
+                if counts != last:
+                    yield f'event: counts\ndata: {json.dumps(counts)}\n\n'
+                    last = counts
+                # Wait for a change, with comment heartbeats to keep proxies from closing the connection
+                while not await subscription.wait(heartbeat):
+                    yield ': keep-alive\n\n'
+                    if time.monotonic() - last_checked >= recheck:
+                        break
+        finally:
+            hub.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx: don't buffer the stream
+    return response
+
 # ========== VIEWS ==========
 
 def search_view(request):
@@ -181,12 +240,16 @@ def search_view(request):
         'wishlist_product_ids': list(wishlist_product_ids)  # Convert to list
     })
 
-def autocomplete(request):
+async def autocomplete(request):
     query = request.GET.get('term', '')
-    suggestions = Product.objects.filter(
-        Q(name__istartswith=query)
-    ).values_list('name', flat=True)[:5]
-    return JsonResponse(list(suggestions), safe=False)
+
+    async def suggestions():
+        names = Product.objects.filter(Q(name__istartswith=query)).values_list('name', flat=True)[:5]
+        return [name async for name in names]
+
+    # Matching is case-insensitive, so every casing of a prefix shares one entry
+    key = 'autocomplete:' + hashlib.md5(query.lower().encode()).hexdigest()
+    return JsonResponse(await aget_or_compute(Product, key, suggestions, AUTOCOMPLETE_TIMEOUT), safe=False)
 
 @login_required
 def change_password(request):
@@ -210,7 +273,9 @@ def change_password(request):
 class CheckoutView(View):
     def get(self, request):
         user = request.user if request.user.is_authenticated else None
-        default_address = Address.objects.filter(user=user, is_default=True).first() if user else None
+        # Cached id, then a primary key lookup
+        default_id = Address.default_id_for(user.pk) if user else None
+        default_address = Address.objects.filter(pk=default_id, user=user).first() if default_id else None
         
         form = AddressForm(instance=default_address)
         
@@ -222,13 +287,11 @@ class CheckoutView(View):
             'form': form,
             'cart_items': cart_items,
             'total': total,
-            'default_address': default_address
+            'default_address': default_address,
+            'checkout_token': uuid.uuid4(),
         })
 
     def post(self, request):
-        print("\n=== CHECKOUT DEBUG START ===")
-        print(f"User: {request.user if request.user.is_authenticated else 'Guest'}")
-        
         user = request.user if request.user.is_authenticated else None
         save_address = request.POST.get("save_address")
         
@@ -242,27 +305,32 @@ class CheckoutView(View):
         country = request.POST.get('country')
         phone = request.POST.get('phone')
         
-        # Debug address fields
-        print(f"\nAddress fields:")
-        print(f"Full Name: {full_name}")
-        print(f"Email: {email}")
-        print(f"Street: {street}")
-        print(f"City: {city}")
-        print(f"State: {state}")
-        print(f"Postal Code: {postal_code}")
-        print(f"Country: {country}")
-        print(f"Phone: {phone}")
-        
         # Validate required fields
         required_fields = ['full_name', 'email', 'street', 'city', 'state', 'postal_code', 'country', 'phone']
         missing_fields = [field for field in required_fields if not request.POST.get(field)]
         
         if missing_fields:
-            print(f"\nERROR: Missing required fields: {missing_fields}")
+            logger.info("Checkout missing fields", extra={'checkout': {'user_id': request.user.pk, 'missing': missing_fields}})
             messages.error(request, f"Please fill in all required fields: {', '.join(missing_fields)}")
             return redirect('checkout')
         
-        # Create address object
+        token = checkout_token(request.POST.get('checkout_token'))
+        
+        # Retrieve cart
+        cart = get_cart(request)
+        owner = {'user_id': user.pk if user else None, 'session_key': request.session.session_key}
+        cart_items = CartItem.objects.filter(cart=cart)
+        
+        if not cart_items.exists():
+            # A resubmitted form finds the cart already emptied by the first submission
+            submission = token and CheckoutSubmission.objects.filter(
+                CheckoutSubmission.owned_by(**owner), token=token, order__isnull=False
+            ).first()
+            if submission:
+                return self.replay(request, submission.order_id)
+            messages.error(request, "Your cart is empty!")
+            return redirect('cart')
+        
         address = Address(
             full_name=full_name,
             email=email,
@@ -273,148 +341,47 @@ class CheckoutView(View):
             country=country,
             phone=phone
         )
-        
-        # If user is logged in & wants to save address
+        # If user is logged in & wants to save address, it's one of theirs; otherwise it's a guest address
         if user and save_address:
             address.user = user
-            existing_address = Address.objects.filter(
-                user=user,
-                full_name=full_name,
-                phone=phone,
-                street=street,
-                city=city,
-                state=state,
-                postal_code=postal_code,
-                country=country
-            ).first()
-            if existing_address:
-                address = existing_address
-                print("Using existing address")
-            else:
-                address.save()
-                print("Created new address")
-        else:
-            address.save()
-            print("Created guest address")
         
-        # Retrieve cart
-        cart = get_cart(request)
-        cart_items = CartItem.objects.filter(cart=cart).select_related('product', 'variant') if cart else []
-        
-        print(f"\nCart items count: {cart_items.count()}")
-        
-        if not cart_items:
-            print("ERROR: Cart is empty")
+        try:
+            order_id, placed = self.place(cart_items, address, token, owner)
+        except EmptyCart:
             messages.error(request, "Your cart is empty!")
             return redirect('cart')
-        
-        try:
-            # Calculate total from cart items
-            order_total = Decimal('0')
-            order_items_data = []
-            
-            for cart_item in cart_items:
-                # Calculate prices for this item
-                if cart_item.product.discount_price:
-                    base_price = cart_item.product.discount_price
-                else:
-                    base_price = cart_item.product.price
-                
-                original_price = cart_item.product.price
-                
-                # Add variant additional price if exists
-                if cart_item.variant and cart_item.variant.additional_price:
-                    base_price += cart_item.variant.additional_price
-                    original_price += cart_item.variant.additional_price
-                
-                # Calculate item total
-                item_total = base_price * cart_item.quantity
-                order_total += item_total
-                
-                print(f"  Cart item: {cart_item.product.name}")
-                print(f"    Quantity: {cart_item.quantity}")
-                print(f"    Price: {base_price}")
-                print(f"    Item total: {item_total}")
-                print(f"    Has variant: {bool(cart_item.variant)}")
-                
-                # Prepare order item data
-                order_items_data.append({
-                    'product': cart_item.product,
-                    'variant': cart_item.variant,
-                    'quantity': cart_item.quantity,
-                    'price': original_price,
-                    'discounted_price': base_price,
-                    'product_obj': cart_item.product,  # For stock update
-                    'variant_obj': cart_item.variant,  # For stock update
-                })
-            
-            print(f"\nCalculated order total: {order_total}")
-            
-            # Create order with calculated total
-            order = Order.objects.create(
-                user=user,
-                delivery_address=address,
-                total=order_total,  # Use calculated total
-                status='processing',
-            )
-            print(f"Order created: ID {order.id}")
-            
-            # Create order items
-            for item_data in order_items_data:
-                OrderItem.objects.create(
-                    order=order,
-                    product=item_data['product'],
-                    variant=item_data['variant'],
-                    quantity=item_data['quantity'],
-                    price=item_data['price'],
-                    discounted_price=item_data['discounted_price']
-                )
-                
-                # Update product stock
-                product = item_data['product_obj']
-                product.sold += item_data['quantity']
-                product.stock = max(product.stock - item_data['quantity'], 0)
-                product.last_sold = timezone.now()
-                product.save()
-                
-                # Update variant stock if exists
-                if item_data['variant_obj']:
-                    variant = item_data['variant_obj']
-                    variant.stock = max(variant.stock - item_data['quantity'], 0)
-                    variant.save()
-            
-            print(f"Created {len(order_items_data)} order items")
-            
-            # Clear cart
-            cart_items.delete()
-            print("Cart cleared")
-            
-            # Store order ID in session for guest users
-            if not user:
-                request.session['guest_order_id'] = order.id
-                request.session.modified = True
-                print(f"Guest order ID stored in session: {order.id}")
-            
-            print("=== CHECKOUT DEBUG END ===\n")
-            
-            messages.success(request, "Your order has been placed successfully!")
-            return redirect('order_confirmation', order_id=order.id)
-            
         except Exception as e:
-            print(f"\nERROR during checkout: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            
-            # Clean up: delete address if it was newly created
-            if address and address.pk and not (user and save_address and 'existing_address' in locals()):
-                try:
-                    address.delete()
-                    print("Cleaned up address")
-                except:
-                    pass
-            
+            # Nothing was written: the order's transaction rolled back, address included
+            logger.exception("Checkout failed: %s", e, extra={'checkout': {'user_id': user.pk if user else None}})
             messages.error(request, "An error occurred during checkout. Please try again.")
             return redirect('cart')
+        
+        if not placed:
+            return self.replay(request, order_id)
+        
+        # Store order ID in session for guest users
+        if not user:
+            request.session['guest_order_id'] = order_id
+            request.session.modified = True
+        
+        messages.success(request, "Your order has been placed successfully!")
+        return redirect('order_confirmation', order_id=order_id)
+
+    def place(self, cart_items, address, token, owner):
+        try:
+            return place_order(cart_items, address, token=token, **owner)
+        except TokenInUse:
+            # Someone else's token (a shared or copied form): this is a checkout of its own
+            return place_order(cart_items, address, **owner)
+
+    def replay(self, request, order_id):
+        """Answer a repeated submission with the order the first one placed"""
+        logger.info("Checkout resubmitted", extra={'checkout': {
+            'order_id': order_id, 'user_id': request.user.pk,
+        }})
+        if not request.user.is_authenticated:
+            request.session['guest_order_id'] = order_id
+        return redirect('order_confirmation', order_id=order_id)
 
 class OrderConfirmationView(View):
     def get(self, request, order_id):
@@ -455,28 +422,20 @@ class OrderDetailView(View):
         
         return render(request, 'order_detail.html', {'order': order})
 
-class OrderHistoryView(View):
-    def get(self, request):
-        if not request.user.is_authenticated:
-            return redirect('login')
-        
-        delivered_orders = Order.objects.filter(
-            user=request.user, 
-            status='delivered'
-        ).select_related('delivery_address').order_by('-created_at')
-        
-        return render(request, 'order_history.html', {'delivered_orders': delivered_orders})
-
 class ProfileView(View):
     def get(self, request):
         user = request.user
-        addresses = Address.objects.filter(user=user)
-        
-        # Get orders with proper prefetching
-        orders = Order.objects.filter(user=user).select_related('delivery_address').order_by('-created_at')
-        
-        active_orders = orders.exclude(status__in=['delivered', 'cancelled'])
-        delivered_orders = orders.filter(status='delivered')
+        addresses = list(Address.objects.filter(user=user))
+        
+        # Order counts come from the maintained summary; only the three most
+        # recent active orders are loaded (user/status/created_at index)
+        summary = OrderSummary.for_user(user)
+        active_orders = list(
+            Order.objects.filter(user=user)
+            .exclude(status__in=['delivered', 'cancelled'])
+            .annotate(item_count=Count('items'))
+            .order_by('-created_at')[:3]
+        )
         
         form = AddressForm()
         
@@ -484,7 +443,7 @@ class ProfileView(View):
             'user': user,
             'addresses': addresses,
             'active_orders': active_orders,
-            'delivered_orders': delivered_orders,
+            'order_summary': summary,
             'form': form
         })
     
@@ -493,15 +452,13 @@ class ProfileView(View):
         address_id = request.POST.get('set_default_address_id')
         if address_id:
             try:
-                # Clear existing default
-                Address.objects.filter(user=request.user, is_default=True).update(is_default=False)
-                # Set new default
-                address = Address.objects.get(id=address_id, user=request.user)
-                address.is_default = True
-                address.save()
-                messages.success(request, "Default address updated successfully!")
-            except Address.DoesNotExist:
-                messages.error(request, "Address not found.")
+                if address_id.isdigit() and Address.set_default(request.user.pk, int(address_id)):
+                    messages.success(request, "Default address updated successfully!")
+                else:
+                    messages.error(request, "Address not found.")
+            except IntegrityError:
+                # Lost to other default changes made at the same moment; the one default stands
+                messages.error(request, "Your addresses were being changed elsewhere. Please try again.")
         
         return redirect('profile')
     
@@ -557,18 +514,24 @@ def edit_profile(request):
     
     return render(request, "edit_profile.html")
 
+class OrderTrackingView(View):
+    def get(self, request, order_id):
+        if not request.user.is_authenticated:
+            return redirect('login')
+        
+        order = get_object_or_404(Order, id=order_id, user=request.user)
+        # Timeline comes straight off the (order, created_at) index
+        events = OrderStatusEvent.objects.filter(order=order).order_by('created_at', 'id')
+        
+        return render(request, 'order_tracking.html', {'order': order, 'events': events})
+
 class OrderHistoryView(View):
     def get(self, request):
         if not request.user.is_authenticated:
             return redirect('login')
         
-        # Get delivered orders with related data
-        delivered_orders = Order.objects.filter(
-            user=request.user, 
-            status='delivered'
-        ).select_related('delivery_address').prefetch_related(
-            Prefetch('items', queryset=OrderItem.objects.select_related('product', 'variant'))
-        ).order_by('-created_at')
+        # Counts and totals come from the maintained per-user summary
+        summary = OrderSummary.for_user(request.user)
         
         # Get orders by status for filtering
         status_filter = request.GET.get('status', 'all')
@@ -586,26 +549,30 @@ class OrderHistoryView(View):
         else:
             orders = Order.objects.filter(user=request.user, status=status_filter)
         
+        # Each line item carries its thumbnail, main image first
         orders = orders.select_related('delivery_address').prefetch_related(
-            Prefetch('items', queryset=OrderItem.objects.select_related('product', 'variant'))
+            Prefetch('items', queryset=OrderItem.objects.select_related('product', 'variant').annotate(
+                thumbnail=main_image_subquery('product_id'),
+            ))
         ).order_by('-created_at')
         
         # Add pagination
         paginator = Paginator(orders, 10)
+        known_count = summary.count_for(status_filter)
+        if known_count is not None:
+            # Skip the COUNT(*) query, the summary already knows the answer
+            paginator.count = known_count
         page_number = request.GET.get('page')
         page_obj = paginator.get_page(page_number)
-        
-        # Statistics
-        total_orders = Order.objects.filter(user=request.user).count()
-        total_spent = Order.objects.filter(user=request.user).aggregate(
-            total=Sum('total')
-        )['total'] or 0
+        for order in page_obj:
+            for item in order.items.all():
+                item.thumbnail_url = default_storage.url(item.thumbnail) if item.thumbnail else None
         
         return render(request, 'order_history.html', {
             'orders': page_obj,
-            'delivered_orders': delivered_orders,
-            'total_orders': total_orders,
-            'total_spent': total_spent,
+            'order_summary': summary,
+            'total_orders': summary.order_count,
+            'total_spent': summary.total_spent,
             'status_filter': status_filter,
             'status_choices': Order.STATUS_CHOICES,
         })
@@ -616,6 +583,7 @@ def manage_address(request, address_id=None):
     address = Address.objects.filter(id=address_id, user=request.user).first() if address_id else None
     
     if request.method == 'POST':
+        was_default = bool(address and address.is_default)
         form = AddressForm(request.POST, instance=address)
         if form.is_valid():
             address = form.save(commit=False)
@@ -625,20 +593,36 @@ def manage_address(request, address_id=None):
             if not address.email:
                 address.email = request.user.email
             
-            # If setting as default, update all other addresses
-            if form.cleaned_data.get('is_default', False):
-                Address.objects.filter(user=request.user).update(is_default=False)
-            elif address_id and not form.cleaned_data.get('is_default', False):
-                # If unchecking default for existing address, check if we need to set another as default
-                if address.is_default:
-                    # Find another address to set as default
-                    other_address = Address.objects.filter(user=request.user).exclude(id=address_id).first()
-                    if other_address:
-                        other_address.is_default = True
-                        other_address.save()
-                    address.is_default = False
+            if not address.pk:
+                # Adding an address that's already saved updates that one instead of duplicating it
+                duplicate = Address.objects.filter(
+                    user=request.user, fingerprint=address.compute_fingerprint()
+                ).first()
+                if duplicate:
+                    address, was_default = duplicate, duplicate.is_default
             
-            address.save()
+            wants_default = form.cleaned_data.get('is_default', False)
+            other_id = None
+            if was_default and not wants_default:
+                # Unchecking the default hands it to another address, if there is one
+                other_id = Address.objects.filter(user=request.user).exclude(id=address.pk).values_list(
+                    'id', flat=True
+                ).first()
+            
+            # The default only moves through set_default(), one statement that can't leave two;
+            # clearing it (on the only address) can't, so the save does that itself
+            address.is_default = was_default and (wants_default or other_id is not None)
+            try:
+                with transaction.atomic():
+                    address.save()
+                    if wants_default and not was_default:
+                        Address.set_default(request.user.pk, address.pk)
+                    elif other_id:
+                        Address.set_default(request.user.pk, other_id)
+            except IntegrityError:
+                # Lost to other default changes made at the same moment; nothing was saved
+                messages.error(request, "Your addresses were being changed elsewhere. Please try again.")
+                return redirect('profile')
             messages.success(request, "Address saved successfully!")
             return redirect('profile')
         else:
@@ -878,40 +862,105 @@ def shop(request):
     }
     return render(request, 'shop.html', context)
 
-def home(request):
-    # Get wishlist product IDs
+# Home page rails: each is cached on its own timeout under a catalog namespace,
+# so a product/review/category change (or the timeout) rebuilds just that rail.
+# Cards carry their rating, review count and image URL, so rendering them
+# needs no further queries.
+HOME_RAIL_TIMEOUTS = {
+    'popular': 10 * 60,
+    'best_sellers': 10 * 60,
+    'new_arrivals': 5 * 60,
+    'latest_reviews': 5 * 60,
+    'categories': 60 * 60,
+}
+
+def main_image_subquery(product_ref):
+    return Subquery(
+        ProductImage.objects.filter(product_id=OuterRef(product_ref)).order_by('-is_main', 'id').values('image')[:1]
+    )
+
+def review_stat_subquery(aggregate):
+    reviews = Review.objects.filter(product_id=OuterRef('pk')).order_by().values('product_id')
+    return Subquery(reviews.annotate(value=aggregate).values('value'))
+
+def product_cards(queryset, limit):
+    products = list(
+        queryset.only('id', 'name', 'slug', 'price', 'discount_price', 'sold').annotate(
+            rating_avg=review_stat_subquery(Avg('rating')),
+            rating_count=Coalesce(review_stat_subquery(Count('id')), 0),
+            main_image=main_image_subquery('pk'),
+        )[:limit]
+    )
+    for product in products:
+        product.image_url = default_storage.url(product.main_image) if product.main_image else ''
+    return products
+
+def popular_rail():
+    return product_cards(Product.objects.order_by('-wishlist_count', 'id'), 10)
+
+def best_sellers_rail():
+    return product_cards(Product.objects.order_by('-sold', 'id'), 5)
+
+def new_arrivals_rail():
+    return product_cards(Product.objects.order_by('-created_at', '-id'), 8)
+
+def latest_reviews_rail():
+    reviews = list(
+        Review.objects.select_related('user', 'product')
+        .only('id', 'rating', 'comment', 'created_at', 'user__username', 'product__name', 'product__slug')
+        .annotate(product_image=main_image_subquery('product_id'))
+        .order_by('-created_at')[:20]
+    )
+    for review in reviews:
+        review.product_image_url = default_storage.url(review.product_image) if review.product_image else ''
+    return reviews
+
+def categories_rail():
+    return list(Category.objects.all()[:6])
+
+HOME_RAILS = {
+    'popular': (Product, popular_rail),
+    'best_sellers': (Product, best_sellers_rail),
+    'new_arrivals': (Product, new_arrivals_rail),
+    'latest_reviews': (Review, latest_reviews_rail),
+    'categories': (Category, categories_rail),
+}
+
+# Ranked by sales: the key also carries the sales generation, so a recorded
+# order rebuilds these rails without flushing the rest of the Product namespace
+SALES_RANKED_RAILS = {'best_sellers'}
+
+def home_rail(name):
+    namespace, build = HOME_RAILS[name]
+    key = f'home:{name}'
+    if name in SALES_RANKED_RAILS:
+        key = f'{key}:{generation(Product.SALES_CACHE_NAMESPACE)}'
+    return get_or_compute(namespace, key, build, HOME_RAIL_TIMEOUTS[name])
+
+def home_overlay(request):
+    """The per-request part of the home page: ids of the products in the wishlist and cart (JSON-safe lists)"""
     if request.user.is_authenticated:
-        try:
-            wishlist = Wishlist.objects.get(user=request.user)
-            wishlist_items = wishlist.wishlistitem.all()
-            wishlist_product_ids = [item.product_id for item in wishlist_items]
-        except Wishlist.DoesNotExist:
-            wishlist_product_ids = []
+        wishlist_product_ids = list(
+            WishlistItem.objects.filter(wishlist__user=request.user).values_list('product_id', flat=True)
+        )
+        cart_items = CartItem.objects.filter(cart__user=request.user)
     else:
-        # For guest users
         session_wishlist = request.session.get('wishlist', [])
         wishlist_product_ids = [int(pid) for pid in session_wishlist if str(pid).isdigit()]
-    
-    # Get cart product IDs
-    cart = get_cart(request)
-    cart_items = CartItem.objects.filter(cart=cart)
-    cart_product_ids = [item.product_id for item in cart_items]
-    
-    popular_products = Product.objects.annotate(
-        wishlist_count=Count('wishlistitem')
-    ).order_by('-wishlist_count')[:10]
-    
-    most_sold_products = Product.objects.order_by('-sold')[:5]
-    latest_reviews = Review.objects.select_related('user', 'product').order_by('-created_at')[:20]
-    
+        session_key = request.session.session_key
+        cart_items = CartItem.objects.filter(cart__session_key=session_key) if session_key else CartItem.objects.none()
+    return wishlist_product_ids, list(cart_items.values_list('product_id', flat=True))
+
+def home(request):
+    wishlist_product_ids, cart_product_ids = home_overlay(request)
     context = {
         'wishlist_product_ids': wishlist_product_ids,
         'cart_product_ids': cart_product_ids,
-        'popular_products': popular_products,
-        'most_sold': most_sold_products,
-        'categories': Category.objects.all()[:6],
-        'new_arrivals': Product.objects.order_by('-created_at')[:8],
-        'latest_reviews': latest_reviews,
+        'popular_products': home_rail('popular'),
+        'most_sold': home_rail('best_sellers'),
+        'categories': home_rail('categories'),
+        'new_arrivals': home_rail('new_arrivals'),
+        'latest_reviews': home_rail('latest_reviews'),
     }
     return render(request, 'home.html', context)
 
@@ -977,44 +1026,36 @@ def about_page_private(request):
     return render(request, 'about_private.html', context)
 
 @require_POST
-def add_to_cart(request, product_id):
+async def add_to_cart(request, product_id):
     try:
-        cart = get_cart(request)
-        product = get_object_or_404(Product, id=product_id)
+        cart = await aget_cart(request)
+        product = await aget_object_or_404(Product, id=product_id)
         variant_id = request.POST.get('variant_id')
         
         variant = None
         if variant_id:
-            try:
-                variant = ProductVariant.objects.get(id=variant_id, product=product)
-            except ProductVariant.DoesNotExist:
-                pass
+            variant = await ProductVariant.objects.filter(id=variant_id, product=product).afirst()
         
         # Check if product with same variant already exists in cart
-        if variant:
-            cart_item, created = CartItem.objects.get_or_create(
-                cart=cart, 
-                product=product, 
-                variant=variant,
-                defaults={'quantity': 1}
-            )
-        else:
-            cart_item, created = CartItem.objects.get_or_create(
-                cart=cart, 
-                product=product,
-                defaults={'quantity': 1}
-            )
+        lookup = {'variant': variant} if variant else {}
+        cart_item, created = await CartItem.objects.aget_or_create(
+            cart=cart,
+            product=product,
+            defaults={'quantity': 1},
+            **lookup
+        )
         
         if not created:
-            cart_item.quantity += 1
-            cart_item.save()
+            await CartItem.objects.filter(pk=cart_item.pk).aupdate(quantity=F('quantity') + 1)
+            notify_cart_streams(cart)
         
-        cart_count = get_cart_count(request)
+        cart_count = await acart_count(CartItem.objects.filter(cart=cart))
         
         # Force session save for guests
-        if not request.user.is_authenticated:
+        user = await request.auser()
+        if not user.is_authenticated:
             request.session.modified = True
-            request.session.save()
+            await request.session.asave()
         
         return JsonResponse({
             'success': True,
@@ -1027,52 +1068,40 @@ def add_to_cart(request, product_id):
         return JsonResponse({'success': False, 'error': str(e)}, status=500)    
 
 @require_POST
-def update_cart(request, product_id, action):
+async def update_cart(request, product_id, action):
     try:
-        cart = get_cart(request)
-        product = get_object_or_404(Product, id=product_id)
+        cart = await aget_cart(request)
+        product = await aget_object_or_404(Product, id=product_id)
         variant_id = request.POST.get('variant_id')  # Get variant_id from POST
         
         # Find the cart item with variant (if variant_id provided)
+        items = CartItem.objects.filter(cart=cart, product=product)
         if variant_id:
-            cart_item = CartItem.objects.filter(
-                cart=cart, 
-                product=product,
-                variant_id=variant_id
-            ).first()
-        else:
-            cart_item = CartItem.objects.filter(cart=cart, product=product).first()
+            items = items.filter(variant_id=variant_id)
+        cart_item = await items.afirst()
         
         if not cart_item:
             return JsonResponse({'success': False, 'error': 'Item not found in cart'}, status=404)
         
-        with transaction.atomic():
-            if action == 'increase':
-                cart_item.quantity += 1
-                cart_item.save()
-            elif action == 'decrease':
-                if cart_item.quantity > 1:
-                    cart_item.quantity -= 1
-                    cart_item.save()
-                else:
-                    cart_item.delete()
-            elif action == 'remove':
-                cart_item.delete()
+        # Single-statement updates, so concurrent clicks can't lose an increment
+        if action == 'increase':
+            await CartItem.objects.filter(pk=cart_item.pk).aupdate(quantity=F('quantity') + 1)
+            notify_cart_streams(cart)
+        elif action == 'decrease':
+            decreased = await CartItem.objects.filter(pk=cart_item.pk, quantity__gt=1).aupdate(
+                quantity=F('quantity') - 1
+            )
+            if decreased:
+                notify_cart_streams(cart)
+            else:
+                await cart_item.adelete()
+        elif action == 'remove':
+            await cart_item.adelete()
         
-        cart.refresh_from_db()
-        cart_items = CartItem.objects.filter(cart=cart)
+        cart_items = [item async for item in CartItem.objects.filter(cart=cart).select_related('product')]
         total = sum(item.get_subtotal() for item in cart_items)
-        cart_count = get_cart_count(request)
-        
-        # Get updated item
-        if variant_id:
-            updated_item = CartItem.objects.filter(
-                cart=cart, 
-                product=product,
-                variant_id=variant_id
-            ).first()
-        else:
-            updated_item = CartItem.objects.filter(cart=cart, product=product).first()
+        cart_count = sum(item.quantity for item in cart_items)
+        updated_item = next((item for item in cart_items if item.pk == cart_item.pk), None)
         
         return JsonResponse({
             'success': True,
@@ -1090,20 +1119,13 @@ def cart(request):
     cart = get_cart(request)
     cart_items = CartItem.objects.filter(cart=cart).select_related('product', 'variant')
     
-    # DEBUG: Print cart items with variant info
-    print("\n=== CART DEBUG ===")
-    for item in cart_items:
-        print(f"Product: {item.product.name}")
-        print(f"  Variant ID: {item.variant_id}")
-        print(f"  Variant: {item.variant}")
-        print(f"  Has variant: {bool(item.variant)}")
-        print("---")
-    print("=== END DEBUG ===\n")
-    
     total = 0
     for item in cart_items:
         item.subtotal = item.get_subtotal()
         total += item.subtotal
+        logger.debug("Cart item", extra={'cart': {
+            'cart_id': item.cart_id, 'product_id': item.product_id, 'variant_id': item.variant_id,
+        }})
 
     recommended_products = Product.objects.order_by('-created_at')[:6]
 
@@ -1258,8 +1280,6 @@ def wishlist(request):
 def add_to_wishlist(request, product_id):
     """Add or remove product from wishlist"""
     try:
-        print(f"Adding to wishlist - Product ID: {product_id}, User: {request.user}")
-        
         if request.user.is_authenticated:
             # Authenticated user
             wishlist, created = Wishlist.objects.get_or_create(user=request.user)
@@ -1292,12 +1312,15 @@ def add_to_wishlist(request, product_id):
                 session_wishlist.append(product_id_str)
                 action = 'added'
             
-            # Update session
+            # Update session; saved now so the header stream reads the new list
             request.session['wishlist'] = session_wishlist
-            request.session.modified = True
+            request.session.save()
+            publish_counts_changed(session_key=request.session.session_key)
             wishlist_count = len(session_wishlist)
         
-        print(f"Wishlist action: {action}, Count: {wishlist_count}")
+        logger.debug("Wishlist %s", action, extra={'wishlist': {
+            'product_id': product_id, 'user_id': request.user.pk, 'count': wishlist_count,
+        }})
         
         return JsonResponse({
             'success': True, 
@@ -1306,9 +1329,7 @@ def add_to_wishlist(request, product_id):
             'message': f'Item {action} wishlist'
         })
     except Exception as e:
-        print(f"Error in add_to_wishlist: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in add_to_wishlist: %s", e)
         
         return JsonResponse({
             'success': False,
@@ -1331,7 +1352,8 @@ def delete_wishlist_item(request, item_id):
             if product_id in wishlist:
                 wishlist.remove(product_id)
                 request.session['wishlist'] = wishlist
-                request.session.modified = True
+                request.session.save()
+                publish_counts_changed(session_key=request.session.session_key)
             return JsonResponse({'success': True})
         except ValueError:
             return JsonResponse({'success': False, 'error': 'Invalid item id.'}, status=400)
@@ -1345,7 +1367,8 @@ def remove_guest_wishlist_item(request, product_id):
         if product_id_str in wishlist:
             wishlist.remove(product_id_str)
             request.session['wishlist'] = wishlist
-            request.session.modified = True
+            request.session.save()
+            publish_counts_changed(session_key=request.session.session_key)
             return JsonResponse({'success': True})
         return JsonResponse({'success': False, 'error': 'Item not found.'}, status=404)
     return JsonResponse({'success': False, 'error': 'User is authenticated.'}, status=400)
@@ -1366,6 +1389,7 @@ def superuser_check(user):
 
 
 @user_passes_test(admin_check, login_url='login')
+@replica_reads()
 def admin_dashboard(request):
     days = int(request.GET.get('days', 30))
     date_range = timezone.now() - timedelta(days=days)
@@ -1451,37 +1475,132 @@ def admin_dashboard(request):
     
     return render(request, 'dashboard/dashboard.html', context)
 
+@user_passes_test(admin_check, login_url='login')
+def cache_stats_api(request):
+    """This process's cache hit/miss counters"""
+    return JsonResponse(cache_stats())
+
+ORDER_SEARCH_PHONE_MIN_DIGITS = 7
+# ASCII digits only: str.isdigit() and \d also accept characters int() or
+# the phone index (PhoneDigits) don't
+ORDER_ID_QUERY_RE = re.compile(r'#?([0-9]+)')
+PHONE_QUERY_RE = re.compile(r'^\+?[0-9\s\-()]+$')
+
+def search_orders(orders, search_query):
+    """
+    Filter orders for the staff search box, routed to the cheapest lookup:
+    numeric -> order id (and phone when long enough), contains '@' -> email,
+    phone-like -> normalized phone, anything else -> customer name.
+    Address/user matches are subqueries served by their own indexes, so the
+    orders table is only probed by primary/foreign key (and no id list is
+    pulled into Python, however many addresses match).
+    Emails match exactly (case-insensitively); names and usernames match
+    partially.
+    """
+    query = search_query.strip()
+    digits = re.sub(r'[^0-9]', '', query)
+    phone_matches = Address.objects.alias(phone_digits=PhoneDigits('phone')).filter(phone_digits=digits).values('id')
+    
+    order_id = ORDER_ID_QUERY_RE.fullmatch(query)
+    if order_id:
+        condition = Q(id=int(order_id.group(1)))
+        if len(digits) >= ORDER_SEARCH_PHONE_MIN_DIGITS:
+            condition |= Q(delivery_address_id__in=phone_matches)
+        return orders.filter(condition)
+    
+    if '@' in query:
+        # Both served by expression indexes: LOWER(address email), UPPER(user email)
+        return orders.filter(
+            Q(delivery_address_id__in=Address.objects.alias(email_lower=Lower('email'))
+              .filter(email_lower=query.lower()).values('id'))
+            | Q(user_id__in=User.objects.filter(email__iexact=query).values('id'))
+        )
+    
+    if PHONE_QUERY_RE.match(query) and len(digits) >= ORDER_SEARCH_PHONE_MIN_DIGITS:
+        return orders.filter(delivery_address_id__in=phone_matches)
+    
+    # Name search: trigram indexes on UPPER(full_name) and UPPER(username) serve the icontains matches
+    return orders.filter(
+        Q(delivery_address_id__in=Address.objects.filter(full_name__icontains=query).values('id'))
+        | Q(user_id__in=User.objects.filter(username__icontains=query).values('id'))
+    )
+
+ORDER_LIST_PAGE_SIZE = 10
+
+def line_cost_expression(prefix=''):
+    """SQL version of OrderItem.get_cost(): discounted price when set (and non-zero), else price"""
+    return ExpressionWrapper(
+        Coalesce(NullIf(F(f'{prefix}discounted_price'), Value(0)), F(f'{prefix}price')) * F(f'{prefix}quantity'),
+        output_field=DecimalField(max_digits=12, decimal_places=2),
+    )
+
+def staff_order_list_queryset():
+    """
+    Orders with just the columns the staff order list renders, plus the
+    line count and items total computed in SQL per order.
+    """
+    order_items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    return Order.objects.select_related('user', 'delivery_address').only(
+        'id', 'status', 'created_at', 'total',
+        'user__username', 'user__first_name', 'user__last_name',
+        'delivery_address__full_name', 'delivery_address__email', 'delivery_address__phone',
+        'delivery_address__street', 'delivery_address__city', 'delivery_address__state',
+        'delivery_address__country', 'delivery_address__postal_code',
+    ).annotate(
+        line_count=Coalesce(Subquery(order_items.annotate(n=Count('id')).values('n')), Value(0)),
+        items_total=Coalesce(
+            Subquery(order_items.annotate(t=Sum(line_cost_expression())).values('t')),
+            Value(Decimal('0')),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        ),
+    )
+
+def attach_order_lines(orders):
+    """
+    Load the line items for a page of orders in a single query and attach
+    them as order.lines, each with one thumbnail_url (main image first).
+    """
+    orders = list(orders)
+    thumbnails = ProductImage.objects.filter(product=OuterRef('product_id')).order_by('-is_main', 'id')
+    lines = OrderItem.objects.filter(order__in=[order.id for order in orders]).select_related(
+        'product', 'variant'
+    ).only(
+        'id', 'order_id', 'quantity', 'price', 'discounted_price',
+        'product__name',
+        'variant__product', 'variant__wattage', 'variant__color', 'variant__shape', 'variant__size', 'variant__additional_price',
+    ).annotate(
+        thumbnail=Subquery(thumbnails.values('image')[:1]),
+    ).order_by('order_id', 'id')
+    
+    lines_by_order = {}
+    for line in lines:
+        line.thumbnail_url = default_storage.url(line.thumbnail) if line.thumbnail else None
+        if line.variant and line.variant.product_id == line.product_id:
+            # ProductVariant.__str__ uses the product name, reuse the one already loaded
+            line.variant.product = line.product
+        lines_by_order.setdefault(line.order_id, []).append(line)
+    for order in orders:
+        order.lines = lines_by_order.get(order.id, [])
+    return orders
+
 @user_passes_test(admin_check, login_url='login')
 def order_list(request):
     status_filter = request.GET.get('status', '')
     search_query = request.GET.get('search', '')
     
-    orders = Order.objects.select_related(
-        'user',
-        'delivery_address'
-    ).prefetch_related(
-        Prefetch('items', queryset=OrderItem.objects.select_related(
-            'product', 
-            'variant'
-        ).prefetch_related('product__images'))
-    ).order_by('-created_at')
+    orders = staff_order_list_queryset().order_by('-created_at')
     
     if status_filter:
         orders = orders.filter(status=status_filter)
     
     if search_query:
-        orders = orders.filter(
-            Q(id__icontains=search_query) |
-            Q(user__username__icontains=search_query) |
-            Q(user__email__icontains=search_query) |
-            Q(delivery_address__full_name__icontains=search_query) |
-            Q(delivery_address__phone__icontains=search_query)
-        )
+        orders = search_orders(orders, search_query)
     
     # Add pagination
-    paginator = Paginator(orders, 10)  # 10 orders per page
+    paginator = Paginator(orders, ORDER_LIST_PAGE_SIZE)
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
+    page_obj.object_list = attach_order_lines(page_obj.object_list)
     
     return render(request, 'dashboard/orders.html', {
         'orders': page_obj,
@@ -1493,24 +1612,103 @@ def order_list(request):
 @user_passes_test(admin_check, login_url='login')
 def update_order_status(request, order_id):
     if request.method == 'POST':
-        order = get_object_or_404(Order, id=order_id)
         new_status = request.POST.get('status')
         if new_status in dict(Order.STATUS_CHOICES):
-            order.status = new_status
-            order.save()
+            found = Order.transition_status([order_id], new_status, changed_by=request.user)
+            result = Order.transition_results([order_id], new_status, found)[order_id]
+            if result == 'not_found':
+                raise Http404("Order not found")
+            if result == 'invalid_transition':
+                return JsonResponse({'success': False, 'error': f"Cannot move order from {found[order_id]} to {new_status}"})
             return JsonResponse({'success': True})
         return JsonResponse({'success': False, 'error': 'Invalid status'})
     return JsonResponse({'success': False, 'error': 'Invalid request method'})
 
+@require_POST
+@user_passes_test(admin_check, login_url='login')
+def bulk_update_order_status(request):
+    """
+    Move many orders to one status in a single transition, for the staff
+    dashboard. Accepts form data (order_ids=1&order_ids=2&status=shipped)
+    or a JSON body ({"order_ids": [1, 2], "status": "shipped"}). Scripts
+    use the token-authenticated api.OrderStatusBulkView instead.
+    """
+    if request.content_type == 'application/json':
+        try:
+            payload = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid JSON'}, status=400)
+        if not isinstance(payload, dict):
+            return JsonResponse({'success': False, 'error': 'Invalid JSON'}, status=400)
+        raw_ids = payload.get('order_ids', [])
+        # A string or an object would otherwise be read character by character or by its keys
+        if not isinstance(raw_ids, list) or not all(
+            isinstance(order_id, (int, str)) and not isinstance(order_id, bool) for order_id in raw_ids
+        ):
+            return JsonResponse({'success': False, 'error': 'order_ids must be a list of ids'}, status=400)
+        new_status = payload.get('status')
+    else:
+        raw_ids = request.POST.getlist('order_ids')
+        new_status = request.POST.get('status')
+    
+    if new_status not in dict(Order.STATUS_CHOICES):
+        return JsonResponse({'success': False, 'error': 'Invalid status'}, status=400)
+    try:
+        order_ids = list(dict.fromkeys(int(order_id) for order_id in raw_ids))
+    except (TypeError, ValueError):
+        return JsonResponse({'success': False, 'error': 'order_ids must be integers'}, status=400)
+    if not order_ids:
+        return JsonResponse({'success': False, 'error': 'No orders selected'}, status=400)
+    if len(order_ids) > BULK_STATUS_MAX_ORDERS:
+        return JsonResponse({
+            'success': False,
+            'error': f'At most {BULK_STATUS_MAX_ORDERS} orders per request'
+        }, status=400)
+    
+    found = Order.transition_status(order_ids, new_status, changed_by=request.user)
+    results = Order.transition_results(order_ids, new_status, found)
+    
+    return JsonResponse({
+        'success': True,
+        'status': new_status,
+        'updated': sum(1 for result in results.values() if result == 'updated'),
+        'results': {str(order_id): result for order_id, result in results.items()},
+    })
+
 @user_passes_test(admin_check, login_url='login')
 def cancel_order(request, order_id):
     if request.method == 'POST':
-        order = get_object_or_404(Order, id=order_id)
-        order.status = 'cancelled'
-        order.save()
+        found = Order.transition_status([order_id], 'cancelled', changed_by=request.user)
+        result = Order.transition_results([order_id], 'cancelled', found)[order_id]
+        if result == 'not_found':
+            raise Http404("Order not found")
+        if result == 'invalid_transition':
+            return JsonResponse({'success': False, 'message': f"A {found[order_id]} order can't be cancelled"})
         return JsonResponse({'success': True})
     return JsonResponse({'success': False, 'message': 'Invalid request'})
 
+@user_passes_test(admin_check, login_url='login')
+@require_GET
+def export_orders(request):
+    """Stream order lines (with order and address) as CSV or JSONL for finance"""
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return JsonResponse({'success': False, 'message': 'Unknown format'}, status=400)
+    try:
+        filters = {
+            'start': parse_export_date(request.GET.get('start')),
+            'end': parse_export_date(request.GET.get('end')),
+            'status': request.GET.get('status') or None,
+            'since_id': int(request.GET.get('since_id') or 0),
+        }
+        rows = export_rows(**filters)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+
+    response = StreamingHttpResponse(export_lines(rows, fmt), content_type=CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = f'attachment; filename="orders-{timezone.now():%Y%m%d-%H%M%S}.{fmt}"'
+    return response
+
 @user_passes_test(admin_check, login_url='login')
 def product_list(request):
     products = Product.objects.select_related("category", "brand").prefetch_related("images", "variants")